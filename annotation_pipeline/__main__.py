@@ -9,6 +9,7 @@ from annotation_pipeline.utils import get_ibm_cos_client
 from annotation_pipeline.imzml import convert_imzml_to_txt
 from annotation_pipeline.pipeline import Pipeline
 from annotation_pipeline.molecular_db import build_database, calculate_centroids, upload_mol_dbs_from_dir
+from annotation_pipeline.server import serve
 
 logger = logging.getLogger(name='annotation_pipeline')
 
@@ -49,6 +50,11 @@ def generate_centroids(args, config):
     calculate_centroids(config, input_db, polarity, isocalc_sigma)
 
 
+def serve_annotations(args, config):
+    input_config = json.load(args.input)
+    serve(config, input_config, args.host, args.port)
+
+
 def convert_imzml(args, config):
     assert args.input.endswith('.imzML')
     assert args.output.endswith('.txt')
@@ -118,6 +124,13 @@ if __name__ == '__main__':
     centroids_parser.add_argument('input', type=argparse.FileType('r'), default='input_config.json', nargs='?',
                                   help='input_config.json path')
 
+    serve_parser = subparsers.add_parser('serve')
+    serve_parser.set_defaults(func=serve_annotations)
+    serve_parser.add_argument('input', type=argparse.FileType('r'), default='input_config.json', nargs='?',
+                              help='input_config.json path')
+    serve_parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    serve_parser.add_argument('--port', type=int, default=8000, help='port to listen on')
+
     convert_parser = subparsers.add_parser('convert_imzml')
     convert_parser.set_defaults(func=convert_imzml)
     convert_parser.add_argument('input', help='path to .imzML file (matching .ibd file must be in the same directory)')
@@ -0,0 +1,316 @@
+import json
+import pickle
+import platform
+import subprocess
+import time
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from annotation_pipeline.executor import get_executor
+from annotation_pipeline.synthetic import generate_mol_db, write_imzml
+from annotation_pipeline.utils import logger, get_ibm_cos_client, clean_from_cos, get_pixel_indices, ds_dims, \
+    merge_sorted_runs
+
+ISOTOPE_MZ_SPACING = 1.00335
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name):
+    """ Registers a benchmark. The decorated function receives a `BenchmarkContext` and returns a dict with
+    a `run` callable that does the measured work, the number of `items` it processes and an optional `setup`
+    callable that is called, untimed, before every run.
+    """
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+class BenchmarkContext(object):
+    """ Synthetic inputs shared by the benchmarks, created lazily in `work_dir`
+
+    The dataset's spectra contain the isotope peaks of every tenth synthetic centroids formula, so that
+    image generation, scoring and FDR benchmarks work with real annotations.
+    """
+
+    def __init__(self, work_dir, nrows=50, ncols=50, peaks_n=1000, mz_precision='f', continuous=False,
+                 formulas_n=5000, mols_n=5000, ds_segm_size_mb=1, workers=None, seed=0):
+        self.work_dir = Path(work_dir)
+        self.params = OrderedDict([('nrows', nrows), ('ncols', ncols), ('peaks_n', peaks_n),
+                                   ('mz_precision', mz_precision), ('continuous', continuous),
+                                   ('formulas_n', formulas_n), ('mols_n', mols_n),
+                                   ('ds_segm_size_mb', ds_segm_size_mb), ('seed', seed)])
+        self.ds_segm_size_mb = ds_segm_size_mb
+        self.config = {'local_cos': {'path': str(self.work_dir / 'cos')},
+                       'executor': {'type': 'local', 'workers': workers},
+                       'storage': {'ds_bucket': 'ds', 'db_bucket': 'db', 'output_bucket': 'output'}}
+        self.input_data = {'ds_segments': 'tmp/ds_segments', 'num_decoys': 20}
+        self.input_db = {'formulas_chunks': 'db/formulas_chunks',
+                         'databases': ['db/mol_db1.pickle'],
+                         'adducts': ['+H', '+Na', '+K'],
+                         'modifiers': ['', '-H2O']}
+        self.image_gen_config = {'q': 99, 'do_preprocessing': False, 'nlevels': 30, 'ppm': 3.0}
+        self._cache = {}
+
+    def _cached(self, name, create):
+        if name not in self._cache:
+            self._cache[name] = create()
+        return self._cache[name]
+
+    @property
+    def ibm_cos(self):
+        return self._cached('ibm_cos', lambda: get_ibm_cos_client(self.config))
+
+    @property
+    def pw(self):
+        return self._cached('pw', lambda: get_executor(self.config))
+
+    @property
+    def centr_df(self):
+        """ Centroids of synthetic formulas, sorted by mz like the centroids segments """
+        def create():
+            rng = np.random.RandomState(self.params['seed'])
+            formulas_n = self.params['formulas_n']
+            first_mzs = rng.uniform(110, 990, size=formulas_n)
+            peak_ints = np.array([100, 50, 20, 5], dtype=np.float64)
+            peak_mzs = first_mzs[:, None] + np.arange(len(peak_ints)) * ISOTOPE_MZ_SPACING
+            centr_df = pd.DataFrame({'formula_i': np.repeat(np.arange(formulas_n), len(peak_ints)),
+                                     'peak_i': np.tile(np.arange(len(peak_ints)), formulas_n),
+                                     'mz': peak_mzs.ravel(),
+                                     'int': np.tile(peak_ints, formulas_n)},
+                                    columns=['formula_i', 'peak_i', 'mz', 'int'])
+            return centr_df.sort_values('mz').reset_index(drop=True)
+        return self._cached('centr_df', create)
+
+    @property
+    def imzml_parser(self):
+        def create():
+            from pyimzml.ImzMLParser import ImzMLParser
+            imzml_path = self.work_dir / 'ds' / 'ds.imzML'
+            imzml_path.parent.mkdir(parents=True, exist_ok=True)
+            planted_mzs = self.centr_df.mz[self.centr_df.formula_i % 10 == 0].values
+            write_imzml(imzml_path, self.params['nrows'], self.params['ncols'], self.params['peaks_n'],
+                        mz_precision=self.params['mz_precision'], continuous=self.params['continuous'],
+                        planted_mzs=planted_mzs, seed=self.params['seed'])
+            return ImzMLParser(str(imzml_path))
+        return self._cached('imzml_parser', create)
+
+    @property
+    def coordinates(self):
+        return [coo[:2] for coo in self.imzml_parser.coordinates]
+
+    @property
+    def spectra_runs(self):
+        """ Dataset peaks split into 8 mz-sorted runs of interleaved spectra, like the parts of a dataset segment """
+        def create():
+            pixel_indices = get_pixel_indices(self.coordinates)
+            runs = []
+            for run_i in range(8):
+                sp_inds = range(run_i, len(self.coordinates), 8)
+                spectra = [self.imzml_parser.getspectrum(sp_i) for sp_i in sp_inds]
+                mzs = np.concatenate([mzs for mzs, _ in spectra])
+                by_mz = np.argsort(mzs, kind='mergesort')
+                runs.append(OrderedDict([
+                    ('sp_i', np.repeat(pixel_indices[list(sp_inds)], [len(mzs) for mzs, _ in spectra])
+                     .astype(np.uint32)[by_mz]),
+                    ('mz', mzs[by_mz]),
+                    ('int', np.concatenate([ints for _, ints in spectra]).astype(np.float32)[by_mz])]))
+            return runs
+        return self._cached('spectra_runs', create)
+
+    @property
+    def spectra(self):
+        """ All dataset peaks sorted by mz """
+        return self._cached('spectra', lambda: merge_sorted_runs(self.spectra_runs))
+
+    @property
+    def ds_segments_bounds(self):
+        from annotation_pipeline.segment import define_ds_segments
+        return self._cached('ds_segments_bounds',
+                            lambda: define_ds_segments(self.imzml_parser, self.ds_segm_size_mb, sample_ratio=1))
+
+    @property
+    def formula_images(self):
+        def create():
+            from annotation_pipeline.image import gen_iso_images
+            nrows, ncols = ds_dims(self.coordinates)
+            spectra = self.spectra
+            return list(gen_iso_images(spectra['sp_i'], spectra['mz'], spectra['int'], self.centr_df, nrows, ncols,
+                                       ppm=self.image_gen_config['ppm']))
+        return self._cached('formula_images', create)
+
+    @property
+    def sample_area_mask(self):
+        from annotation_pipeline.image import make_sample_area_mask
+        return make_sample_area_mask(self.coordinates)
+
+    def upload_mol_db(self):
+        def upload():
+            mols = generate_mol_db(self.params['mols_n'], seed=self.params['seed'])
+            self.ibm_cos.put_object(Bucket=self.config['storage']['db_bucket'], Key=self.input_db['databases'][0],
+                                    Body=pickle.dumps(mols))
+            return len(mols)
+        return self._cached('mols_n', upload)
+
+    def build_database(self):
+        from annotation_pipeline.molecular_db import build_database
+        self.upload_mol_db()
+        return self._cached('formulas_n', lambda: build_database(self.config, self.input_db)[0])
+
+
+@benchmark('define_ds_segments')
+def bench_define_ds_segments(ctx):
+    from annotation_pipeline.segment import define_ds_segments
+    sp_n = len(ctx.coordinates)
+    return {'run': lambda: define_ds_segments(ctx.imzml_parser, ctx.ds_segm_size_mb, sample_ratio=1),
+            'items': sp_n}
+
+
+@benchmark('chunk_spectra')
+def bench_chunk_spectra(ctx):
+    from annotation_pipeline.segment import chunk_spectra
+    bucket, prefix = ctx.config['storage']['ds_bucket'], ctx.input_data['ds_segments']
+    return {'setup': lambda: clean_from_cos(ctx.config, bucket, prefix, ctx.ibm_cos),
+            'run': lambda: chunk_spectra(ctx.config, ctx.input_data, ctx.imzml_parser, ctx.coordinates,
+                                         ctx.ds_segments_bounds),
+            'items': len(ctx.spectra['mz'])}
+
+
+@benchmark('merge_sorted_runs')
+def bench_merge_sorted_runs(ctx):
+    runs = ctx.spectra_runs
+    rows_n = sum(len(run['mz']) for run in runs)
+    out = OrderedDict((name, np.empty(rows_n, dtype=arr.dtype)) for name, arr in runs[0].items())
+    return {'run': lambda: merge_sorted_runs(runs, out=out),
+            'items': rows_n}
+
+
+@benchmark('gen_iso_images')
+def bench_gen_iso_images(ctx):
+    from annotation_pipeline.image import gen_iso_images
+    nrows, ncols = ds_dims(ctx.coordinates)
+    spectra = ctx.spectra
+
+    def run():
+        for _ in gen_iso_images(spectra['sp_i'], spectra['mz'], spectra['int'], ctx.centr_df, nrows, ncols,
+                                ppm=ctx.image_gen_config['ppm']):
+            pass
+
+    return {'run': run, 'items': ctx.params['formulas_n']}
+
+
+@benchmark('compute_image_metrics')
+def bench_compute_image_metrics(ctx):
+    from annotation_pipeline.validate import make_compute_image_metrics, formula_image_metrics
+    nrows, ncols = ds_dims(ctx.coordinates)
+    compute_metrics = make_compute_image_metrics(ctx.sample_area_mask, nrows, ncols, ctx.image_gen_config)
+    formula_images = ctx.formula_images
+
+    def run():
+        formula_image_metrics(iter(formula_images), compute_metrics, lambda f_i, f_metrics, f_images: None)
+
+    return {'run': run, 'items': len(formula_images)}
+
+
+@benchmark('compute_image_metrics_batch')
+def bench_compute_image_metrics_batch(ctx):
+    from annotation_pipeline.validate import make_compute_image_metrics_batch, formula_image_metrics_batch
+    nrows, ncols = ds_dims(ctx.coordinates)
+    compute_metrics = make_compute_image_metrics_batch(ctx.sample_area_mask, nrows, ncols, ctx.image_gen_config)
+    formula_images = ctx.formula_images
+
+    def run():
+        formula_image_metrics_batch(iter(formula_images), compute_metrics, lambda f_i, f_metrics, f_images: None)
+
+    return {'run': run, 'items': len(formula_images)}
+
+
+@benchmark('build_database')
+def bench_build_database(ctx):
+    from annotation_pipeline.molecular_db import build_database, DECOY_ADDUCTS
+    mols_n = ctx.upload_mol_db()
+    bucket, prefix = ctx.config['storage']['db_bucket'], ctx.input_db['formulas_chunks']
+    adducts_n = len(ctx.input_db['adducts']) + len(DECOY_ADDUCTS)
+    return {'setup': lambda: clean_from_cos(ctx.config, bucket, prefix, ctx.ibm_cos),
+            'run': lambda: build_database(ctx.config, ctx.input_db),
+            'items': mols_n * adducts_n * len(ctx.input_db['modifiers'])}
+
+
+@benchmark('calculate_fdrs')
+def bench_calculate_fdrs(ctx):
+    from annotation_pipeline.fdr import calculate_fdrs, MsmVector
+    formulas_n = ctx.build_database()
+    rng = np.random.RandomState(ctx.params['seed'])
+    scored_formula_is = np.sort(rng.choice(formulas_n, formulas_n // 10, replace=False))
+    msm_vector = MsmVector()
+    msm_vector.add(scored_formula_is, rng.rand(len(scored_formula_is)) ** 3)
+    msm_obj = msm_vector.save(ctx.ibm_cos, ctx.config['storage']['output_bucket'], 'tmp/msm.msgpack')
+    return {'run': lambda: calculate_fdrs(ctx.pw, ctx.config['storage']['db_bucket'], ctx.input_data,
+                                          ctx.input_db, msm_obj),
+            'items': ctx.upload_mol_db() * len(ctx.input_db['adducts']) * len(ctx.input_db['modifiers'])}
+
+
+@benchmark('run_fdr_ranking')
+def bench_run_fdr_ranking(ctx):
+    from annotation_pipeline.fdr import run_fdr_ranking
+    rng = np.random.RandomState(ctx.params['seed'])
+    mols_n = ctx.params['mols_n'] * 10
+    target_msm = rng.rand(mols_n) ** 3
+    decoy_msms = [rng.rand(mols_n) ** 4 for _ in range(ctx.input_data['num_decoys'])]
+    return {'run': lambda: run_fdr_ranking(target_msm, decoy_msms),
+            'items': mols_n}
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=str(Path(__file__).parent)).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(ctx, names=None, repeats=3):
+    """ Runs the benchmarks (all by default) `repeats` times each and returns the results as a JSON-serializable dict
+    """
+    results = OrderedDict()
+    for name in names or BENCHMARKS:
+        logger.info(f'Benchmark {name}: preparing inputs')
+        bench = BENCHMARKS[name](ctx)
+        runs_s = []
+        for _ in range(repeats):
+            if 'setup' in bench:
+                bench['setup']()
+            start = time.perf_counter()
+            bench['run']()
+            runs_s.append(time.perf_counter() - start)
+        results[name] = OrderedDict([('runs_s', runs_s),
+                                     ('min_s', min(runs_s)),
+                                     ('median_s', float(np.median(runs_s))),
+                                     ('items', bench['items']),
+                                     ('items_per_s', bench['items'] / min(runs_s) if min(runs_s) > 0 else None)])
+        logger.info(f'Benchmark {name}: {min(runs_s):.3f}s min, {np.median(runs_s):.3f}s median')
+
+    return OrderedDict([('created', datetime.now().isoformat()),
+                        ('commit', _git_commit()),
+                        ('python', platform.python_version()),
+                        ('numpy', np.__version__),
+                        ('pandas', pd.__version__),
+                        ('params', ctx.params),
+                        ('repeats', repeats),
+                        ('benchmarks', results)])
+
+
+def compare_results(baseline, current):
+    """ Returns the ratio of the current to the baseline min time of every benchmark present in both results """
+    return OrderedDict((name, result['min_s'] / baseline['benchmarks'][name]['min_s'])
+                       for name, result in current['benchmarks'].items()
+                       if name in baseline['benchmarks'] and baseline['benchmarks'][name]['min_s'] > 0)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,64 @@
+import pickle
+
+from annotation_pipeline.utils import logger, read_object_with_retry, read_manifest, write_manifest
+
+MANIFEST_NAME = 'manifest.json'
+# Increased whenever the outputs recorded by any stage change, so that manifests of older versions are ignored
+MANIFEST_VERSION = 2
+
+
+class RunCheckpoint(object):
+    """ Manifest of the outputs of every completed stage of a pipeline run, stored in COS as `{prefix}/manifest.json`.
+
+    Every stage is recorded with a fingerprint of its inputs and the outputs that the following stages need,
+    so that a rerun can restore stages whose fingerprint hasn't changed instead of running them again.
+    Outputs that don't fit in the manifest are stored as pickled objects next to it.
+
+    Args
+    -----
+    ibm_cos : ibm_boto3.Client
+    bucket : str
+    prefix : str
+    stages : list[str]
+        names of the stages, in the order they run
+    """
+
+    def __init__(self, ibm_cos, bucket, prefix, stages):
+        self._ibm_cos = ibm_cos
+        self._bucket = bucket
+        self.prefix = prefix
+        self.stages = stages
+        self._manifest = None
+
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            manifest = read_manifest(self._ibm_cos, self._bucket, f'{self.prefix}/{MANIFEST_NAME}')
+            if manifest is None or manifest.get('version') != MANIFEST_VERSION:
+                manifest = {'version': MANIFEST_VERSION, 'stages': {}}
+            self._manifest = manifest
+        return self._manifest
+
+    def get(self, stage, fingerprint):
+        """ Returns the outputs of `stage` if it completed with the same fingerprint, otherwise None """
+        record = self.manifest['stages'].get(stage)
+        if record is None or record['fingerprint'] != fingerprint:
+            return None
+        return record['outputs']
+
+    def save(self, stage, fingerprint, outputs):
+        """ Records the outputs of `stage` and invalidates all the stages after it, as their inputs have changed """
+        stages = self.manifest['stages']
+        for later_stage in self.stages[self.stages.index(stage) + 1:]:
+            stages.pop(later_stage, None)
+        stages[stage] = {'fingerprint': fingerprint, 'outputs': outputs}
+        write_manifest(self._ibm_cos, self._bucket, f'{self.prefix}/{MANIFEST_NAME}', self.manifest)
+        logger.info(f'Saved checkpoint of stage {stage}')
+
+    def put_object(self, name, obj):
+        key = f'{self.prefix}/{name}.pickle'
+        self._ibm_cos.put_object(Bucket=self._bucket, Key=key, Body=pickle.dumps(obj))
+        return key
+
+    def get_object(self, key):
+        return pickle.loads(read_object_with_retry(self._ibm_cos, self._bucket, key))
@@ -0,0 +1,139 @@
+import hashlib
+import time
+from pathlib import Path
+
+import numpy as np
+
+from annotation_pipeline.segment import spectra_dtypes, spectra_peak_bytes
+from annotation_pipeline.segment_format import MAGIC, INDEX_STEP
+from annotation_pipeline.utils import logger, list_prefixes, clean_from_cos, content_hash, read_manifest, write_manifest
+
+FINGERPRINT_BLOCK_SIZE = 1024 ** 2
+FINGERPRINT_BLOCKS_N = 64
+MANIFEST_NAME = 'manifest.json'
+# Segments of runs that failed before storing all of them are kept this long, so that the runs can be resumed
+INCOMPLETE_MAX_AGE_DAYS = 1
+
+
+def dataset_fingerprint(imzml_path):
+    """ Content hash of a dataset. The imzML file, which includes the UUID and usually a checksum of the ibd file,
+    is hashed in full. The ibd file can be too large for that, so only its size and `FINGERPRINT_BLOCKS_N` evenly
+    spaced blocks are hashed, which covers the whole file if it is smaller than that many blocks.
+    """
+    m = hashlib.md5()
+    with open(imzml_path, 'rb') as f:
+        for block in iter(lambda: f.read(FINGERPRINT_BLOCK_SIZE), b''):
+            m.update(block)
+
+    ibd_path = Path(imzml_path).with_suffix('.ibd')
+    if ibd_path.exists():
+        size = ibd_path.stat().st_size
+        m.update(str(size).encode('utf-8'))
+        blocks_n = min(FINGERPRINT_BLOCKS_N, -(-size // FINGERPRINT_BLOCK_SIZE))
+        with open(ibd_path, 'rb') as f:
+            for block_i in range(blocks_n):
+                f.seek(max(size - FINGERPRINT_BLOCK_SIZE, 0) * block_i // max(blocks_n - 1, 1))
+                m.update(f.read(FINGERPRINT_BLOCK_SIZE))
+    return m.hexdigest()
+
+
+def get_ds_segments_key(ds_fingerprint, ds_segm_size_mb, mz_precision):
+    """ Cache key of the segments of a dataset, which changes with anything that changes their contents or format """
+    dtypes = [(name, np.dtype(dtype).str) for name, dtype in spectra_dtypes(mz_precision).items()]
+    return content_hash(ds_fingerprint, ds_segm_size_mb, dtypes, MAGIC.decode('ascii'), INDEX_STEP)
+
+
+class DatasetSegmentsCache(object):
+    """ Dataset segments stored under `{prefix}/{key}/`, where `key` comes from `get_ds_segments_key`, so that
+    annotating the same dataset again doesn't need to parse and segment it. Each cached dataset has a manifest
+    with its size and usage times. It is created by `start` before any segments are stored, and only marked as
+    complete with the segment bounds and lengths by `put`, once all of them are stored. Manifests without the
+    `complete` flag were written by older versions, which only wrote them once all segments were stored.
+
+    Cached datasets are evicted when they haven't been used for `max_age_days`, and the least recently used ones
+    are evicted while the cache holds more than `max_size_gb`. Incomplete datasets, left by runs that failed
+    before storing all of their segments, are evicted after `INCOMPLETE_MAX_AGE_DAYS`.
+
+    Args
+    -----
+    ibm_cos : ibm_boto3.Client
+    bucket : str
+    prefix : str
+    max_age_days : float
+    max_size_gb : float
+    """
+
+    def __init__(self, ibm_cos, bucket, prefix, max_age_days=30, max_size_gb=100):
+        self._ibm_cos = ibm_cos
+        self._bucket = bucket
+        self.prefix = prefix
+        self.max_age_days = max_age_days
+        self.max_size_gb = max_size_gb
+
+    def segments_prefix(self, key):
+        return f'{self.prefix}/{key}'
+
+    def _manifest_key(self, key):
+        return f'{self.segments_prefix(key)}/{MANIFEST_NAME}'
+
+    def get(self, key):
+        """ Returns the manifest of the cached dataset if all of its segments are stored, otherwise None.
+        A cached dataset that is found is marked as recently used, and old cached datasets are evicted.
+        """
+        manifest = read_manifest(self._ibm_cos, self._bucket, self._manifest_key(key))
+        if manifest is None or not manifest.get('complete', True):
+            return None
+
+        manifest['last_used'] = time.time()
+        write_manifest(self._ibm_cos, self._bucket, self._manifest_key(key), manifest)
+        self.evict(keep_key=key)
+        return manifest
+
+    def start(self, key):
+        """ Records that segments are going to be stored under `segments_prefix(key)`, so that they are evicted
+        even if `put` is never called
+        """
+        now = time.time()
+        manifest = {'complete': False, 'size_mb': 0, 'created': now, 'last_used': now}
+        write_manifest(self._ibm_cos, self._bucket, self._manifest_key(key), manifest)
+
+    def put(self, key, ds_segments_bounds, ds_segms_len, mz_precision):
+        """ Records the segments stored under `segments_prefix(key)` and evicts old cached datasets """
+        now = time.time()
+        manifest = {'complete': True,
+                    'ds_segments_bounds': np.asarray(ds_segments_bounds).tolist(),
+                    'ds_segm_n': len(ds_segms_len),
+                    'ds_segms_len': [int(segm_len) for segm_len in ds_segms_len],
+                    'size_mb': sum(ds_segms_len) * spectra_peak_bytes(mz_precision) / 1024 ** 2,
+                    'created': now,
+                    'last_used': now}
+        write_manifest(self._ibm_cos, self._bucket, self._manifest_key(key), manifest)
+        self.evict(keep_key=key)
+
+    def evict(self, keep_key=None):
+        # Only the manifests are read, the segments of each cached dataset are not listed
+        entries = []
+        for segments_prefix in list_prefixes(self._bucket, f'{self.prefix}/', self._ibm_cos):
+            key = segments_prefix[len(self.prefix) + 1:-1]
+            manifest = read_manifest(self._ibm_cos, self._bucket, self._manifest_key(key))
+            if manifest is None:
+                # Left by an interrupted eviction, which removes the manifest first
+                manifest = {'complete': False, 'size_mb': 0, 'last_used': 0}
+            entries.append((manifest['last_used'], manifest['size_mb'], manifest.get('complete', True), key))
+
+        # Least recently used first
+        entries.sort()
+        now = time.time()
+        total_size_mb = sum(size_mb for _, size_mb, _, _ in entries)
+        for last_used, size_mb, complete, key in entries:
+            if key == keep_key:
+                continue
+            max_age_days = self.max_age_days if complete else min(self.max_age_days, INCOMPLETE_MAX_AGE_DAYS)
+            too_old = now - last_used > max_age_days * 24 * 3600
+            if too_old or (complete and total_size_mb > self.max_size_gb * 1024):
+                logger.info(f'Evicting {"" if complete else "incomplete "}cached dataset segments {key} '
+                            f'({size_mb:.1f} MB)')
+                # The manifest is removed first, so that the dataset is never found with missing segments
+                self._ibm_cos.delete_object(Bucket=self._bucket, Key=self._manifest_key(key))
+                clean_from_cos(None, self._bucket, f'{self.segments_prefix(key)}/', self._ibm_cos)
+                total_size_mb -= size_mb
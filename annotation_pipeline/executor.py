@@ -0,0 +1,501 @@
+import inspect
+import multiprocessing
+import os
+import pickle
+import time
+import traceback
+import uuid
+from collections import deque
+from concurrent.futures import CancelledError
+from multiprocessing import connection
+
+import numpy as np
+
+from annotation_pipeline.tracing import TracingExecutor
+from annotation_pipeline.utils import logger, get_ibm_cos_client, list_keys, clean_from_cos
+
+INJECTED_ARGS = ('obj', 'id', 'ibm_cos', 'internal_storage')
+# `return_when` values of the executors' `wait`, the same as in `pywren_ibm_cloud.wait`
+ALL_COMPLETED = 1
+ANY_COMPLETED = 2
+ALWAYS = 3
+
+
+def get_executor(config, runtime_memory=None):
+    """ Returns an executor that honours the `pywren.ibm_cf_executor` map/get_result contract.
+    The backend is selected by the optional `executor` section of the config:
+
+        "executor": {"type": "local", "workers": 32}
+
+    Any other type (or a missing section) selects IBM Cloud Functions through PyWren.
+    If `trace_dir` is set, every call is traced and the traces are saved there (see `TracingExecutor`).
+    """
+    executor_config = config.get('executor', {})
+    if executor_config.get('type', 'ibm_cf') == 'local':
+        executor = LocalExecutor(config,
+                                 workers=executor_config.get('workers'),
+                                 total_memory_mb=executor_config.get('total_memory_mb'),
+                                 runtime_memory=runtime_memory)
+    else:
+        import pywren_ibm_cloud as pywren  # Import lazily so that local runs don't require PyWren to be configured
+        if runtime_memory:
+            executor = pywren.ibm_cf_executor(config=config, runtime_memory=runtime_memory)
+        else:
+            executor = pywren.ibm_cf_executor(config=config)
+
+    if executor_config.get('trace_dir'):
+        executor = TracingExecutor(executor, executor_config['trace_dir'])
+    return executor
+
+
+class MemoryLimitExceeded(MemoryError):
+    """ Raised by `LocalExecutor` for a call that was killed because it exceeded its runtime memory """
+
+
+def is_memory_error(ex):
+    """ Whether a call failed because it ran out of memory, either killed by its executor for exceeding its
+    runtime memory or refusing to continue because it wasn't given enough memory. All of these raise `MemoryError`:
+    `MemoryLimitExceeded` locally and `MemoryError('HANDLER', ...)` in PyWren's handler when a call is killed.
+    Other exceptions aren't retried, even if their message mentions memory.
+    """
+    return isinstance(ex, MemoryError)
+
+
+def _cancel(future):
+    try:
+        future.cancel()
+    except NotImplementedError:
+        # PyWren can't cancel dispatched calls, so they run to completion and their results are ignored
+        pass
+
+
+def _check_completed(pw, futures, return_when):
+    """ Checks the calls of `futures` like the executor's `wait`. PyWren's `wait` stops its invoker when it returns,
+    which drops the calls it hasn't invoked yet, so PyWren futures are checked in its storage directly instead.
+    """
+    internal_storage = getattr(pw, 'internal_storage', None)
+    if internal_storage is None:
+        return pw.wait(futures, throw_except=False, return_when=return_when)
+    from pywren_ibm_cloud.wait import wait_storage  # Import lazily, as in get_executor
+    return wait_storage(futures, internal_storage, throw_except=False, return_when=return_when)
+
+
+def iter_completed(pw, futures, resubmit=None, slowdown=3.0, min_done_fraction=0.5, poll_interval=1.0):
+    """ Yields `(i, future)` for the call of every future once it's done, successfully or not.
+
+    PyWren's `get_result` also stops its invoker, so that calls that haven't been invoked yet would never run if
+    the results of the yielded futures were collected while any of them were still waiting for a worker.
+    Finished calls are therefore only yielded once every call has started, or finished, and are yielded as soon as
+    they finish after that. Calls are checked without stopping the invoker (see `_check_completed`).
+
+    If `resubmit` is given, once `min_done_fraction` of the calls are done, any call that has been running for
+    `slowdown` times longer than the median execution time of the finished calls is speculatively submitted again
+    with `resubmit(i)`, which has to return the future of the new copy. Only the copy that finishes first is yielded
+    and the others are cancelled if the executor supports it, so the mapped function has to be idempotent.
+    Calls are timed from when they were first seen running.
+
+    Args
+    -----
+    pw : pywren.ibm_cf_executor
+    futures : list
+    resubmit : Callable[[int], future]
+    slowdown : float
+    min_done_fraction : float
+    poll_interval : float
+        seconds between checks, while finished calls are held back or stragglers can be resubmitted
+    """
+    copies = {i: [future] for i, future in enumerate(futures)}
+    call_is = {id(future): i for i, future in enumerate(futures)}
+    # Only the first time a call is seen running is recorded, as PyWren resets it every time it checks the call
+    start_times = {}
+    completed = []
+    done_n = 0
+    durations = []
+    while copies or completed:
+        for future in [future for call_copies in copies.values() for future in call_copies]:
+            start_time = (getattr(future, '_call_status', None) or {}).get('start_time')
+            if start_time is not None:
+                start_times.setdefault(id(future), start_time)
+        all_started = all(any(id(future) in start_times for future in call_copies) for call_copies in copies.values())
+
+        if all_started:
+            for i, future in completed:
+                yield i, future
+            completed = []
+        if not copies:
+            break
+
+        speculate = (resubmit is not None and all_started and durations
+                     and done_n >= min_done_fraction * len(futures))
+        # While finished calls are held back or stragglers can be resubmitted, calls are checked periodically
+        # instead of waiting for any call to finish
+        polling = speculate or bool(completed)
+        done, _ = _check_completed(pw, [future for call_copies in copies.values() for future in call_copies],
+                                   ALWAYS if polling else ANY_COMPLETED)
+        for future in done:
+            i = call_is[id(future)]
+            if i not in copies:
+                # Another copy of the same call finished in the same check
+                continue
+            for other_future in copies.pop(i):
+                if other_future is not future:
+                    _cancel(other_future)
+            done_n += 1
+            exec_time = (getattr(future, '_call_status', None) or {}).get('exec_time')
+            if exec_time is not None:
+                durations.append(exec_time)
+            completed.append((i, future))
+
+        if speculate and copies:
+            now = time.time()
+            median_duration = np.median(durations)
+            for i, call_copies in copies.items():
+                start_time = start_times.get(id(call_copies[0]))
+                if len(call_copies) == 1 and start_time is not None and now - start_time > slowdown * median_duration:
+                    logger.info(f'Call {i} has been running for {now - start_time:.1f}s, '
+                                f'{slowdown} times longer than the median of {median_duration:.1f}s, '
+                                f'submitting a speculative copy')
+                    future = resubmit(i)
+                    call_is[id(future)] = i
+                    call_copies.append(future)
+        if polling:
+            time.sleep(poll_interval)
+
+
+class CloudObject(object):
+    def __init__(self, bucket, key):
+        self.bucket = bucket
+        self.key = key
+
+    def __repr__(self):
+        return f'CloudObject({self.bucket}/{self.key})'
+
+
+class CloudObjectStream(CloudObject):
+    """ Equivalent of the `obj` argument PyWren passes to functions mapped over `bucket/prefix/` iterdata.
+    The object body is only requested once `data_stream` is accessed.
+    """
+
+    def __init__(self, bucket, key, ibm_cos):
+        super().__init__(bucket, key)
+        self._ibm_cos = ibm_cos
+        self._data_stream = None
+
+    @property
+    def data_stream(self):
+        if self._data_stream is None:
+            self._data_stream = self._ibm_cos.get_object(Bucket=self.bucket, Key=self.key)['Body']
+        return self._data_stream
+
+
+class LocalInternalStorage(object):
+    """ Minimal equivalent of PyWren's `internal_storage` that keeps temporary objects under an executor prefix """
+
+    def __init__(self, ibm_cos, bucket, prefix):
+        self._ibm_cos = ibm_cos
+        self._bucket = bucket
+        self._prefix = prefix
+
+    def put_object(self, body, bucket=None, key=None):
+        bucket = bucket or self._bucket
+        key = key or f'{self._prefix}/{uuid.uuid4().hex}'
+        self._ibm_cos.put_object(Bucket=bucket, Key=key, Body=body)
+        return CloudObject(bucket, key)
+
+    def get_object(self, cloud_obj):
+        return self._ibm_cos.get_object(Bucket=cloud_obj.bucket, Key=cloud_obj.key)['Body'].read()
+
+
+class LocalFuture(object):
+    """ Future of a `LocalExecutor` call. As with PyWren's `ResponseFuture`, `done` is a property and the statistics
+    of a finished call are in `_call_status`. Calls only progress while the executor is used, e.g. in `wait`.
+    """
+
+    def __init__(self, executor, function_name, call_id, runtime_memory):
+        self.function_name = function_name
+        self.call_id = call_id
+        self.runtime_memory = runtime_memory
+        self.error = False
+        self.cancelled = False
+        self._executor = executor
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._read = False
+        self._call_status = {}
+
+    @property
+    def done(self):
+        return self._done
+
+    def cancel(self):
+        """ Cancels the call if it hasn't started yet, otherwise kills its process """
+        self.cancelled = True
+        self._executor._cancel_call(self)
+
+    def result(self, throw_except=True):
+        self._executor.wait([self], throw_except=False)
+        if self._exception is not None:
+            if throw_except:
+                raise self._exception
+            return None
+        return self._result
+
+    def _set_result(self, result, call_status):
+        self._result = result
+        self._call_status = call_status
+        self._done = True
+
+    def _set_exception(self, exception):
+        self._exception = exception
+        self.error = True
+        self._done = True
+
+
+def _process_private_memory_mb(pid):
+    """ Memory attributable to the task process only, i.e. excluding copy-on-write pages shared with the driver """
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            private_kb = sum(int(line.split()[1]) for line in f if line.startswith('Private_'))
+        return private_kb / 1024
+    except (OSError, ValueError):
+        try:
+            with open(f'/proc/{pid}/statm') as f:
+                resident_pages = int(f.read().split()[1])
+            return resident_pages * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+        except (OSError, ValueError):
+            return 0
+
+
+def _total_memory_mb():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024 ** 2
+    except (ValueError, OSError):
+        return None
+
+
+class LocalExecutor(object):
+    """ Drop-in replacement for `pywren.ibm_cf_executor` that runs every call in a forked process on this machine.
+
+    Each call gets its own process, so nested functions don't need to be serialized and a call that exceeds
+    `runtime_memory` is killed without affecting the other calls, similarly to a cloud function.
+    Calls of all maps share a single queue, so the number of concurrent calls is limited by `workers` and
+    the sum of their `runtime_memory` by the machine's memory, even when several maps run at the same time.
+
+    The executor doesn't start any threads: calls are started, monitored and collected by the thread that calls
+    `map`, `wait` or `get_result`. Processes are therefore only forked while no other thread of the executor could
+    hold a lock, such as the logging lock, that the child would inherit locked. Like PyWren's executor,
+    it must not be used by several threads at the same time.
+    """
+
+    memory_check_interval = 0.05
+
+    def __init__(self, config, workers=None, total_memory_mb=None, runtime_memory=None):
+        self.config = config
+        self.workers = workers or os.cpu_count()
+        self.total_memory_mb = total_memory_mb or _total_memory_mb()
+        self.runtime_memory = runtime_memory or 2048
+        self.executor_id = uuid.uuid4().hex[:8]
+        self.storage_bucket = config.get('pywren', {}).get('storage_bucket') or config['storage']['output_bucket']
+        self.storage_prefix = f'local_executor/{self.executor_id}'
+        self._ctx = multiprocessing.get_context('fork')
+        self._ibm_cos = None
+        self._map_n = 0
+        self._futures = []
+        # Calls waiting for a worker, in submission order, and the process, pipe and peak memory of running calls
+        self._queue = deque()
+        self._running = {}
+        self._reserved_memory_mb = 0
+
+    @property
+    def ibm_cos(self):
+        if self._ibm_cos is None:
+            self._ibm_cos = get_ibm_cos_client(self.config)
+        return self._ibm_cos
+
+    def _create_calls(self, map_function, map_iterdata):
+        """ Maps iterdata items to keyword arguments in the same way PyWren does """
+        params = list(inspect.signature(map_function).parameters)
+        data_params = [param for param in params if param not in INJECTED_ARGS]
+
+        if 'obj' in params:
+            if isinstance(map_iterdata, str):
+                map_iterdata = [map_iterdata]
+            calls = []
+            for path in map_iterdata:
+                bucket, prefix = path.split('/', 1)
+                if not prefix or prefix.endswith('/'):
+                    keys = list_keys(bucket, prefix, self.ibm_cos)
+                else:
+                    keys = [prefix]
+                calls.extend({'obj': (bucket, key)} for key in keys)
+            return params, calls
+
+        calls = []
+        for item in map_iterdata:
+            if isinstance(item, dict):
+                calls.append(dict(item))
+            elif isinstance(item, (list, tuple)):
+                calls.append(dict(zip(data_params, item)))
+            else:
+                calls.append({data_params[0]: item})
+        return params, calls
+
+    def _run_call(self, map_function, params, call_id, kwargs, conn):
+        """ Entry point of the forked process """
+        start = time.time()
+        try:
+            ibm_cos = get_ibm_cos_client(self.config)
+            if 'obj' in params:
+                kwargs['obj'] = CloudObjectStream(*kwargs['obj'], ibm_cos)
+            if 'id' in params:
+                kwargs['id'] = call_id
+            if 'ibm_cos' in params:
+                kwargs['ibm_cos'] = ibm_cos
+            if 'internal_storage' in params:
+                kwargs['internal_storage'] = LocalInternalStorage(ibm_cos, self.storage_bucket, self.storage_prefix)
+            cos_stats_before = dict(getattr(type(ibm_cos), 'process_stats', {}))
+            result = map_function(**kwargs)
+            cos_stats = {stat: n - cos_stats_before[stat]
+                         for stat, n in getattr(type(ibm_cos), 'process_stats', {}).items()}
+            end = time.time()
+            message = ('ok', result, {'exec_time': end - start, 'start_time': start, 'end_time': end,
+                                      'cos_stats': cos_stats})
+        except Exception as ex:
+            message = ('error', ex, traceback.format_exc())
+        try:
+            conn.send(message)
+        except (pickle.PicklingError, TypeError, AttributeError) as ex:
+            conn.send(('error', RuntimeError(f'Unable to return result of call {call_id}: {ex}'), ''))
+        finally:
+            conn.close()
+
+    def _can_start(self, future):
+        # A call that needs more than the total memory can still run, but only on its own
+        return len(self._running) < self.workers and not (
+            self.total_memory_mb and self._reserved_memory_mb
+            and self._reserved_memory_mb + future.runtime_memory > self.total_memory_mb)
+
+    def _start_queued(self):
+        # Calls start in submission order, so that calls needing a lot of memory aren't starved by smaller ones
+        while self._queue and self._can_start(self._queue[0][0]):
+            future, map_function, params, kwargs = self._queue.popleft()
+            recv_conn, send_conn = self._ctx.Pipe(duplex=False)
+            process = self._ctx.Process(target=self._run_call,
+                                        args=(map_function, params, future.call_id, kwargs, send_conn), daemon=True)
+            process.start()
+            send_conn.close()
+            # As in PyWren, the status of a running call only has its start time
+            future._call_status = {'start_time': time.time()}
+            self._reserved_memory_mb += future.runtime_memory
+            self._running[future] = [process, recv_conn, 0]
+
+    def _finish(self, future, exception=None, result=None, call_status=None):
+        process, recv_conn, peak_memory_mb = self._running.pop(future)
+        if exception is not None:
+            process.kill()
+        recv_conn.close()
+        process.join()
+        self._reserved_memory_mb -= future.runtime_memory
+        if exception is not None:
+            future._set_exception(exception)
+        else:
+            future._set_result(result, dict(call_status, peak_memory_mb=peak_memory_mb))
+
+    def _check_running(self, future):
+        """ Collects the result of a running call if it's finished, otherwise kills it if it exceeds its memory """
+        process, recv_conn, peak_memory_mb = self._running[future]
+        call_name = f'Call {future.call_id} of {future.function_name}'
+        if recv_conn.poll():
+            try:
+                status, result, extra = recv_conn.recv()
+            except EOFError:
+                # The pipe is closed without a message when the process dies
+                process.join()
+                return self._finish(future, RuntimeError(f'{call_name} exited unexpectedly '
+                                                         f'with code {process.exitcode}'))
+            if status == 'error':
+                logger.error(f'{call_name} failed:\n{extra}')
+                return self._finish(future, result)
+            return self._finish(future, result=result, call_status=extra)
+
+        peak_memory_mb = max(peak_memory_mb, _process_private_memory_mb(process.pid))
+        self._running[future][2] = peak_memory_mb
+        if peak_memory_mb > future.runtime_memory:
+            self._finish(future, MemoryLimitExceeded(f'{call_name} exceeded its memory limit '
+                                                     f'of {future.runtime_memory}MB'))
+
+    def _poll(self, timeout=0):
+        """ Starts queued calls while there are free workers and memory, then waits up to `timeout` seconds
+        for any running call to finish and collects the calls that did
+        """
+        self._start_queued()
+        if self._running:
+            if timeout:
+                connection.wait([recv_conn for _, recv_conn, _ in self._running.values()], timeout)
+            for future in list(self._running):
+                self._check_running(future)
+            self._start_queued()
+
+    def _cancel_call(self, future):
+        if future.done:
+            return
+        if future in self._running:
+            self._finish(future, CancelledError(f'Call {future.call_id} of {future.function_name} was cancelled'))
+            self._start_queued()
+        else:
+            self._queue = deque(call for call in self._queue if call[0] is not future)
+            future._set_exception(CancelledError(f'Call {future.call_id} of {future.function_name} was cancelled'))
+
+    def map(self, map_function, map_iterdata, runtime_memory=None):
+        runtime_memory = runtime_memory or self.runtime_memory
+        params, calls = self._create_calls(map_function, map_iterdata)
+        self._map_n += 1
+        logger.info(f'Local executor {self.executor_id} - map {self._map_n}: '
+                    f'{len(calls)} calls of {map_function.__name__} with {runtime_memory}MB')
+
+        futures = []
+        for call_id, kwargs in enumerate(calls):
+            future = LocalFuture(self, map_function.__name__, call_id, runtime_memory)
+            self._queue.append((future, map_function, params, kwargs))
+            futures.append(future)
+        self._futures.extend(futures)
+        self._poll()
+        return futures
+
+    def wait(self, fs, throw_except=True, return_when=ALL_COMPLETED):
+        """ Waits until all or any of the calls of `fs` are done, or only checks them with `ALWAYS`
+
+        Returns
+        -----
+            tuple[list[LocalFuture], list[LocalFuture]]: done and not done futures
+        """
+        fs = [fs] if isinstance(fs, LocalFuture) else list(fs)
+        self._poll()
+        while return_when != ALWAYS:
+            done_n = sum(future.done for future in fs)
+            if done_n == len(fs) or (return_when == ANY_COMPLETED and done_n):
+                break
+            self._poll(self.memory_check_interval)
+        done = [future for future in fs if future.done]
+        if throw_except:
+            for future in done:
+                future.result()
+        return done, [future for future in fs if not future.done]
+
+    def get_result(self, futures=None, throw_except=True):
+        """ Waits for all calls of `futures` and returns their results. As with PyWren after a map, the results are
+        returned as a list even for a single future, and without `futures`, the results of all calls whose results
+        haven't been returned yet are returned.
+        """
+        if futures is None:
+            futures = [future for future in self._futures if not future._read]
+            for future in futures:
+                future._read = True
+        elif isinstance(futures, LocalFuture):
+            futures = [futures]
+        self.wait(futures, throw_except=throw_except)
+        return [future.result(throw_except=throw_except) for future in futures]
+
+    def clean(self):
+        clean_from_cos(self.config, self.storage_bucket, self.storage_prefix, self.ibm_cos)
@@ -1,135 +1,161 @@
-from itertools import product, repeat
+from itertools import product
 import pickle
 import numpy as np
 import pandas as pd
 import msgpack_numpy as msgpack
 
-from annotation_pipeline.formula_parser import safe_generate_ion_formula
-from annotation_pipeline.molecular_db import DECOY_ADDUCTS
-from annotation_pipeline.utils import append_pywren_stats, read_object_with_retry, list_keys
+from annotation_pipeline.executor import CloudObject
+from annotation_pipeline.molecular_db import DECOY_ADDUCTS, get_formula_index_key
+from annotation_pipeline.tracing import span
+from annotation_pipeline.utils import append_pywren_stats, read_object_with_retry
 
 
-def _get_random_adduct_set(size, adducts, offset):
+def _get_random_adduct_idxs(size, adducts_n, offset):
     r = np.random.RandomState(123)
-    idxs = (r.random_integers(0, len(adducts), size) + offset) % len(adducts)
-    return np.array(adducts)[idxs]
+    # The upper bound is inclusive, as in the deprecated `random_integers` this replaced, so that decoys don't change
+    return (r.randint(0, adducts_n + 1, size) + offset) % adducts_n
 
 
 def msgpack_load_text(stream):
     return msgpack.load(stream, encoding='utf-8')
 
 
-def build_fdr_rankings(pw, bucket, input_data, input_db, formula_scores_df):
-
-    def build_ranking(group_i, ranking_i, database, modifier, adduct, id, ibm_cos):
-        print("Building ranking...")
-        print(f'job_i: {id}')
-        print(f'ranking_i: {ranking_i}')
-        print(f'database: {database}')
-        print(f'modifier: {modifier}')
-        print(f'adduct: {adduct}')
+class MsmVector(object):
+    """ MSM of every formula, indexed by formula_i, with NaN for formulas that weren't scored.
+    The scores of each centroids segment are merged into it as soon as the segment is annotated, so that the driver
+    doesn't need to keep the metrics of all segments, and FDR rankings read it from COS with a single request.
+    """
+
+    def __init__(self):
+        self.msm = np.full(0, np.nan)
+
+    def add(self, formula_is, msm):
+        formula_is = np.asarray(formula_is, dtype=np.int64)
+        if len(formula_is) and formula_is.max() >= len(self.msm):
+            grown = np.full(max(formula_is.max() + 1, 2 * len(self.msm)), np.nan)
+            grown[:len(self.msm)] = self.msm
+            self.msm = grown
+        self.msm[formula_is] = msm
+
+    @property
+    def scored_n(self):
+        return int((~np.isnan(self.msm)).sum())
+
+    def save(self, ibm_cos, bucket, key):
+        ibm_cos.put_object(Bucket=bucket, Key=key, Body=msgpack.dumps(self.msm))
+        return CloudObject(bucket, key)
+
+
+def lookup_msm(msm, formula_is):
+    """ Returns the MSM of `formula_is` in an MSM vector, with NaN for unscored and invalid (negative) formula_is """
+    found = (formula_is >= 0) & (formula_is < len(msm))
+    result = np.full(len(formula_is), np.nan)
+    result[found] = msm[formula_is[found]]
+    return result
+
+
+def run_fdr_ranking(target_msm, decoy_msms):
+    """ Calculates the FDR of every target score against each decoy ranking and returns the median across decoys
+
+    The FDR of a score is the number of decoys divided by the number of targets that score at least as high, so
+    tied scores, such as those of molecules that share a formula, all count as hits of each other and get the same
+    FDR. The original implementation counted the rows above each target in a sort by score instead, so the FDRs of
+    tied targets depended on their order and its median could differ slightly for formulas shared by molecules.
+
+    Args
+    -----
+    target_msm : ndarray
+    decoy_msms : list[ndarray]
+
+    Returns
+    -----
+        ndarray: FDR of every target score, in the same order as `target_msm`
+    """
+    by_msm = np.argsort(target_msm, kind='mergesort')
+    sorted_target_msm = target_msm[by_msm]
+    # number of targets and decoys scoring at least as high as each target
+    target_hits = len(sorted_target_msm) - np.searchsorted(sorted_target_msm, sorted_target_msm, side='left')
+
+    fdrs = np.empty((len(decoy_msms), len(sorted_target_msm)))
+    for decoy_i, decoy_msm in enumerate(decoy_msms):
+        sorted_decoy_msm = np.sort(decoy_msm)
+        decoy_hits = len(sorted_decoy_msm) - np.searchsorted(sorted_decoy_msm, sorted_target_msm, side='left')
+        base_fdr = np.clip(decoy_hits / target_hits, 0, 1)
+        # FDR is made monotonic, so that it never increases with the score
+        fdrs[decoy_i] = np.minimum.accumulate(base_fdr)
+
+    target_fdr = np.empty(len(sorted_target_msm))
+    target_fdr[by_msm] = np.nanmedian(fdrs, axis=0)
+    return target_fdr
+
+
+def calculate_fdrs(pw, bucket, input_data, input_db, msm_obj):
+    """ Calculates the FDR of the targets of every database and modifier
+
+    Args
+    -----
+    pw : executor
+    bucket : str
+        bucket of the databases and formula indices
+    input_data : dict
+    input_db : dict
+    msm_obj : CloudObject
+        MSM vector stored with `MsmVector.save`
+
+    Returns
+    -----
+        pd.DataFrame: FDR, molecule, database, adduct and modifier of every target formula_i
+    """
+
+    def run_group_fdr(database, modifier, ibm_cos):
+        print(f'Calculating FDR of {database} with modifier "{modifier}"')
         # For every unmodified formula in `database`, look up the MSM score for the molecule
         # that it would become after the modifier and adduct are applied
-        mols = pickle.loads(read_object_with_retry(ibm_cos, bucket, database))
-        if adduct is not None:
+        formula_index_key = get_formula_index_key(input_db['formulas_chunks'], database, modifier)
+        with span('download', key=formula_index_key):
+            formula_index = read_object_with_retry(ibm_cos, bucket, formula_index_key, msgpack_load_text)
+            mols = np.array(pickle.loads(read_object_with_retry(ibm_cos, bucket, database)), dtype=object)
+        with span('download', key=msm_obj.key):
+            msm_vector = read_object_with_retry(ibm_cos, msm_obj.bucket, msm_obj.key, msgpack_load_text)
+        adduct_rows = {index_adduct: row for row, index_adduct in reversed(list(enumerate(formula_index['adducts'])))}
+        formula_is = formula_index['formula_is']
+        mols_n = formula_is.shape[1]
+
+        # Decoy rankings use a consistent random adduct for each molecule, chosen so that it doesn't overlap
+        # with other decoy rankings for this molecule.
+        # Specific molecules don't matter in the decoy rankings, only their msm distribution
+        with span('compute', mols=mols_n, decoy_rankings=n_decoy_rankings):
+            decoy_adduct_rows = np.array([adduct_rows[adduct] for adduct in decoy_adducts])
+            decoy_msms = []
+            for ranking_i in range(n_decoy_rankings):
+                rows = decoy_adduct_rows[_get_random_adduct_idxs(mols_n, len(decoy_adducts), ranking_i)]
+                msm = lookup_msm(msm_vector, formula_is[rows, np.arange(mols_n)])
+                decoy_msms.append(msm[~np.isnan(msm)])
+
             # Target rankings use the same adduct for all molecules
-            mol_formulas = list(map(safe_generate_ion_formula, mols, repeat(modifier), repeat(adduct)))
-        else:
-            # Decoy rankings use a consistent random adduct for each molecule, chosen so that it doesn't overlap
-            # with other decoy rankings for this molecule
-            adducts = _get_random_adduct_set(len(mols), decoy_adducts, ranking_i)
-            mol_formulas = list(map(safe_generate_ion_formula, mols, repeat(modifier), adducts))
-
-        formula_to_id = {}
-        keys = list_keys(bucket, f'{input_db["formula_to_id_chunks"]}/', ibm_cos)
-        for key in keys:
-            formula_to_id_chunk = read_object_with_retry(ibm_cos, bucket, key, msgpack_load_text)
-
-            for formula in mol_formulas:
-                if formula_to_id_chunk.get(formula) is not None:
-                    formula_to_id[formula] = formula_to_id_chunk.get(formula)
-
-        formula_is = [formula and formula_to_id.get(formula) for formula in mol_formulas]
-        msm = [formula_i and msm_lookup.get(formula_i) for formula_i in formula_is]
-        if adduct is not None:
-            ranking_df = pd.DataFrame({'mol': mols, 'msm': msm}, index=formula_is)
-            ranking_df = ranking_df[~ranking_df.msm.isna()]
-            key = f'{input_data["fdr_rankings"]}/{group_i}/target{ranking_i}.pickle'
-        else:
-            # Specific molecules don't matter in the decoy rankings, only their msm distribution
-            ranking_df = pd.DataFrame({'msm': msm})
-            ranking_df = ranking_df[~ranking_df.msm.isna()]
-            key = f'{input_data["fdr_rankings"]}/{group_i}/decoy{ranking_i}.pickle'
-
-        ibm_cos.put_object(Bucket=bucket, Key=key, Body=pickle.dumps(ranking_df))
-        return id, key
+            results = []
+            for adduct in input_db['adducts']:
+                target_formula_is = formula_is[adduct_rows[adduct]]
+                msm = lookup_msm(msm_vector, target_formula_is)
+                scored = ~np.isnan(msm)
+                target_df = pd.DataFrame({'formula_i': target_formula_is[scored],
+                                          'fdr': run_fdr_ranking(msm[scored], decoy_msms),
+                                          'mol': mols[scored]})
+                results.append(target_df.drop_duplicates('formula_i')
+                               .set_index('formula_i')
+                               .sort_index()
+                               .assign(database_path=database, adduct=adduct, modifier=modifier))
+
+            return pd.concat(results)
 
     decoy_adducts = sorted(set(DECOY_ADDUCTS).difference(input_db['adducts']))
     n_decoy_rankings = input_data.get('num_decoys', len(decoy_adducts))
-    msm_lookup = formula_scores_df.msm.to_dict() # Ideally this data would stay in COS so it doesn't have to be reuploaded
-
-    # Create a job for each list of molecules to be ranked
-    ranking_jobs = []
-    for group_i, (database, modifier) in enumerate(product(input_db['databases'], input_db['modifiers'])):
-        # Target and decoy rankings are treated differently. Decoy rankings are identified by not having an adduct.
-        ranking_jobs.extend((group_i, ranking_i, database, modifier, adduct)
-                             for ranking_i, adduct in enumerate(input_db['adducts']))
-        ranking_jobs.extend((group_i, ranking_i, database, modifier, None)
-                             for ranking_i in range(n_decoy_rankings))
-
-    memory_capacity_mb = 1536
-    futures = pw.map(build_ranking, ranking_jobs, runtime_memory=memory_capacity_mb)
-    ranking_keys = [key for job_i, key in sorted(pw.get_result(futures))]
-    append_pywren_stats(futures, memory=memory_capacity_mb, plus_objects=len(futures))
-
-    rankings_df = pd.DataFrame(ranking_jobs, columns=['group_i', 'ranking_i', 'database_path', 'modifier', 'adduct'])
-    rankings_df = rankings_df.assign(is_target=~rankings_df.adduct.isnull(), key=ranking_keys)
-
-    return rankings_df
-
-
-def calculate_fdrs(pw, data_bucket, rankings_df):
-
-    def run_ranking(ibm_cos, data_bucket, target_key, decoy_key):
-        target = pickle.loads(read_object_with_retry(ibm_cos, data_bucket, target_key))
-        decoy = pickle.loads(read_object_with_retry(ibm_cos, data_bucket, decoy_key))
-        merged = pd.concat([target.assign(is_target=1), decoy.assign(is_target=0)], sort=False)
-        merged = merged.sort_values('msm', ascending=False)
-        decoy_cumsum = (merged.is_target == False).cumsum()
-        target_cumsum = merged.is_target.cumsum()
-        base_fdr = np.clip(decoy_cumsum / target_cumsum, 0, 1)
-        base_fdr[np.isnan(base_fdr)] = 1
-        target_fdrs = merged.assign(fdr=base_fdr)[lambda df: df.is_target == 1]
-        target_fdrs = target_fdrs.drop('is_target', axis=1)
-        target_fdrs = target_fdrs.sort_values('msm')
-        target_fdrs = target_fdrs.assign(fdr=np.minimum.accumulate(target_fdrs.fdr))
-        target_fdrs = target_fdrs.sort_index()
-        return target_fdrs
-
-    def merge_rankings(ibm_cos, data_bucket, target_row, decoy_keys):
-        print("Merging rankings...")
-        print(target_row)
-        rankings = [run_ranking(ibm_cos, data_bucket, target_row.key, decoy_key) for decoy_key in decoy_keys]
-        mols = (pd.concat(rankings)
-                .rename_axis('formula_i')
-                .reset_index()
-                .groupby('formula_i')
-                .agg({'fdr': np.nanmedian, 'mol': 'first'})
-                .assign(database_path=target_row.database_path,
-                        adduct=target_row.adduct,
-                        modifier=target_row.modifier))
-        return mols
-
-    ranking_jobs = []
-    for group_i, group in rankings_df.groupby('group_i'):
-        target_rows = group[group.is_target]
-        decoy_rows = group[~group.is_target]
-
-        for i, target_row in target_rows.iterrows():
-            ranking_jobs.append([data_bucket, target_row, decoy_rows.key.tolist()])
-
-    memory_capacity_mb = 256
-    futures = pw.map(merge_rankings, ranking_jobs, runtime_memory=memory_capacity_mb)
+
+    # Create a job for each database and modifier, which ranks all its targets against all its decoys
+    groups = list(product(input_db['databases'], input_db['modifiers']))
+
+    memory_capacity_mb = 1024
+    futures = pw.map(run_group_fdr, groups, runtime_memory=memory_capacity_mb)
     results = pw.get_result(futures)
     append_pywren_stats(futures, memory=memory_capacity_mb)
 
@@ -1,9 +1,11 @@
 import re
+import numpy as np
 from collections import Counter
 
 clean_regexp = re.compile(r'[.=]')
 formula_regexp = re.compile(r'([A-Z][a-z]*)([0-9]*)')
 adduct_split_regexp = re.compile(r'([+-]*)([A-Za-z0-9]+)')
+whole_formula_regexp = re.compile(r'(?:[A-Z][a-z]*[0-9]*)+')
 
 
 class ParseFormulaError(Exception):
@@ -16,6 +18,12 @@ def parse_formula(f):
             for (elem, n) in formula_regexp.findall(f)]
 
 
+def is_valid_formula(f, elements):
+    """ Checks that `f` is a plain sum formula that only consists of the given elements """
+    return (whole_formula_regexp.fullmatch(f) is not None
+            and all(elem in elements for elem, _ in parse_formula(f)))
+
+
 def generate_ion_formula(formula, *adducts):
     formula = clean_regexp.sub('', formula)
     adducts = [clean_regexp.sub('', adduct) for adduct in adducts]
@@ -58,3 +66,83 @@ def safe_generate_ion_formula(*parts):
         return generate_ion_formula(*(part for part in parts if part))
     except ParseFormulaError:
         return None
+
+
+def parse_formulas(formulas):
+    """ Parses many formulas into a matrix of element counts, with the same semantics as `generate_ion_formula`
+
+    Args
+    -----
+    formulas : list[str]
+
+    Returns
+    -----
+        tuple[list[str], ndarray]: element alphabet and (n, len(elements)) counts matrix
+    """
+    parsed = [dict(parse_formula(clean_regexp.sub('', formula))) for formula in formulas]
+    elements = sorted(set().union(*parsed))
+    element_cols = {elem: col for col, elem in enumerate(elements)}
+    counts = np.zeros((len(parsed), len(elements)), dtype=np.int64)
+    for row, formula_elements in enumerate(parsed):
+        for elem, n in formula_elements.items():
+            counts[row, element_cols[elem]] = n
+    return elements, counts
+
+
+def _render_formulas(elements, counts):
+    """ Renders rows of element counts as formulas with the elements in the given order """
+    formulas = np.full(counts.shape[0], '', dtype=object)
+    for col, elem in enumerate(elements):
+        col_counts = counts[:, col]
+        labels = np.array(['', elem] + [f'{elem}{n}' for n in range(2, col_counts.max(initial=0) + 1)],
+                          dtype=object)
+        formulas += labels[col_counts]
+    return formulas
+
+
+def safe_generate_ion_formulas(elements, counts, *parts):
+    """ Bulk equivalent of `safe_generate_ion_formula` for formulas parsed with `parse_formulas`
+
+    Args
+    -----
+    elements : list[str]
+    counts : ndarray
+    parts : str
+        modifiers and adducts, empty ones are ignored
+
+    Returns
+    -----
+        list[str]: ion formulas, or None where `safe_generate_ion_formula` would return None
+    """
+    adducts = [clean_regexp.sub('', part) for part in parts if part]
+    signed_deltas = []
+    for adduct in adducts:
+        op, a_formula = adduct_split_regexp.findall(adduct)[0]
+        assert op in ('+','-'), 'Adduct should be prefixed with + or -'
+        signed_deltas.append((op, parse_formula(a_formula)))
+
+    extra_elements = sorted({elem for _, delta in signed_deltas for elem, _ in delta}.difference(elements))
+    elements = list(elements) + extra_elements
+    ion_counts = np.hstack([counts, np.zeros((counts.shape[0], len(extra_elements)), dtype=counts.dtype)])
+    element_cols = {elem: col for col, elem in enumerate(elements)}
+
+    valid = np.ones(counts.shape[0], dtype=bool)
+    for op, delta in signed_deltas:
+        sign = 1 if op == '+' else -1
+        for elem, n in delta:
+            ion_counts[:, element_cols[elem]] += sign * n
+        if op == '-':
+            valid &= (ion_counts >= 0).all(axis=1)
+    valid &= (ion_counts > 0).any(axis=1)
+
+    # Ordered per https://en.wikipedia.org/wiki/Chemical_formula#Hill_system
+    alphabetical_order = sorted(range(len(elements)), key=elements.__getitem__)
+    hill_order = [element_cols[elem] for elem in ('C', 'H') if elem in element_cols]
+    hill_order += [col for col in alphabetical_order if col not in hill_order]
+    has_carbon = ion_counts[:, element_cols['C']] != 0 if 'C' in element_cols else np.zeros(len(valid), dtype=bool)
+
+    ion_formulas = np.full(len(valid), None, dtype=object)
+    for order, mask in [(hill_order, valid & has_carbon), (alphabetical_order, valid & ~has_carbon)]:
+        if mask.any():
+            ion_formulas[mask] = _render_formulas([elements[col] for col in order], ion_counts[mask][:, order])
+    return ion_formulas.tolist()
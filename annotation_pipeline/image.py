@@ -1,21 +1,31 @@
 import pickle
+from pathlib import Path
 import numpy as np
 import pandas as pd
 from scipy.sparse import coo_matrix
+from collections import OrderedDict
 from concurrent.futures import ThreadPoolExecutor
-import msgpack_numpy as msgpack
 
-from annotation_pipeline.utils import ds_dims, get_pixel_indices, read_object_with_retry
-from annotation_pipeline.validate import make_compute_image_metrics, formula_image_metrics
-from annotation_pipeline.segment import ISOTOPIC_PEAK_N
+from annotation_pipeline.executor import CloudObject
+from annotation_pipeline.segment_format import read_segment
+from annotation_pipeline.tracing import span, count_stream
+from annotation_pipeline.utils import ds_dims, get_pixel_indices, read_object_with_retry, merge_sorted_runs
+from annotation_pipeline.validate import make_compute_image_metrics_batch, formula_image_metrics_batch
+from annotation_pipeline.segment import ISOTOPIC_PEAK_N, spectra_dtypes, spectra_peak_bytes
+
+PROCESS_SEGMENT_SAFE_MB = 1024
 
 
 class ImagesManager:
+    """ Collects formula metrics and images, saving the images to `{prefix}/{partition}.pickle` whenever they
+    exceed `max_formula_images_size`. Keys only depend on the prefix and the order in which images are added,
+    so a repeated call with the same inputs overwrites the same objects with the same images.
+    """
     min_memory_allowed = 64 * 1024 ** 2  # 64MB
 
-    def __init__(self, internal_storage, bucket, max_formula_images_size):
+    def __init__(self, ibm_cos, bucket, prefix, max_formula_images_size):
         if max_formula_images_size < self.__class__.min_memory_allowed:
-            raise Exception(f'There isn\'t enough memory to generate images, consider increasing PyWren\'s memory.')
+            raise MemoryError(f'There isn\'t enough memory to generate images, consider increasing PyWren\'s memory.')
 
         self.formula_metrics = {}
         self.formula_images = {}
@@ -23,8 +33,9 @@ class ImagesManager:
 
         self._formula_images_size = 0
         self._max_formula_images_size = max_formula_images_size
-        self._internal_storage = internal_storage
+        self._ibm_cos = ibm_cos
         self._bucket = bucket
+        self._prefix = prefix
         self._partition = 0
 
     def __call__(self, f_i, f_metrics, f_images):
@@ -49,7 +60,11 @@ class ImagesManager:
     def save_images(self):
         if self.formula_images:
             print(f'Saving {len(self.formula_images)} images')
-            cloud_obj = self._internal_storage.put_object(pickle.dumps(self.formula_images), bucket=self._bucket)
+            with span('encode', images=len(self.formula_images)):
+                body = pickle.dumps(self.formula_images)
+            cloud_obj = CloudObject(self._bucket, f'{self._prefix}/{self._partition}.pickle')
+            with span('upload'):
+                self._ibm_cos.put_object(Bucket=cloud_obj.bucket, Key=cloud_obj.key, Body=body)
             self.cloud_objs.append(cloud_obj)
             self._partition += 1
         else:
@@ -65,89 +80,95 @@ class ImagesManager:
 def gen_iso_images(sp_inds, sp_mzs, sp_ints, centr_df, nrows, ncols, ppm=3, min_px=1):
     # assume sp data is sorted by mz order ascending
     # assume centr data is sorted by mz order ascending
-
-    centr_f_inds = centr_df.formula_i.values
-    centr_p_inds = centr_df.peak_i.values
-    centr_mzs = centr_df.mz.values
-    centr_ints = centr_df.int.values
-
-    def yield_buffer(buffer):
-        while len(buffer) < ISOTOPIC_PEAK_N:
-            buffer.append((buffer[0][0], len(buffer) - 1, 0, None))
-        buffer = np.array(buffer)
-        buffer = buffer[buffer[:, 1].argsort()]  # sort order by peak ascending
-        buffer = pd.DataFrame(buffer, columns=['formula_i', 'peak_i', 'centr_ints', 'image'])
-        buffer.sort_values('peak_i', inplace=True)
-        return buffer.formula_i[0], buffer.centr_ints, buffer.image
-
-    if len(sp_inds) > 0:
-        lower = centr_mzs - centr_mzs * ppm * 1e-6
-        upper = centr_mzs + centr_mzs * ppm * 1e-6
-        lower_idx = np.searchsorted(sp_mzs, lower, 'l')
-        upper_idx = np.searchsorted(sp_mzs, upper, 'r')
-        ranges_df = pd.DataFrame({'formula_i': centr_f_inds, 'lower_idx': lower_idx, 'upper_idx': upper_idx}).sort_values('formula_i')
-
-        buffer = []
-        for df_index, df_row in ranges_df.iterrows():
-            if len(buffer) != 0 and buffer[0][0] != centr_f_inds[df_index]:
-                yield yield_buffer(buffer)
-                buffer = []
-
-            l, u = df_row['lower_idx'], df_row['upper_idx']
-            m = None
+    if len(sp_inds) == 0 or len(centr_df) == 0:
+        return
+
+    # order peaks by formula and then by peak, so each formula occupies a contiguous range of peaks
+    by_formula = np.lexsort((centr_df.peak_i.values, centr_df.formula_i.values))
+    centr_f_inds = centr_df.formula_i.values[by_formula]
+    centr_p_inds = centr_df.peak_i.values[by_formula]
+    centr_mzs = centr_df.mz.values[by_formula]
+    centr_ints = centr_df.int.values[by_formula]
+
+    lower = centr_mzs - centr_mzs * ppm * 1e-6
+    upper = centr_mzs + centr_mzs * ppm * 1e-6
+    lower_idx = np.searchsorted(sp_mzs, lower, 'left')
+    upper_idx = np.searchsorted(sp_mzs, upper, 'right')
+
+    formula_starts = np.flatnonzero(np.r_[True, centr_f_inds[1:] != centr_f_inds[:-1]])
+    formula_ends = np.r_[formula_starts[1:], len(centr_f_inds)]
+    peaks_n = np.repeat(formula_ends - formula_starts, formula_ends - formula_starts)
+
+    # Formulas with clipped peaks are padded to ISOTOPIC_PEAK_N with zero intensity and no image. As in the
+    # original implementation, the padding of a formula with k peaks takes peak indices k-1, k, ..., so it
+    # goes before any surviving peak with a higher index, e.g. peaks 1, 2, 3 become 1, 2, padding, 3.
+    padding_n = np.maximum(ISOTOPIC_PEAK_N - peaks_n, 0)
+    peak_rank = np.arange(len(centr_f_inds)) - np.repeat(formula_starts, formula_ends - formula_starts)
+    peak_pos = peak_rank + np.clip(centr_p_inds - peaks_n + 1, 0, padding_n)
+    padded_ints = np.zeros((len(formula_starts), max(ISOTOPIC_PEAK_N, peak_pos.max() + 1)))
+    padded_ints[np.repeat(np.arange(len(formula_starts)), formula_ends - formula_starts), peak_pos] = centr_ints
+
+    # images are built from slices of shared row/col/intensity buffers instead of copying each peak's data
+    row_inds = (sp_inds // ncols).astype(np.int32)
+    col_inds = (sp_inds % ncols).astype(np.int32)
+
+    for f_pos, (start, end) in enumerate(zip(formula_starts, formula_ends)):
+        images = [None] * padded_ints.shape[1]
+        for peak_pos_i, l, u in zip(peak_pos[start:end], lower_idx[start:end], upper_idx[start:end]):
             if u - l >= min_px:
-                data = sp_ints[l:u]
-                inds = sp_inds[l:u]
-                row_inds = inds / ncols
-                col_inds = inds % ncols
-                m = coo_matrix((data, (row_inds, col_inds)), shape=(nrows, ncols), copy=True)
-            buffer.append((centr_f_inds[df_index], centr_p_inds[df_index], centr_ints[df_index], m))
-
-        if len(buffer) != 0:
-            yield yield_buffer(buffer)
+                images[peak_pos_i] = coo_matrix((sp_ints[l:u], (row_inds[l:u], col_inds[l:u])),
+                                                shape=(nrows, ncols), copy=False)
+        yield centr_f_inds[start], padded_ints[f_pos], images
 
 
 def read_ds_segments(ds_bucket, ds_segm_prefix, first_segm_i, last_segm_i, ds_segms_len, pw_mem_mb, ds_segm_size_mb,
-                     ds_segm_dtype, ibm_cos):
+                     ds_segm_dtype, ibm_cos, mz_range=None):
+    """ Reads consecutive dataset segments and returns their sp_i, mz and int columns sorted by mz.
+    If `mz_range` is specified, only the parts of the first and last segments within the range are downloaded.
+    """
 
     ds_segms_mb = (last_segm_i - first_segm_i + 1) * ds_segm_size_mb
     safe_mb = 512
     read_memory_mb = ds_segms_mb + safe_mb
     if read_memory_mb > pw_mem_mb:
-        raise Exception(f'There isn\'t enough memory to read dataset segments, consider increasing PyWren\'s memory for at least {read_memory_mb} mb.')
+        raise MemoryError(f'There isn\'t enough memory to read dataset segments, '
+                          f'consider increasing PyWren\'s memory for at least {read_memory_mb} mb.')
 
-    ds_segm_keys = [f'{ds_segm_prefix}/{segm_i}.msgpack' for segm_i in range(first_segm_i, last_segm_i + 1)]
+    segm_is = list(range(first_segm_i, last_segm_i + 1))
 
-    def read_ds_segment(ds_segm_key):
-        data = read_object_with_retry(ibm_cos, ds_bucket, ds_segm_key, msgpack.load)
-        if type(data) == list:
-            sp_arr = np.concatenate(data)
-        else:
-            sp_arr = data
-        return sp_arr
+    def read_ds_segment(segm_i):
+        # Only the outermost segments can contain peaks outside of the mz range
+        segm_mz_range = mz_range if segm_i in (first_segm_i, last_segm_i) else None
+        return read_segment(ibm_cos, ds_bucket, f'{ds_segm_prefix}/{segm_i}.segm', segm_mz_range)
 
     safe_mb = 1024
     concat_memory_mb = ds_segms_mb * 2 + safe_mb
     if concat_memory_mb > pw_mem_mb:
 
         print('Using pre-allocated concatenation')
-        sp_arr = np.zeros((sum(ds_segms_len), 3), dtype=ds_segm_dtype)
+        sp_columns = OrderedDict((name, np.zeros(sum(ds_segms_len), dtype=dtype))
+                                 for name, dtype in spectra_dtypes(ds_segm_dtype).items())
         row_i = 0
-        for key in ds_segm_keys:
-            sub_sp_arr = read_ds_segment(key)
-            sp_arr[row_i:row_i + len(sub_sp_arr)] = sub_sp_arr
-            row_i += len(sub_sp_arr)
-        sp_arr.view(f'{ds_segm_dtype},{ds_segm_dtype},{ds_segm_dtype}').sort(order=['f1'],
-                                                                             axis=0)  # assume mz in column 1
+        for segm_i in segm_is:
+            sub_sp_columns = read_ds_segment(segm_i)
+            sub_len = len(sub_sp_columns['mz'])
+            for name, arr in sub_sp_columns.items():
+                sp_columns[name][row_i:row_i + sub_len] = arr
+            row_i += sub_len
+            del sub_sp_columns
+        sp_columns = OrderedDict((name, arr[:row_i]) for name, arr in sp_columns.items())
 
     else:
 
         with ThreadPoolExecutor(max_workers=128) as pool:
-            sp_arr = list(pool.map(read_ds_segment, ds_segm_keys))
-        sp_arr = np.concatenate(sp_arr)
-        sp_arr = sp_arr[sp_arr[:, 1].argsort()]  # assume mz in column 1
+            sub_sp_columns_list = list(pool.map(read_ds_segment, segm_is))
+        sp_columns = merge_sorted_runs(sub_sp_columns_list,
+                                       out=OrderedDict((name, np.empty(sum(ds_segms_len), dtype=dtype))
+                                                       for name, dtype in spectra_dtypes(ds_segm_dtype).items()))
+        del sub_sp_columns_list
 
-    return sp_arr
+    # consecutive segments cover disjoint mz ranges, so the concatenated segments are already sorted by mz
+    return tuple(sp_columns[name] for name in ('sp_i', 'mz', 'int'))
 
 
 def make_sample_area_mask(coordinates):
@@ -158,11 +179,19 @@ def make_sample_area_mask(coordinates):
     return sample_area_mask.reshape(nrows, ncols)
 
 
+def ppm_mz_range(min_mz, max_mz, ppm):
+    return min_mz - min_mz * ppm * 1e-6, max_mz + max_mz * ppm * 1e-6
+
+
+def centr_segm_mz_range(centr_df, ppm):
+    return ppm_mz_range(*centr_df.mz.agg([np.min, np.max]), ppm)
+
+
 def choose_ds_segments(ds_segments_bounds, centr_df, ppm):
-    centr_segm_min_mz, centr_segm_max_mz = centr_df.mz.agg([np.min, np.max])
-    centr_segm_min_mz -= centr_segm_min_mz * ppm * 1e-6
-    centr_segm_max_mz += centr_segm_max_mz * ppm * 1e-6
+    return choose_ds_segments_in_mz_range(ds_segments_bounds, *centr_segm_mz_range(centr_df, ppm))
 
+
+def choose_ds_segments_in_mz_range(ds_segments_bounds, centr_segm_min_mz, centr_segm_max_mz):
     ds_segm_n = len(ds_segments_bounds)
     first_ds_segm_i = np.searchsorted(ds_segments_bounds[:, 0], centr_segm_min_mz, side='right') - 1
     first_ds_segm_i = max(0, first_ds_segm_i)
@@ -171,41 +200,105 @@ def choose_ds_segments(ds_segments_bounds, centr_df, ppm):
     return first_ds_segm_i, last_ds_segm_i
 
 
+def fixed_memory_mb(ds_segms_mb, ds_segm_dtype):
+    """ Memory that `process_centr_segment` needs besides the formula images buffer """
+    # gen_iso_images keeps int32 row and column indices for every dataset peak
+    index_buffers_mb = ds_segms_mb * 2 * 4 / spectra_peak_bytes(ds_segm_dtype)
+    return PROCESS_SEGMENT_SAFE_MB + ds_segms_mb + index_buffers_mb
+
+
+def estimate_process_segment_memory_mb(ds_segms_len, ds_segm_size_mb, ds_segm_dtype):
+    """ Smallest runtime memory with which `process_centr_segment` can process a centroids segment that overlaps
+    dataset segments with `ds_segms_len` peaks: enough for the segments and the minimum formula images buffer.
+    Segments are assumed to be at least `ds_segm_size_mb`, as the memory checks of the function do.
+    """
+    ds_segms_mb = max(len(ds_segms_len) * ds_segm_size_mb,
+                      sum(ds_segms_len) * spectra_peak_bytes(ds_segm_dtype) / 1024 ** 2)
+    return fixed_memory_mb(ds_segms_mb, ds_segm_dtype) + 3 * ImagesManager.min_memory_allowed / 1024 ** 2
+
+
+def plan_memory_tiers(centr_segm_mz_ranges, ds_segments_bounds, ds_segms_len, ppm, ds_segm_size_mb, ds_segm_dtype,
+                      memory_tiers_mb):
+    """ Assigns every centroids segment to the smallest memory tier that is predicted to fit it,
+    based on the dataset segments that its mz range overlaps.
+    Segments that don't fit in any tier are assigned to the largest one.
+
+    Args
+    -----
+    centr_segm_mz_ranges : dict[int, tuple[float, float]]
+        min and max mz of every centroids segment
+    memory_tiers_mb : list[int]
+
+    Returns
+    -----
+        dict[int, list[int]]: memory tier -> centroids segment ids
+    """
+    memory_tiers_mb = sorted(memory_tiers_mb)
+    tiers = {}
+    for segm_i, (min_mz, max_mz) in sorted(centr_segm_mz_ranges.items()):
+        first_ds_segm_i, last_ds_segm_i = choose_ds_segments_in_mz_range(ds_segments_bounds,
+                                                                         *ppm_mz_range(min_mz, max_mz, ppm))
+        memory_mb = estimate_process_segment_memory_mb(ds_segms_len[first_ds_segm_i:last_ds_segm_i + 1],
+                                                       ds_segm_size_mb, ds_segm_dtype)
+        tier_mb = next((tier_mb for tier_mb in memory_tiers_mb if tier_mb >= memory_mb), memory_tiers_mb[-1])
+        tiers.setdefault(tier_mb, []).append(segm_i)
+    return tiers
+
+
 def create_process_segment(ds_bucket, output_bucket, ds_segm_prefix, ds_segments_bounds, ds_segms_len,
-                           coordinates, image_gen_config, pw_mem_mb, ds_segm_size_mb, ds_segm_dtype):
+                           coordinates, image_gen_config, pw_mem_mb, ds_segm_size_mb, ds_segm_dtype, images_prefix):
+    """ Creates the function that generates the images and metrics of the formulas in a centroids segment.
+    Its images and metrics are stored under `{images_prefix}/{centroids segment}/{pw_mem_mb}MB/`, so it's idempotent
+    and it can be run several times for the same segment, e.g. speculatively. It only returns the MSM of the
+    formulas, so that the driver can merge them as segments complete without keeping all the metrics.
+    """
     sample_area_mask = make_sample_area_mask(coordinates)
     nrows, ncols = ds_dims(coordinates)
-    compute_metrics = make_compute_image_metrics(sample_area_mask, nrows, ncols, image_gen_config)
+    compute_metrics = make_compute_image_metrics_batch(sample_area_mask, nrows, ncols, image_gen_config)
     ppm = image_gen_config['ppm']
 
-    def process_centr_segment(obj, ibm_cos, internal_storage):
+    def process_centr_segment(obj, ibm_cos):
         print(f'Reading centroids segment {obj.key}')
         # read database relevant part
-        try:
-            centr_df = pd.read_msgpack(obj.data_stream)
-        except:
-            centr_df = read_object_with_retry(ibm_cos, obj.bucket, obj.key, pd.read_msgpack)
+        with span('download', key=obj.key):
+            try:
+                centr_df = pd.read_msgpack(obj.data_stream)
+                count_stream(obj.data_stream)
+            except:
+                centr_df = read_object_with_retry(ibm_cos, obj.bucket, obj.key, pd.read_msgpack)
 
         # find range of datasets
         first_ds_segm_i, last_ds_segm_i = choose_ds_segments(ds_segments_bounds, centr_df, ppm)
         print(f'Reading dataset segments {first_ds_segm_i}-{last_ds_segm_i}')
-        # read all segments in loop from COS
-        sp_arr = read_ds_segments(ds_bucket, ds_segm_prefix, first_ds_segm_i, last_ds_segm_i,
-                                  ds_segms_len[first_ds_segm_i:last_ds_segm_i+1], pw_mem_mb,
-                                  ds_segm_size_mb, ds_segm_dtype, ibm_cos)
-
-        formula_images_it = gen_iso_images(sp_inds=sp_arr[:,0], sp_mzs=sp_arr[:,1], sp_ints=sp_arr[:,2],
+        # read all segments in loop from COS, skipping peaks outside of the centroids mz range
+        with span('download', ds_segments=f'{first_ds_segm_i}-{last_ds_segm_i}'):
+            sp_inds, sp_mzs, sp_ints = read_ds_segments(ds_bucket, ds_segm_prefix, first_ds_segm_i, last_ds_segm_i,
+                                                        ds_segms_len[first_ds_segm_i:last_ds_segm_i+1], pw_mem_mb,
+                                                        ds_segm_size_mb, ds_segm_dtype, ibm_cos,
+                                                        mz_range=centr_segm_mz_range(centr_df, ppm))
+
+        formula_images_it = gen_iso_images(sp_inds=sp_inds, sp_mzs=sp_mzs, sp_ints=sp_ints,
                                            centr_df=centr_df, nrows=nrows, ncols=ncols, ppm=ppm, min_px=1)
-        safe_mb = 1024
-        max_formula_images_mb = (pw_mem_mb - safe_mb - (last_ds_segm_i - first_ds_segm_i + 1) * ds_segm_size_mb) // 3
+        ds_segms_mb = (last_ds_segm_i - first_ds_segm_i + 1) * ds_segm_size_mb
+        max_formula_images_mb = int(pw_mem_mb - fixed_memory_mb(ds_segms_mb, ds_segm_dtype)) // 3
         print(f'Max formula_images size: {max_formula_images_mb} mb')
-        images_manager = ImagesManager(internal_storage, output_bucket, max_formula_images_mb * 1024 ** 2)
-        formula_image_metrics(formula_images_it, compute_metrics, images_manager)
+        segm_images_prefix = f'{images_prefix}/{Path(obj.key).stem}/{pw_mem_mb}MB'
+        images_manager = ImagesManager(ibm_cos, output_bucket, segm_images_prefix, max_formula_images_mb * 1024 ** 2)
+        # images that don't fit in memory are saved from within this span
+        with span('compute', formulas=centr_df.formula_i.nunique()):
+            formula_image_metrics_batch(formula_images_it, compute_metrics, images_manager)
         images_cloud_objs = images_manager.finish()
 
-        print(f'Centroids segment {obj.key} finished')
         formula_metrics_df = pd.DataFrame.from_dict(images_manager.formula_metrics, orient='index')
         formula_metrics_df.index.name = 'formula_i'
-        return formula_metrics_df, images_cloud_objs
+        formula_metrics_obj = CloudObject(output_bucket, f'{segm_images_prefix}/metrics.pickle')
+        with span('upload'):
+            ibm_cos.put_object(Bucket=formula_metrics_obj.bucket, Key=formula_metrics_obj.key,
+                               Body=pickle.dumps(formula_metrics_df))
+
+        print(f'Centroids segment {obj.key} finished')
+        formula_is = formula_metrics_df.index.values.astype(np.int64)
+        msm = formula_metrics_df['msm'].values if len(formula_metrics_df) else np.zeros(0)
+        return formula_metrics_obj, formula_is, msm, images_cloud_objs
 
     return process_centr_segment
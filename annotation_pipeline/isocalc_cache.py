@@ -0,0 +1,147 @@
+import uuid
+import numpy as np
+import msgpack_numpy as msgpack
+
+from annotation_pipeline.utils import list_keys, read_object_with_retry
+
+BASE_NAME = 'base.msgpack'
+DELTA_PREFIX = 'delta-'
+
+
+def _load_part(stream):
+    part = msgpack.load(stream, encoding='utf-8')
+    return part['formulas'], part['mzs'], part['ints']
+
+
+def _dump_part(formulas, mzs, ints):
+    return msgpack.dumps({'formulas': formulas, 'mzs': mzs, 'ints': ints})
+
+
+def _merge_parts(parts, n_peaks):
+    """ Concatenates (formulas, mzs, ints) parts and returns them sorted by formula, without duplicates """
+    if not parts:
+        return np.zeros(0, dtype='S1'), np.zeros((0, n_peaks)), np.zeros((0, n_peaks))
+    formulas = np.concatenate([formulas for formulas, _, _ in parts])
+    formulas, first = np.unique(formulas, return_index=True)
+    mzs = np.concatenate([mzs for _, mzs, _ in parts])[first]
+    ints = np.concatenate([ints for _, _, ints in parts])[first]
+    return formulas, mzs, ints
+
+
+class IsotopePatternCache(object):
+    """ Persistent formula -> isotope pattern centroids cache, stored in COS as sorted array shards.
+
+    Every combination of charge, sigma and number of peaks has its own set of shards. Each shard consists of
+    a base object and delta objects with the patterns calculated by workers since the last compaction.
+    Formulas that can't be parsed are cached as well, with NaN centroids.
+
+    Args
+    ----------
+    ibm_cos : ibm_boto3.Client
+    bucket : str
+    prefix : str
+    charge : int
+    sigma : float
+    n_peaks : int
+    """
+
+    def __init__(self, ibm_cos, bucket, prefix, charge, sigma, n_peaks):
+        self._ibm_cos = ibm_cos
+        self._bucket = bucket
+        self.prefix = f'{prefix}/charge{charge}_sigma{sigma:.9g}_peaks{n_peaks}'
+        self.n_peaks = n_peaks
+        self.hits = 0
+        self.misses = 0
+        self._formulas, self._mzs, self._ints = _merge_parts([], n_peaks)
+        self._new = {}
+
+    def shard_prefix(self, shard_i):
+        return f'{self.prefix}/{shard_i}/'
+
+    def _read_shard_parts(self, shard_i):
+        keys = list_keys(self._bucket, self.shard_prefix(shard_i), self._ibm_cos)
+        parts = [read_object_with_retry(self._ibm_cos, self._bucket, key, _load_part) for key in keys]
+        return keys, parts
+
+    def load_shards(self, shard_inds):
+        """ Loads the base and deltas of the shards, replacing any previously loaded shards """
+        parts = []
+        for shard_i in shard_inds:
+            parts.extend(self._read_shard_parts(shard_i)[1])
+        self._formulas, self._mzs, self._ints = _merge_parts(parts, self.n_peaks)
+
+    def centroids(self, formulas, calculate_centroids_batch):
+        """ Looks up the centroids of `formulas` in the loaded shards and the centroids calculated since the last
+        `store_new`, and calculates the missing ones
+
+        Args
+        -----
+        formulas : list[str]
+        calculate_centroids_batch : Callable[[list[str]], tuple]
+            function that returns (n, n_peaks) mzs and ints arrays, with NaN rows for invalid formulas
+
+        Returns
+        -----
+            tuple[ndarray, ndarray]: (n, n_peaks) mzs and ints, with NaN rows for invalid formulas
+        """
+        formulas = np.array(formulas, dtype='S')
+        mzs = np.full((len(formulas), self.n_peaks), np.nan)
+        ints = np.full((len(formulas), self.n_peaks), np.nan)
+
+        positions = np.searchsorted(self._formulas, formulas).clip(max=max(len(self._formulas) - 1, 0))
+        found = (self._formulas[positions] == formulas) if len(self._formulas) else np.zeros(len(formulas), bool)
+        mzs[found] = self._mzs[positions[found]]
+        ints[found] = self._ints[positions[found]]
+
+        for i in np.flatnonzero(~found):
+            if formulas[i] in self._new:
+                mzs[i], ints[i] = self._new[formulas[i]]
+                found[i] = True
+
+        missing = np.flatnonzero(~found)
+        if len(missing):
+            mzs[missing], ints[missing] = calculate_centroids_batch([f.decode('utf-8') for f in formulas[missing]])
+            for i in missing:
+                self._new[formulas[i]] = (mzs[i], ints[i])
+
+        self.hits += int(found.sum())
+        self.misses += len(missing)
+        return mzs, ints
+
+    def store_new(self, formula_to_shard):
+        """ Stores the centroids calculated since the last call as delta objects of their shards
+
+        Returns
+        -----
+            int: number of stored delta objects
+        """
+        shards = {}
+        for formula, (mzs, ints) in self._new.items():
+            shards.setdefault(formula_to_shard(formula.decode('utf-8')), []).append((formula, mzs, ints))
+
+        for shard_i, patterns in shards.items():
+            formulas, mzs, ints = zip(*patterns)
+            self._ibm_cos.put_object(Bucket=self._bucket,
+                                     Key=f'{self.shard_prefix(shard_i)}{DELTA_PREFIX}{uuid.uuid4().hex}.msgpack',
+                                     Body=_dump_part(np.array(formulas, dtype='S'), np.array(mzs), np.array(ints)))
+        self._new.clear()
+        return len(shards)
+
+    def compact(self, shard_i):
+        """ Merges the deltas of a shard into its base object """
+        keys, parts = self._read_shard_parts(shard_i)
+        delta_keys = [key for key in keys if not key.endswith(BASE_NAME)]
+        if not delta_keys:
+            return 0
+
+        formulas, mzs, ints = _merge_parts(parts, self.n_peaks)
+        self._ibm_cos.put_object(Bucket=self._bucket,
+                                 Key=f'{self.shard_prefix(shard_i)}{BASE_NAME}',
+                                 Body=_dump_part(formulas, mzs, ints))
+        self._ibm_cos.delete_objects(Bucket=self._bucket, Delete={'Objects': [{'Key': key} for key in delta_keys]})
+        return len(formulas)
+
+    def shards_with_deltas(self):
+        keys = list_keys(self._bucket, f'{self.prefix}/', self._ibm_cos)
+        return sorted({int(key[len(self.prefix) + 1:].split('/')[0]) for key in keys
+                       if key.rsplit('/', 1)[-1].startswith(DELTA_PREFIX)})
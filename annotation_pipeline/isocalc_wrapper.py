@@ -1,8 +1,13 @@
 from cpyMSpec import isotopePattern, InstrumentModel
 from pyMSpec.pyisocalc import pyisocalc
+from pyMSpec.pyisocalc.periodic_table import periodic_table
 import cpyMSpec.utils
 import numpy as np
 import logging
+import multiprocessing
+import os
+
+from annotation_pipeline.formula_parser import is_valid_formula
 
 assert cpyMSpec.utils.VERSION == '0.3.5', 'Incorrect version of cpyMSpec: ' + cpyMSpec.utils.VERSION
 
@@ -10,6 +15,17 @@ logger = logging.getLogger('engine')
 
 ISOTOPIC_PEAK_N = 4
 SIGMA_TO_FWHM = 2.3548200450309493  # 2 \sqrt{2 \log 2}
+BATCH_CHUNK_SIZE = 1000
+
+
+def _centroids_batch_chunk(args):
+    """ Entry point of the pool processes of `IsocalcWrapper.centroids_batch` """
+    isocalc_wrapper, formulas = args
+    mzs = np.full((len(formulas), isocalc_wrapper.n_peaks), np.nan)
+    ints = np.full((len(formulas), isocalc_wrapper.n_peaks), np.nan)
+    for i, formula in enumerate(formulas):
+        isocalc_wrapper._centroids_into(formula, mzs[i], ints[i])
+    return mzs, ints
 
 
 class IsocalcWrapper(object):
@@ -35,44 +51,94 @@ class IsocalcWrapper(object):
     def _trim(mzs, ints, k):
         """ Only keep top k peaks
         """
-        int_order = np.argsort(ints)[::-1]
-        mzs = mzs[int_order][:k]
-        ints = ints[int_order][:k]
+        if len(ints) > k:
+            top = np.argsort(ints)[::-1][:k]
+            mzs, ints = mzs[top], ints[top]
         mz_order = np.argsort(mzs)
-        mzs = mzs[mz_order]
-        ints = ints[mz_order]
-        return mzs, ints
+        return mzs[mz_order], ints[mz_order]
 
-    def centroids(self, formula):
-        """
-        Args
-        -----
-        formula : str
+    def _centroids_into(self, formula, mzs, ints):
+        """ Writes the zero padded centroids of an already validated formula into the `mzs` and `ints` rows
 
         Returns
         -----
-            list[tuple]
+            bool: whether the centroids could be calculated
         """
         try:
-            pyisocalc.parseSumFormula(formula)  # tests that formula is parsable
-            iso_pattern = isotopePattern(str(formula))
+            iso_pattern = isotopePattern(formula)
             iso_pattern.addCharge(int(self.charge))
             fwhm = self.sigma * SIGMA_TO_FWHM
             resolving_power = iso_pattern.masses[0] / fwhm
             instrument_model = InstrumentModel('tof', resolving_power)
             centr = iso_pattern.centroids(instrument_model)
-            mzs_ = np.array(centr.masses)
-            ints_ = 100. * np.array(centr.intensities)
-            mzs_, ints_ = self._trim(mzs_, ints_, self.n_peaks)
+            mzs_, ints_ = self._trim(np.array(centr.masses), 100. * np.array(centr.intensities), self.n_peaks)
 
             n = len(mzs_)
-            mzs = np.zeros(self.n_peaks)
-            mzs[:n] = np.array(mzs_)
-            ints = np.zeros(self.n_peaks)
-            ints[:n] = ints_
+            mzs[:n], mzs[n:] = mzs_, 0
+            ints[:n], ints[n:] = ints_, 0
+            return True
 
-            return mzs, ints
+        except Exception as e:
+            logger.warning('%s - %s', formula, e)
+            return False
+
+    def centroids(self, formula):
+        """
+        Args
+        -----
+        formula : str
 
+        Returns
+        -----
+            list[tuple]
+        """
+        try:
+            pyisocalc.parseSumFormula(formula)  # tests that formula is parsable
         except Exception as e:
             logger.warning('%s - %s', formula, e)
             return None, None
+
+        mzs = np.zeros(self.n_peaks)
+        ints = np.zeros(self.n_peaks)
+        if self._centroids_into(str(formula), mzs, ints):
+            return mzs, ints
+        return None, None
+
+    def centroids_batch(self, formulas, processes=None):
+        """ Calculates the centroids of many formulas, using a pool of `processes` (all CPUs by default)
+        unless this is a daemonic process, e.g. a call of `LocalExecutor`, which isn't allowed to have children.
+
+        Formulas are validated with `formula_parser` instead of being parsed by pyisocalc first.
+
+        Args
+        -----
+        formulas : list[str]
+        processes : int
+
+        Returns
+        -----
+            tuple[ndarray, ndarray]: (n, n_peaks) mzs and ints, with NaN rows for invalid formulas
+        """
+        mzs = np.full((len(formulas), self.n_peaks), np.nan)
+        ints = np.full((len(formulas), self.n_peaks), np.nan)
+        valid_inds = []
+        for i, formula in enumerate(formulas):
+            if is_valid_formula(formula, periodic_table):
+                valid_inds.append(i)
+            else:
+                logger.warning('%s - invalid formula', formula)
+
+        processes = min(processes or os.cpu_count(), -(-len(valid_inds) // BATCH_CHUNK_SIZE))
+        if processes <= 1 or multiprocessing.current_process().daemon:
+            for i in valid_inds:
+                self._centroids_into(str(formulas[i]), mzs[i], ints[i])
+        else:
+            chunks = [valid_inds[start:start + BATCH_CHUNK_SIZE]
+                      for start in range(0, len(valid_inds), BATCH_CHUNK_SIZE)]
+            with multiprocessing.get_context('fork').Pool(processes) as pool:
+                chunk_results = pool.imap(_centroids_batch_chunk,
+                                          ((self, [str(formulas[i]) for i in chunk]) for chunk in chunks))
+                for chunk, (chunk_mzs, chunk_ints) in zip(chunks, chunk_results):
+                    mzs[chunk], ints[chunk] = chunk_mzs, chunk_ints
+
+        return mzs, ints
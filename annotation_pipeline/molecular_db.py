@@ -1,37 +1,103 @@
-from itertools import repeat
 from pathlib import Path
 from ibm_botocore.client import ClientError
 from concurrent.futures import ThreadPoolExecutor
-import pywren_ibm_cloud as pywren
+from itertools import product
 import msgpack_numpy as msgpack
+import numpy as np
 import pandas as pd
 import pickle
 import hashlib
 import math
+import uuid
 
-from annotation_pipeline.formula_parser import safe_generate_ion_formula
+from annotation_pipeline.executor import get_executor
+from annotation_pipeline.formula_parser import parse_formulas, safe_generate_ion_formulas
+from annotation_pipeline.isocalc_cache import IsotopePatternCache
+from annotation_pipeline.tracing import span, count_stream
 from annotation_pipeline.utils import logger, get_ibm_cos_client, append_pywren_stats, list_keys, clean_from_cos,\
-    read_object_with_retry
+    read_object_with_retry, content_hash, read_manifest, write_manifest
 
 DECOY_ADDUCTS = ['+He', '+Li', '+Be', '+B', '+C', '+N', '+O', '+F', '+Ne', '+Mg', '+Al', '+Si', '+P', '+S', '+Cl', '+Ar', '+Ca', '+Sc', '+Ti', '+V', '+Cr', '+Mn', '+Fe', '+Co', '+Ni', '+Cu', '+Zn', '+Ga', '+Ge', '+As', '+Se', '+Br', '+Kr', '+Rb', '+Sr', '+Y', '+Zr', '+Nb', '+Mo', '+Ru', '+Rh', '+Pd', '+Ag', '+Cd', '+In', '+Sn', '+Sb', '+Te', '+I', '+Xe', '+Cs', '+Ba', '+La', '+Ce', '+Pr', '+Nd', '+Sm', '+Eu', '+Gd', '+Tb', '+Dy', '+Ho', '+Ir', '+Th', '+Pt', '+Os', '+Yb', '+Lu', '+Bi', '+Pb', '+Re', '+Tl', '+Tm', '+U', '+W', '+Au', '+Er', '+Hf', '+Hg', '+Ta']
 N_FORMULAS_SEGMENTS = 256
+N_HASH_SEGMENTS = 32  # should be less than N_FORMULAS_SEGMENTS
+
+
+def hash_formula_to_segment(formula):
+    m = hashlib.md5()
+    m.update(formula.encode('utf-8'))
+    return int(m.hexdigest(), 16) % N_HASH_SEGMENTS
+
+
+def get_formula_index_key(formulas_chunks_prefix, database, modifier):
+    return f'{formulas_chunks_prefix}_rankings/{Path(database).stem}/{modifier or "no_modifier"}.msgpack'
 
 
 def build_database(config, input_db):
+    """ Generates the ion formulas of all molecules in `input_db['databases']`, assigns a formula_i to each of them
+    and builds the formula indices of the FDR rankings.
+
+    Builds are cached by a manifest stored next to the formulas chunks, which records the content hash of every
+    database. A rerun with the same databases, adducts and modifiers doesn't do anything, while new or changed
+    databases only generate the formulas that are not present yet and append them with new formula_i values.
+    Changing the adducts or modifiers rebuilds everything.
+
+    The `build_id` of the manifest identifies the formula_i numbering, which centroids are cached for. Every
+    from-scratch build gets a new one, while builds that append formulas keep it, as existing formula_i don't change.
+    """
     bucket = config["storage"]["db_bucket"]
     formulas_chunks_prefix = input_db["formulas_chunks"]
-    clean_from_cos(config, bucket, formulas_chunks_prefix)
+    manifest_key = f'{formulas_chunks_prefix}_manifest.json'
 
     adducts = [*input_db['adducts'], *DECOY_ADDUCTS]
     modifiers = input_db['modifiers']
-    databases = input_db['databases']
 
-    N_HASH_SEGMENTS = 32  # should be less than N_FORMULAS_SEGMENTS
+    ibm_cos = get_ibm_cos_client(config)
 
-    def hash_formula_to_segment(formula):
-        m = hashlib.md5()
-        m.update(formula.encode('utf-8'))
-        return int(m.hexdigest(), 16) % N_HASH_SEGMENTS
+    def database_hash(database):
+        return content_hash(read_object_with_retry(ibm_cos, bucket, database))
+
+    with ThreadPoolExecutor(max_workers=128) as pool:
+        databases_hashes = dict(zip(input_db['databases'], pool.map(database_hash, input_db['databases'])))
+    config_hash = content_hash({'adducts': adducts, 'modifiers': modifiers})
+
+    manifest = read_manifest(ibm_cos, bucket, manifest_key)
+    if manifest is None or manifest['config_hash'] != config_hash:
+        logger.info('Building formulas from scratch')
+        # also removes the manifest, segment tables and formula indices, which share the prefix
+        clean_from_cos(config, bucket, formulas_chunks_prefix)
+        manifest = {'config_hash': config_hash,
+                    'build_id': uuid.uuid4().hex,
+                    'generation': -1,
+                    'databases': {},
+                    'formulas_n': 0,
+                    'segment_tables': {},
+                    'formula_chunks': []}
+
+    databases = [database for database, database_hash in databases_hashes.items()
+                 if manifest['databases'].get(database) != database_hash]
+    if not databases:
+        logger.info(f'Formulas are up to date: {manifest["formulas_n"]} formulas in '
+                    f'{len(manifest["formula_chunks"])} chunks')
+        return manifest['formulas_n'], len(manifest['formula_chunks'])
+
+    generation = manifest['generation'] + 1
+    formulas_n_before = manifest['formulas_n']
+    segment_tables = {int(segm_i): table_generation for segm_i, table_generation in manifest['segment_tables'].items()}
+    logger.info(f'Generating formulas of {len(databases)} databases (build generation {generation})')
+    # intermediate objects of an interrupted build
+    for prefix in [f'{formulas_chunks_prefix}/chunk/', f'{formulas_chunks_prefix}/mol_chunk/',
+                   f'{formulas_chunks_prefix}/new_formulas/', f'{formulas_chunks_prefix}_rankings/chunk/']:
+        clean_from_cos(config, bucket, prefix, ibm_cos)
+
+    def segment_table_key(segm_i, table_generation):
+        return f'{formulas_chunks_prefix}_fdr/{table_generation}/{segm_i}.msgpack'
+
+    def read_segment_table(segm_i, ibm_cos):
+        """ Formulas of a hash segment that were generated by previous builds, indexed by formula_i """
+        if segm_i not in segment_tables:
+            return pd.DataFrame({'formula': []}, index=pd.RangeIndex(0, 0, name='formula_i'))
+        return read_object_with_retry(ibm_cos, bucket, segment_table_key(segm_i, segment_tables[segm_i]),
+                                      pd.read_msgpack)
 
     def generate_formulas(adduct, ibm_cos):
         print(f'Generating formulas for adduct {adduct}')
@@ -42,41 +108,65 @@ def build_database(config, input_db):
         with ThreadPoolExecutor(max_workers=128) as pool:
             mols_list = list(pool.map(_get_mols, databases))
 
-        formulas = set()
-
-        for mols in mols_list:
-            for modifier in modifiers:
-                formulas.update(map(safe_generate_ion_formula, mols, repeat(modifier), repeat(adduct)))
-
-        if None in formulas:
-            formulas.remove(None)
-
         formulas_segments = {}
-        for formula in formulas:
-            segm_i = hash_formula_to_segment(formula)
-            if segm_i in formulas_segments:
-                formulas_segments[segm_i].append(formula)
-            else:
-                formulas_segments[segm_i] = [formula]
+        # segment and position within the segment of every formula, which is then used to reference
+        # the ion formula of each molecule of every (database, modifier) group by compact integer arrays
+        formula_positions = {}
+        mol_formulas_groups = {}
+        for db_i, mols in enumerate(mols_list):
+            # each molecule is parsed once and then combined with every modifier
+            elements, element_counts = parse_formulas(mols)
+            for mod_i, modifier in enumerate(modifiers):
+                mol_segm_inds, mol_positions = [], []
+                for formula in safe_generate_ion_formulas(elements, element_counts, modifier, adduct):
+                    if formula is None:
+                        mol_segm_inds.append(-1)
+                        mol_positions.append(-1)
+                        continue
+                    segm_i, position = formula_positions.get(formula, (None, None))
+                    if segm_i is None:
+                        segm_i = hash_formula_to_segment(formula)
+                        segm_formulas = formulas_segments.setdefault(segm_i, [])
+                        position = len(segm_formulas)
+                        formula_positions[formula] = segm_i, position
+                        segm_formulas.append(formula)
+                    mol_segm_inds.append(segm_i)
+                    mol_positions.append(position)
+                mol_formulas_groups[(db_i, mod_i)] = (np.array(mol_segm_inds, dtype=np.int32),
+                                                      np.array(mol_positions, dtype=np.int32))
+        del formula_positions
 
         def _store(segm_i):
             ibm_cos.put_object(Bucket=bucket,
                                Key=f'{formulas_chunks_prefix}/chunk/{segm_i}/{adduct}.pickle',
                                Body=pickle.dumps(formulas_segments[segm_i]))
+            mol_formulas = {}
+            for group, (mol_segm_inds, mol_positions) in mol_formulas_groups.items():
+                mol_inds = np.flatnonzero(mol_segm_inds == segm_i).astype(np.int32)
+                mol_formulas[group] = (mol_inds, mol_positions[mol_inds])
+            ibm_cos.put_object(Bucket=bucket,
+                               Key=f'{formulas_chunks_prefix}/mol_chunk/{segm_i}/{adduct}.pickle',
+                               Body=pickle.dumps({'adduct': adduct,
+                                                  'formulas': formulas_segments[segm_i],
+                                                  'mol_formulas': mol_formulas}))
 
         segments_n = [segm_i for segm_i in formulas_segments]
         with ThreadPoolExecutor(max_workers=128) as pool:
             pool.map(_store, segments_n)
 
-        return segments_n
+        return segments_n, [len(mols) for mols in mols_list]
 
-    pw = pywren.ibm_cf_executor(config=config)
+    pw = get_executor(config)
     memory_capacity_mb = 512
     futures = pw.map(generate_formulas, adducts, runtime_memory=memory_capacity_mb)
-    segments_n = list(set().union(*pw.get_result(futures)))
-    append_pywren_stats(futures, memory=memory_capacity_mb, plus_objects=len(adducts) * len(segments_n))
+    results = pw.get_result(futures)
+    segments_n = list(set().union(*[segments for segments, mols_n in results]))
+    mols_n = results[0][1]
+    append_pywren_stats(futures, memory=memory_capacity_mb, plus_objects=len(adducts) * len(segments_n) * 2)
 
-    def deduplicate_formulas_segment(segm_i, ibm_cos, clean=True):
+    def deduplicate_formulas_segment(segm_i, ibm_cos):
+        """ Stores the sorted formulas of a hash segment that are not in its segment table yet and returns their number
+        """
         print(f'Deduplicating formulas segment {segm_i}')
         keys = list_keys(bucket, f'{formulas_chunks_prefix}/chunk/{segm_i}/', ibm_cos)
 
@@ -85,145 +175,250 @@ def build_database(config, input_db):
             segm_formulas_chunk = pickle.loads(read_object_with_retry(ibm_cos, bucket, key))
             segm.update(segm_formulas_chunk)
 
-        if clean:
-            clean_from_cos(config, bucket, f'{formulas_chunks_prefix}/chunk/{segm_i}/', ibm_cos)
-
-        return segm
+        new_formulas = sorted(segm.difference(read_segment_table(segm_i, ibm_cos).formula))
+        ibm_cos.put_object(Bucket=bucket,
+                           Key=f'{formulas_chunks_prefix}/new_formulas/{segm_i}.pickle',
+                           Body=pickle.dumps(new_formulas))
+        clean_from_cos(config, bucket, f'{formulas_chunks_prefix}/chunk/{segm_i}/', ibm_cos)
 
-    def get_formulas_number_per_chunk(segm_i, ibm_cos):
-        segm = deduplicate_formulas_segment(segm_i, ibm_cos, clean=False)
-        return len(segm)
+        return len(new_formulas)
 
-    pw = pywren.ibm_cf_executor(config=config)
+    pw = get_executor(config)
     memory_capacity_mb = 512
-    futures = pw.map(get_formulas_number_per_chunk, segments_n, runtime_memory=memory_capacity_mb)
-    formulas_nums = pw.get_result(futures)
-    append_pywren_stats(futures, memory=memory_capacity_mb)
-
-    def store_formulas_segment(segm_i, ibm_cos):
-        segm = deduplicate_formulas_segment(segm_i, ibm_cos)
-        formula_i_start = sum(formulas_nums[:segm_i])
-        formula_i_end = formula_i_start + len(segm)
-        segm = pd.DataFrame(sorted(segm),
+    futures = pw.map(deduplicate_formulas_segment, segments_n, runtime_memory=memory_capacity_mb)
+    formulas_nums = dict(zip(segments_n, pw.get_result(futures)))
+    append_pywren_stats(futures, memory=memory_capacity_mb,
+                        plus_objects=len(segments_n), minus_objects=len(adducts) * len(segments_n))
+
+    # new formulas are appended after the formulas of previous builds in hash segment order,
+    # so that existing formula_i don't change and the same input always gets the same formula_i
+    formula_i_starts = {}
+    formula_i_start = formulas_n_before
+    for segm_i in sorted(formulas_nums):
+        formula_i_starts[segm_i] = formula_i_start
+        formula_i_start += formulas_nums[segm_i]
+
+    def store_formula_index_parts(segm_i, segm, ibm_cos):
+        formula_to_id = dict(zip(segm.formula, segm.index))
+        keys = list_keys(bucket, f'{formulas_chunks_prefix}/mol_chunk/{segm_i}/', ibm_cos)
+
+        index_parts = {}
+        for key in keys:
+            mol_formulas_chunk = pickle.loads(read_object_with_retry(ibm_cos, bucket, key))
+            adduct_i = adducts.index(mol_formulas_chunk['adduct'])
+            chunk_formula_is = np.array([formula_to_id[formula] for formula in mol_formulas_chunk['formulas']],
+                                        dtype=np.int32)
+            for group, (mol_inds, mol_positions) in mol_formulas_chunk['mol_formulas'].items():
+                index_parts.setdefault(group, []).append((adduct_i, mol_inds, chunk_formula_is[mol_positions]))
+
+        def _store(group):
+            db_i, mod_i = group
+            ibm_cos.put_object(Bucket=bucket,
+                               Key=f'{formulas_chunks_prefix}_rankings/chunk/{db_i}_{mod_i}/{segm_i}.pickle',
+                               Body=pickle.dumps(index_parts[group]))
+
+        with ThreadPoolExecutor(max_workers=128) as pool:
+            pool.map(_store, index_parts)
+        clean_from_cos(config, bucket, f'{formulas_chunks_prefix}/mol_chunk/{segm_i}/', ibm_cos)
+
+    def store_formulas_segment(segm_i, formula_i_start, ibm_cos):
+        new_formulas_key = f'{formulas_chunks_prefix}/new_formulas/{segm_i}.pickle'
+        new_formulas = pickle.loads(read_object_with_retry(ibm_cos, bucket, new_formulas_key))
+        segm = pd.DataFrame(new_formulas,
                             columns=['formula'],
-                            index=pd.RangeIndex(formula_i_start, formula_i_end, name='formula_i'))
+                            index=pd.RangeIndex(formula_i_start, formula_i_start + len(new_formulas),
+                                                name='formula_i'))
 
+        segm_table = pd.concat([read_segment_table(segm_i, ibm_cos), segm])
         ibm_cos.put_object(Bucket=bucket,
-                           Key=f'{formulas_chunks_prefix}_fdr/{segm_i}.msgpack',
-                           Body=segm.to_msgpack())
+                           Key=segment_table_key(segm_i, generation),
+                           Body=segm_table.to_msgpack())
+
+        store_formula_index_parts(segm_i, segm_table, ibm_cos)
+        ibm_cos.delete_object(Bucket=bucket, Key=new_formulas_key)
 
         n_threads = N_FORMULAS_SEGMENTS // N_HASH_SEGMENTS
-        subsegm_size = math.ceil(len(segm) / n_threads)
+        subsegm_size = max(math.ceil(len(segm) / n_threads), 1)
         segm_list = [segm[i:i+subsegm_size] for i in range(0, segm.shape[0], subsegm_size)]
 
         def _store(segm_j):
-            id = segm_i * n_threads + segm_j
+            id = generation * N_FORMULAS_SEGMENTS + segm_i * n_threads + segm_j
             print(f'Storing formulas segment {id}')
+            key = f'{formulas_chunks_prefix}/{id}.msgpack'
             ibm_cos.put_object(Bucket=bucket,
-                               Key=f'{formulas_chunks_prefix}/{id}.msgpack',
+                               Key=key,
                                Body=segm_list[segm_j].to_msgpack())
+            return key
 
         with ThreadPoolExecutor(max_workers=128) as pool:
-            pool.map(_store, range(n_threads))
+            return list(pool.map(_store, range(len(segm_list))))
 
-        return [len(segm) for segm in segm_list]
-
-    pw = pywren.ibm_cf_executor(config=config)
+    pw = get_executor(config)
     memory_capacity_mb = 512
-    futures = pw.map(store_formulas_segment, segments_n, runtime_memory=memory_capacity_mb)
-    results = pw.get_result(futures)
+    futures = pw.map(store_formulas_segment, sorted(formula_i_starts.items()), runtime_memory=memory_capacity_mb)
+    formula_chunks = [key for keys in pw.get_result(futures) for key in keys]
     append_pywren_stats(futures, memory=memory_capacity_mb,
-                        plus_objects=N_FORMULAS_SEGMENTS, minus_objects=len(adducts) * len(segments_n))
-
-    num_formulas = sum(formulas_nums)
-    n_formulas_chunks = sum([len(result) for result in results])
-    logger.info(f'Generated {num_formulas} formulas in {n_formulas_chunks} chunks')
-
-    formula_to_id_chunks_prefix = input_db["formula_to_id_chunks"]
-    clean_from_cos(config, bucket, formula_to_id_chunks_prefix)
-    formulas_bytes = 200 * num_formulas
-    formula_to_id_chunk_mb = 512
-    N_FORMULA_TO_ID = int(math.ceil(formulas_bytes / (formula_to_id_chunk_mb * 1024 ** 2)))
+                        plus_objects=len(formula_chunks) + len(segments_n) * (1 + len(databases) * len(modifiers)),
+                        minus_objects=len(adducts) * len(segments_n) + len(segments_n))
 
-    def store_formula_to_id_chunk(ch_i, ibm_cos):
-        print(f'Storing formula_to_id dictionary chunk {ch_i}')
-        start_id = (N_FORMULAS_SEGMENTS // N_FORMULA_TO_ID) * ch_i
-        end_id = (N_FORMULAS_SEGMENTS // N_FORMULA_TO_ID) * (ch_i + 1)
-        keys = [f'{formulas_chunks_prefix}/{formulas_chunk}.msgpack' for formulas_chunk in range(start_id, end_id)]
+    new_formulas_n = sum(formulas_nums.values())
+    logger.info(f'Generated {new_formulas_n} new formulas in {len(formula_chunks)} chunks')
 
-        def _get(key):
-            formula_chunk = read_object_with_retry(ibm_cos, bucket, key, pd.read_msgpack)
-            formula_to_id_chunk = dict(zip(formula_chunk.formula, formula_chunk.index))
-            return formula_to_id_chunk
+    def store_formula_index(db_i, mod_i, ibm_cos):
+        database, modifier = databases[db_i], modifiers[mod_i]
+        print(f'Storing formula index of {database} with modifier "{modifier}"')
+        parts_prefix = f'{formulas_chunks_prefix}_rankings/chunk/{db_i}_{mod_i}/'
+        keys = list_keys(bucket, parts_prefix, ibm_cos)
 
-        with ThreadPoolExecutor(max_workers=128) as pool:
-            results = list(pool.map(_get, keys))
-
-        formula_to_id = {}
-        for chunk_dict in results:
-            formula_to_id.update(chunk_dict)
+        # formula_i of every molecule for each adduct, or -1 if the ion formula is invalid
+        formula_is = np.full((len(adducts), mols_n[db_i]), -1, dtype=np.int32)
+        for key in keys:
+            for adduct_i, mol_inds, part_formula_is in pickle.loads(read_object_with_retry(ibm_cos, bucket, key)):
+                formula_is[adduct_i, mol_inds] = part_formula_is
 
         ibm_cos.put_object(Bucket=bucket,
-                           Key=f'{formula_to_id_chunks_prefix}/{ch_i}.msgpack',
-                           Body=msgpack.dumps(formula_to_id))
-
-    pw = pywren.ibm_cf_executor(config=config)
-    safe_mb = 512
-    memory_capacity_mb = formula_to_id_chunk_mb * 2 + safe_mb
-    futures = pw.map(store_formula_to_id_chunk, range(N_FORMULA_TO_ID), runtime_memory=memory_capacity_mb)
+                           Key=get_formula_index_key(formulas_chunks_prefix, database, modifier),
+                           Body=msgpack.dumps({'adducts': adducts, 'formula_is': formula_is}))
+        clean_from_cos(config, bucket, parts_prefix, ibm_cos)
+
+    pw = get_executor(config)
+    memory_capacity_mb = 1024
+    groups = list(product(range(len(databases)), range(len(modifiers))))
+    futures = pw.map(store_formula_index, groups, runtime_memory=memory_capacity_mb)
     pw.get_result(futures)
-    append_pywren_stats(futures, memory=memory_capacity_mb, plus_objects=N_FORMULA_TO_ID)
-    logger.info(f'Built {N_FORMULA_TO_ID} formula_to_id dictionaries chunks')
-
+    append_pywren_stats(futures, memory=memory_capacity_mb,
+                        plus_objects=len(groups), minus_objects=len(groups) * len(segments_n))
+    logger.info(f'Built {len(groups)} formula indices for FDR rankings')
+
+    # The manifest is only updated once everything has been stored, so that an interrupted build is repeated
+    superseded_tables = [segment_table_key(segm_i, segment_tables[segm_i])
+                         for segm_i in segments_n if segm_i in segment_tables]
+    segment_tables.update((segm_i, generation) for segm_i in segments_n)
+    manifest['databases'].update((database, databases_hashes[database]) for database in databases)
+    manifest.update(generation=generation,
+                    formulas_n=formulas_n_before + new_formulas_n,
+                    segment_tables={str(segm_i): table_generation
+                                    for segm_i, table_generation in sorted(segment_tables.items())},
+                    formula_chunks=manifest['formula_chunks'] + formula_chunks)
+    write_manifest(ibm_cos, bucket, manifest_key, manifest)
+    if superseded_tables:
+        ibm_cos.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': key} for key in superseded_tables]})
+
+    num_formulas = manifest['formulas_n']
+    n_formulas_chunks = len(manifest['formula_chunks'])
+    logger.info(f'Database has {num_formulas} formulas in {n_formulas_chunks} chunks')
     return num_formulas, n_formulas_chunks
 
 
 def calculate_centroids(config, input_db, polarity='+', isocalc_sigma=0.001238):
+    """ Calculates the isotopic peaks of all formulas built by `build_database`.
+
+    Centroids are cached by a manifest that records the formulas build, polarity and sigma they were calculated for
+    and the formulas chunks that are already done, so that only the chunks appended by later builds are calculated.
+    Isotope patterns are additionally cached per formula in `input_db['isocalc_cache']`
+    (`<formulas_chunks directory>/isocalc_cache` by default), which is shared by all builds and databases.
+    """
     bucket = config["storage"]["db_bucket"]
     formulas_chunks_prefix = input_db["formulas_chunks"]
     centroids_chunks_prefix = input_db["centroids_chunks"]
-    clean_from_cos(config, bucket, centroids_chunks_prefix)
+    manifest_key = f'{centroids_chunks_prefix}_manifest.json'
+    isocalc_cache_prefix = input_db.get('isocalc_cache', str(Path(formulas_chunks_prefix).parent / 'isocalc_cache'))
 
-    def calculate_peaks_for_formula(formula_i, formula):
-        mzs, ints = isocalc_wrapper.centroids(formula)
-        if mzs is not None:
-            return list(zip(repeat(formula_i), range(len(mzs)), mzs, ints))
-        else:
-            return []
-
-    def calculate_peaks_chunk(obj, id, ibm_cos):
+    ibm_cos = get_ibm_cos_client(config)
+    formulas_manifest = read_manifest(ibm_cos, bucket, f'{formulas_chunks_prefix}_manifest.json')
+    if formulas_manifest is None:
+        raise Exception(f'Formulas in {formulas_chunks_prefix} have not been built, run build_database first')
+
+    centroids_config = {'build_id': formulas_manifest['build_id'],
+                        'polarity': polarity,
+                        'isocalc_sigma': float(f"{isocalc_sigma:f}")}
+    manifest = read_manifest(ibm_cos, bucket, manifest_key)
+    if manifest is None or manifest['config_hash'] != content_hash(centroids_config):
+        logger.info('Calculating centroids from scratch')
+        # also removes the manifest, which shares the prefix
+        clean_from_cos(config, bucket, centroids_chunks_prefix)
+        manifest = {'config_hash': content_hash(centroids_config), **centroids_config, 'centroids_chunks': {}}
+
+    formula_chunks = [key for key in formulas_manifest['formula_chunks'] if key not in manifest['centroids_chunks']]
+
+    def create_isocalc_cache(ibm_cos):
+        return IsotopePatternCache(ibm_cos, bucket, isocalc_cache_prefix,
+                                   isocalc_wrapper.charge, isocalc_wrapper.sigma, isocalc_wrapper.n_peaks)
+
+    def calculate_peaks_chunk(obj, ibm_cos):
         print(f'Calculating peaks from formulas chunk {obj.key}')
-        chunk_df = pd.read_msgpack(obj.data_stream._raw_stream)
-        peaks = [peak for formula_i, formula in chunk_df.formula.items()
-                 for peak in calculate_peaks_for_formula(formula_i, formula)]
-        peaks_df = pd.DataFrame(peaks, columns=['formula_i', 'peak_i', 'mz', 'int'])
-        peaks_df.set_index('formula_i', inplace=True)
-
-        print(f'Storing centroids chunk {id}')
-        centroids_chunk_key = f'{centroids_chunks_prefix}/{id}.msgpack'
-        ibm_cos.put_object(Bucket=bucket, Key=centroids_chunk_key, Body=peaks_df.to_msgpack())
-
-        return peaks_df.shape[0]
-
-    from annotation_pipeline.isocalc_wrapper import IsocalcWrapper # Import lazily so that the rest of the pipeline still works if the dependency is missing
-    isocalc_wrapper = IsocalcWrapper({
-        # These instrument settings are usually customized on a per-dataset basis out of a set of
-        # 18 possible combinations, but most of EMBL's datasets are compatible with the following settings:
-        'charge': {
-            'polarity': polarity,
-            'n_charges': 1,
-        },
-        'isocalc_sigma': float(f"{isocalc_sigma:f}") # Rounding to match production implementation
-    })
-
-    pw = pywren.ibm_cf_executor(config=config)
-    memory_capacity_mb = 2048
-    futures = pw.map(calculate_peaks_chunk, f'{bucket}/{formulas_chunks_prefix}/', runtime_memory=memory_capacity_mb)
-    centroids_chunks_n = pw.get_result(futures)
-    append_pywren_stats(futures, memory=memory_capacity_mb, plus_objects=len(futures))
-
-    num_centroids = sum(centroids_chunks_n)
-    n_centroids_chunks = len(centroids_chunks_n)
+        with span('download', key=obj.key):
+            chunk_df = pd.read_msgpack(obj.data_stream._raw_stream)
+            count_stream(obj.data_stream)
+            # formulas chunks are split from hash segments, so usually only one cache shard has to be loaded
+            isocalc_cache = create_isocalc_cache(ibm_cos)
+            isocalc_cache.load_shards(set(map(hash_formula_to_segment, chunk_df.formula)))
+        with span('compute', formulas=len(chunk_df)) as span_args:
+            mzs, ints = isocalc_cache.centroids(chunk_df.formula.values, isocalc_wrapper.centroids_batch)
+            span_args.update(cache_hits=isocalc_cache.hits, cache_misses=isocalc_cache.misses)
+        with span('upload'):
+            isocalc_cache.store_new(hash_formula_to_segment)
+        print(f'Isotope pattern cache: {isocalc_cache.hits} hits, {isocalc_cache.misses} misses')
+
+        with span('encode'):
+            valid = ~np.isnan(mzs[:, 0])
+            n_peaks = mzs.shape[1]
+            peaks_df = pd.DataFrame({'formula_i': np.repeat(chunk_df.index.values[valid], n_peaks),
+                                     'peak_i': np.tile(np.arange(n_peaks), valid.sum()),
+                                     'mz': mzs[valid].ravel(),
+                                     'int': ints[valid].ravel()},
+                                    columns=['formula_i', 'peak_i', 'mz', 'int'])
+            peaks_df.set_index('formula_i', inplace=True)
+            body = peaks_df.to_msgpack()
+
+        centroids_chunk_key = f'{centroids_chunks_prefix}/{Path(obj.key).stem}.msgpack'
+        print(f'Storing centroids chunk {centroids_chunk_key}')
+        with span('upload'):
+            ibm_cos.put_object(Bucket=bucket, Key=centroids_chunk_key, Body=body)
+
+        return obj.key, peaks_df.shape[0], isocalc_cache.hits, isocalc_cache.misses
+
+    def compact_isocalc_cache_shard(shard_i, ibm_cos):
+        print(f'Compacting isotope pattern cache shard {shard_i}')
+        return create_isocalc_cache(ibm_cos).compact(shard_i)
+
+    if formula_chunks:
+        # Import lazily so that the rest of the pipeline still works if the dependency is missing
+        from annotation_pipeline.isocalc_wrapper import IsocalcWrapper
+        isocalc_wrapper = IsocalcWrapper({
+            # These instrument settings are usually customized on a per-dataset basis out of a set of
+            # 18 possible combinations, but most of EMBL's datasets are compatible with the following settings:
+            'charge': {
+                'polarity': polarity,
+                'n_charges': 1,
+            },
+            'isocalc_sigma': centroids_config['isocalc_sigma'] # Rounding to match production implementation
+        })
+
+        pw = get_executor(config)
+        memory_capacity_mb = 2048
+        futures = pw.map(calculate_peaks_chunk, [f'{bucket}/{key}' for key in formula_chunks],
+                         runtime_memory=memory_capacity_mb)
+        results = pw.get_result(futures)
+        append_pywren_stats(futures, memory=memory_capacity_mb, plus_objects=len(futures))
+        manifest['centroids_chunks'].update((key, centroids_n) for key, centroids_n, _, _ in results)
+        write_manifest(ibm_cos, bucket, manifest_key, manifest)
+        hits, misses = sum(result[2] for result in results), sum(result[3] for result in results)
+        logger.info(f'Calculated centroids of {len(formula_chunks)} formulas chunks, '
+                    f'isotope pattern cache: {hits} hits, {misses} misses')
+
+        shards = create_isocalc_cache(ibm_cos).shards_with_deltas()
+        if shards:
+            memory_capacity_mb = 2048
+            futures = pw.map(compact_isocalc_cache_shard, shards, runtime_memory=memory_capacity_mb)
+            cached_n = sum(pw.get_result(futures))
+            append_pywren_stats(futures, memory=memory_capacity_mb, minus_objects=len(futures))
+            logger.info(f'Compacted {len(shards)} isotope pattern cache shards with {cached_n} formulas')
+    else:
+        logger.info('Centroids are up to date')
+
+    num_centroids = sum(manifest['centroids_chunks'].values())
+    n_centroids_chunks = len(manifest['centroids_chunks'])
     logger.info(f'Calculated {num_centroids} centroids in {n_centroids_chunks} chunks')
     return num_centroids, n_centroids_chunks
 
@@ -1,20 +1,25 @@
 import pickle
-from itertools import chain
-
-import pywren_ibm_cloud as pywren
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
 from pyimzml.ImzMLParser import ImzMLParser
 import pandas as pd
 import numpy as np
 
+from annotation_pipeline.checkpoint import RunCheckpoint
+from annotation_pipeline.ds_cache import DatasetSegmentsCache, dataset_fingerprint, get_ds_segments_key
+from annotation_pipeline.executor import get_executor, is_memory_error, iter_completed, CloudObject
 from annotation_pipeline.check_results import get_reference_results, check_results, log_bad_results
-from annotation_pipeline.fdr import build_fdr_rankings, calculate_fdrs
-from annotation_pipeline.image import create_process_segment
+from annotation_pipeline.fdr import calculate_fdrs, MsmVector
+from annotation_pipeline.image import create_process_segment, plan_memory_tiers
 from annotation_pipeline.segment import define_ds_segments, chunk_spectra, segment_spectra, segment_centroids, \
     clip_centr_df, define_centr_segments
-from annotation_pipeline.utils import ds_imzml_path, clean_from_cos, append_pywren_stats
+from annotation_pipeline.utils import ds_imzml_path, clean_from_cos, append_pywren_stats, read_object_with_retry, \
+    get_ibm_cos_client, list_keys, content_hash, read_manifest
 from annotation_pipeline.utils import logger
 
+STAGES = ['split_ds', 'segment_ds', 'segment_centroids', 'annotate', 'run_fdr']
+
 
 class Pipeline(object):
 
@@ -24,9 +29,24 @@ class Pipeline(object):
         self.input_data = input_config['dataset']
         self.input_db = input_config['molecular_db']
         self.output = input_config['output']
-        self.pywren_executor = pywren.ibm_cf_executor(config=self.config, runtime_memory=2048)
+        self.pywren_executor = get_executor(self.config, runtime_memory=2048)
+        self.ibm_cos = get_ibm_cos_client(self.config)
+        # Not under the formula images prefix, which is cleaned by `annotate`
+        checkpoint_prefix = self.output.get('run_checkpoint',
+                                            str(Path(self.output['formula_images']).parent / 'run_checkpoint'))
+        self.checkpoint = RunCheckpoint(self.ibm_cos, self.storage['output_bucket'], checkpoint_prefix, STAGES)
+        # Dataset segments are stored under a key of the dataset's contents, so that they can be reused by later runs
+        self.ds_segments_cache = DatasetSegmentsCache(self.ibm_cos, self.storage['ds_bucket'],
+                                                      self.input_data['ds_segments'],
+                                                      **self.config.get('ds_segments_cache', {}))
+        self.use_ds_segments_cache = True
 
         self.ds_segm_size_mb = 100
+        # Annotation tasks run with the smallest of these that fits them, and are retried with the next one on OOM
+        self.annotate_memory_tiers_mb = [2048, 4096]
+        # Annotation tasks that run this many times longer than the median are speculatively duplicated,
+        # None disables it
+        self.annotate_speculative_slowdown = 3
         self.image_gen_config = {
             "q": 99,
             "do_preprocessing": False,
@@ -34,33 +54,170 @@ class Pipeline(object):
             "ppm": 3.0
         }
 
-    def __call__(self, *args, **kwargs):
+    def __call__(self, resume=True):
+        """ Runs all stages. With `resume`, stages that completed in a previous run with the same inputs are restored
+        from the run checkpoint instead, and the pipeline resumes at the first stage that didn't.
+        """
         self.load_ds()
-        self.split_ds()
-        self.segment_ds()
-        self.segment_centroids()
-        self.annotate()
-        self.run_fdr()
+        resume_stage_i = self.restore_checkpoint() if resume else 0
+        for stage in STAGES[resume_stage_i:]:
+            getattr(self, stage)()
 
     def load_ds(self):
-        self.imzml_parser = ImzMLParser(ds_imzml_path(self.input_data['path']))
+        imzml_path = ds_imzml_path(self.input_data['path'])
+        self.imzml_parser = ImzMLParser(imzml_path)
         self.coordinates = [coo[:2] for coo in self.imzml_parser.coordinates]
         self.sp_n = len(self.coordinates)
         logger.info(f'Parsed imzml: {self.sp_n} spectra found')
+        self.ds_fingerprint = dataset_fingerprint(imzml_path)
+
+    @property
+    def ds_segments_key(self):
+        return get_ds_segments_key(self.ds_fingerprint, self.ds_segm_size_mb, self.imzml_parser.mzPrecision)
+
+    @property
+    def ds_segments_prefix(self):
+        return self.ds_segments_cache.segments_prefix(self.ds_segments_key)
+
+    def stage_fingerprint(self, stage):
+        """ Hash of everything the outputs of `stage` depend on, including the fingerprint of the previous stage """
+        if stage == 'split_ds':
+            return content_hash(self.ds_fingerprint, self.input_data['ds_segments'], self.ds_segm_size_mb)
+        previous = self.stage_fingerprint(STAGES[STAGES.index(stage) - 1])
+        if stage == 'segment_ds':
+            return content_hash(previous)
+        if stage == 'segment_centroids':
+            centroids_manifest = read_manifest(self.ibm_cos, self.storage['db_bucket'],
+                                               f'{self.input_db["centroids_chunks"]}_manifest.json')
+            return content_hash(previous, centroids_manifest, self.input_db['centroids_chunks'],
+                                self.input_db['clipped_centroids_chunks'], self.input_db['centroids_segments'],
+                                self.image_gen_config['ppm'])
+        if stage == 'annotate':
+            return content_hash(previous, self.image_gen_config, self.output['formula_images'])
+        if stage == 'run_fdr':
+            # Rankings use the formula indices of the databases, which are rewritten by every build that changes them
+            formulas_manifest = read_manifest(self.ibm_cos, self.storage['db_bucket'],
+                                              f'{self.input_db["formulas_chunks"]}_manifest.json') or {}
+            return content_hash(previous, formulas_manifest.get('databases'), formulas_manifest.get('generation'),
+                                self.input_db['databases'], self.input_db['adducts'], self.input_db['modifiers'],
+                                self.input_data['num_decoys'])
+
+    def save_checkpoint(self, stage, outputs):
+        self.checkpoint.save(stage, self.stage_fingerprint(stage), outputs)
+
+    def _restore_stage(self, stage, outputs):
+        if stage == 'split_ds':
+            self.ds_segments_bounds = np.array(outputs['ds_segments_bounds'])
+            self.ds_segm_parts_n = outputs['ds_segm_parts_n']
+            self.ds_segments_cached = outputs['ds_segments_cached']
+        elif stage == 'segment_ds':
+            self.ds_segm_n, self.ds_segms_len = outputs['ds_segm_n'], outputs['ds_segms_len']
+        elif stage == 'segment_centroids':
+            self.centr_n = outputs['centr_n']
+            self.centr_segm_lower_bounds = np.array(outputs['centr_segm_lower_bounds'])
+            self.centr_segm_n = outputs['centr_segm_n']
+            self.centr_segm_mz_ranges = {int(segm_i): tuple(mz_range)
+                                         for segm_i, mz_range in outputs['centr_segm_mz_ranges'].items()}
+        elif stage == 'annotate':
+            self.formula_metrics_objs = [CloudObject(bucket, key) for bucket, key in outputs['formula_metrics']]
+            self.msm_obj = CloudObject(*outputs['msm'])
+            self.images_cloud_objs = [CloudObject(bucket, key) for bucket, key in outputs['images']]
+            self._formula_metrics_df = None
+        elif stage == 'run_fdr':
+            self.fdrs = self.checkpoint.get_object(outputs['fdrs'])
+
+    def _stage_outputs_exist(self, stage, outputs, next_stage_skipped):
+        if stage == 'split_ds':
+            # Segment parts are removed once `segment_ds` has merged them, so they are only needed if it runs again
+            if next_stage_skipped:
+                return True
+            if outputs['ds_segments_cached']:
+                return self.ds_segments_cache.get(self.ds_segments_key) is not None
+            keys = list_keys(self.storage['ds_bucket'], f'{self.ds_segments_prefix}/chunk/', self.ibm_cos)
+            return len(keys) == outputs['ds_segm_parts_n']
+        if stage == 'segment_ds':
+            keys = set(list_keys(self.storage['ds_bucket'], f'{self.ds_segments_prefix}/', self.ibm_cos))
+            return all(f'{self.ds_segments_prefix}/{segm_i}.segm' in keys for segm_i in range(outputs['ds_segm_n']))
+        if stage == 'segment_centroids':
+            keys = set(list_keys(self.storage['db_bucket'], f'{self.input_db["centroids_segments"]}/', self.ibm_cos))
+            return all(f'{self.input_db["centroids_segments"]}/{segm_i}.msgpack' in keys
+                       for segm_i in outputs['centr_segm_mz_ranges'])
+        if stage == 'annotate':
+            keys = set(list_keys(self.storage['output_bucket'], f'{self.output["formula_images"]}/', self.ibm_cos))
+            return all(key in keys for _, key in [*outputs['formula_metrics'], outputs['msm'], *outputs['images']])
+        if stage == 'run_fdr':
+            return outputs['fdrs'] in list_keys(self.storage['output_bucket'], outputs['fdrs'], self.ibm_cos)
+
+    def restore_checkpoint(self):
+        """ Restores the outputs of the leading stages whose fingerprint matches the run checkpoint and whose outputs
+        still exist in COS
+
+        Returns
+        -----
+            int: index in STAGES of the first stage that has to run
+        """
+        stages_outputs = []
+        for stage in STAGES:
+            outputs = self.checkpoint.get(stage, self.stage_fingerprint(stage))
+            if outputs is None:
+                break
+            stages_outputs.append(outputs)
+
+        resume_stage_i = len(stages_outputs)
+        for stage_i, outputs in enumerate(stages_outputs):
+            if not self._stage_outputs_exist(STAGES[stage_i], outputs, True):
+                logger.info(f'Outputs of stage {STAGES[stage_i]} are missing')
+                resume_stage_i = stage_i
+                break
+        # The first stage that runs may need outputs that are only kept until the stage after them completes
+        while resume_stage_i > 0 and not self._stage_outputs_exist(STAGES[resume_stage_i - 1],
+                                                                   stages_outputs[resume_stage_i - 1], False):
+            resume_stage_i -= 1
+            logger.info(f'Outputs of stage {STAGES[resume_stage_i]} are missing')
+
+        for stage, outputs in zip(STAGES, stages_outputs[:resume_stage_i]):
+            self._restore_stage(stage, outputs)
+            logger.info(f'Restored stage {stage} from checkpoint')
+        if resume_stage_i < len(STAGES):
+            logger.info(f'Resuming at stage {STAGES[resume_stage_i]}')
+        return resume_stage_i
 
     def split_ds(self):
-        clean_from_cos(self.config, self.config["storage"]["ds_bucket"], self.input_data["ds_chunks"])
-        self.specra_chunks_keys = chunk_spectra(self.config, self.input_data, self.imzml_parser, self.coordinates)
+        cached = self.ds_segments_cache.get(self.ds_segments_key) if self.use_ds_segments_cache else None
+        self.ds_segments_cached = cached is not None
+        if cached:
+            logger.info(f'Reusing {cached["ds_segm_n"]} cached dataset segments from {self.ds_segments_prefix}')
+            self.ds_segments_bounds = np.array(cached['ds_segments_bounds'])
+            self.ds_segm_parts_n = 0
+            self.ds_segm_n, self.ds_segms_len = cached['ds_segm_n'], cached['ds_segms_len']
+        else:
+            clean_from_cos(self.config, self.config["storage"]["ds_bucket"], f'{self.ds_segments_prefix}/')
+            self.ds_segments_cache.start(self.ds_segments_key)
+            sample_sp_n = 1000
+            self.ds_segments_bounds = define_ds_segments(self.imzml_parser, self.ds_segm_size_mb,
+                                                         sample_ratio=sample_sp_n / self.sp_n)
+            input_data = dict(self.input_data, ds_segments=self.ds_segments_prefix)
+            self.ds_segm_parts_n = chunk_spectra(self.config, input_data, self.imzml_parser, self.coordinates,
+                                                 self.ds_segments_bounds)
+        self.save_checkpoint('split_ds', {'ds_segments_bounds': self.ds_segments_bounds.tolist(),
+                                          'ds_segm_parts_n': self.ds_segm_parts_n,
+                                          'ds_segments_cached': self.ds_segments_cached})
 
     def segment_ds(self):
-        clean_from_cos(self.config, self.config["storage"]["ds_bucket"], self.input_data["ds_segments"])
-        sample_sp_n = 1000
-        self.ds_segments_bounds = define_ds_segments(self.imzml_parser, self.ds_segm_size_mb,
-                                                     sample_ratio=sample_sp_n / self.sp_n)
-        self.ds_segm_n, self.ds_segms_len = segment_spectra(self.pywren_executor, self.config["storage"]["ds_bucket"],
-                                            self.input_data["ds_chunks"], self.input_data["ds_segments"],
-                                            self.ds_segments_bounds, self.ds_segm_size_mb, self.imzml_parser.mzPrecision)
-        logger.info(f'Segmented dataset chunks into {self.ds_segm_n} segments')
+        if self.ds_segments_cached:
+            cached = self.ds_segments_cache.get(self.ds_segments_key)
+            self.ds_segm_n, self.ds_segms_len = cached['ds_segm_n'], cached['ds_segms_len']
+        else:
+            self.ds_segm_n, self.ds_segms_len = segment_spectra(self.pywren_executor,
+                                                                self.config["storage"]["ds_bucket"],
+                                                                self.ds_segments_prefix, len(self.ds_segments_bounds),
+                                                                self.ds_segm_size_mb, self.imzml_parser.mzPrecision,
+                                                                self.ds_segm_parts_n)
+            self.ds_segments_cache.put(self.ds_segments_key, self.ds_segments_bounds, self.ds_segms_len,
+                                       self.imzml_parser.mzPrecision)
+            logger.info(f'Segmented dataset chunks into {self.ds_segm_n} segments')
+        self.save_checkpoint('segment_ds', {'ds_segm_n': self.ds_segm_n,
+                                            'ds_segms_len': [int(segm_len) for segm_len in self.ds_segms_len]})
 
     def segment_centroids(self):
         mz_min, mz_max = self.ds_segments_bounds[0, 0], self.ds_segments_bounds[-1, 1]
@@ -73,41 +230,115 @@ class Pipeline(object):
         clean_from_cos(self.config, self.config["storage"]["db_bucket"], self.input_db["centroids_segments"])
         self.centr_segm_lower_bounds = define_centr_segments(self.pywren_executor, self.config["storage"]["db_bucket"],
                                                              self.input_db["clipped_centroids_chunks"], self.centr_n,
-                                                             self.ds_segm_n, self.ds_segm_size_mb)
-        self.centr_segm_n = segment_centroids(self.pywren_executor, self.config["storage"]["db_bucket"],
-                                              self.input_db["clipped_centroids_chunks"],
-                                              self.input_db["centroids_segments"], self.centr_segm_lower_bounds)
+                                                             self.ds_segm_n, self.ds_segm_size_mb,
+                                                             self.ds_segments_bounds, self.ds_segms_len,
+                                                             self.image_gen_config['ppm'])
+        self.centr_segm_n, self.centr_segm_mz_ranges = segment_centroids(self.pywren_executor,
+                                                                         self.config["storage"]["db_bucket"],
+                                                                         self.input_db["clipped_centroids_chunks"],
+                                                                         self.input_db["centroids_segments"],
+                                                                         self.centr_segm_lower_bounds)
         logger.info(f'Segmented centroids chunks into {self.centr_segm_n} segments')
+        self.save_checkpoint('segment_centroids', {
+            'centr_n': int(self.centr_n),
+            'centr_segm_lower_bounds': np.asarray(self.centr_segm_lower_bounds).tolist(),
+            'centr_segm_n': self.centr_segm_n,
+            'centr_segm_mz_ranges': {str(segm_i): [float(mz) for mz in mz_range]
+                                     for segm_i, mz_range in self.centr_segm_mz_ranges.items()},
+        })
 
     def annotate(self):
         logger.info('Annotating...')
         clean_from_cos(self.config, self.config["storage"]["output_bucket"], self.output["formula_images"])
 
-        memory_capacity_mb = 2048  # TODO: Detect when this isn't enough and bump it up to 4096
-        process_centr_segment = create_process_segment(self.config["storage"]["ds_bucket"],
-                                                       self.config["storage"]["output_bucket"],
-                                                       self.input_data["ds_segments"],
-                                                       self.ds_segments_bounds, self.ds_segms_len, self.coordinates,
-                                                       self.image_gen_config, memory_capacity_mb, self.ds_segm_size_mb,
-                                                       self.imzml_parser.mzPrecision)
+        memory_tiers_mb = sorted(self.annotate_memory_tiers_mb)
+        pending = plan_memory_tiers(self.centr_segm_mz_ranges, self.ds_segments_bounds, self.ds_segms_len,
+                                    self.image_gen_config['ppm'], self.ds_segm_size_mb, self.imzml_parser.mzPrecision,
+                                    memory_tiers_mb)
+        logger.info('Centroids segments per memory tier: ' +
+                    ', '.join(f'{memory_mb}MB: {len(segm_ids)}' for memory_mb, segm_ids in sorted(pending.items())))
+
+        # Only the MSM of every segment is kept as segments complete, their metrics are loaded when needed
+        msm_vector = MsmVector()
+        self.formula_metrics_objs, self.images_cloud_objs = [], []
+        self._formula_metrics_df = None
+        while pending:
+            # Submit all tiers before waiting for any of them, so that they run concurrently
+            calls = []
+            for memory_mb, segm_ids in sorted(pending.items()):
+                process_centr_segment = create_process_segment(self.config["storage"]["ds_bucket"],
+                                                               self.config["storage"]["output_bucket"],
+                                                               self.ds_segments_prefix,
+                                                               self.ds_segments_bounds, self.ds_segms_len,
+                                                               self.coordinates, self.image_gen_config, memory_mb,
+                                                               self.ds_segm_size_mb, self.imzml_parser.mzPrecision,
+                                                               self.output["formula_images"])
+                centr_segm_keys = [f'{self.config["storage"]["db_bucket"]}/{self.input_db["centroids_segments"]}/'
+                                   f'{segm_i}.msgpack' for segm_i in segm_ids]
+                futures = self.pywren_executor.map(process_centr_segment, centr_segm_keys, runtime_memory=memory_mb)
+                calls.extend(zip([memory_mb] * len(segm_ids), segm_ids, centr_segm_keys,
+                                 [process_centr_segment] * len(segm_ids), futures))
+
+            def resubmit(call_i):
+                # Copies are only submitted once every call has started. The local executor counts them towards
+                # its concurrency and memory limits, while PyWren invokes them right away, as no calls are queued
+                memory_mb, segm_i, centr_segm_key, process_centr_segment, _ = calls[call_i]
+                logger.info(f'Speculatively resubmitting centroids segment {segm_i}')
+                return self.pywren_executor.map(process_centr_segment, [centr_segm_key], runtime_memory=memory_mb)[0]
+
+            pending = {}
+            tier_futures, tier_objects_n = {}, {}
+            for call_i, future in iter_completed(self.pywren_executor, [call[-1] for call in calls],
+                                                 resubmit if self.annotate_speculative_slowdown else None,
+                                                 slowdown=self.annotate_speculative_slowdown or 0):
+                memory_mb, segm_i = calls[call_i][:2]
+                try:
+                    # PyWren returns a list of results for a single future, as the last call was a map
+                    formula_metrics_obj, formula_is, msm, cloud_objs = self.pywren_executor.get_result([future])[0]
+                    msm_vector.add(formula_is, msm)
+                    self.formula_metrics_objs.append(formula_metrics_obj)
+                    self.images_cloud_objs.extend(cloud_objs)
+                    tier_futures.setdefault(memory_mb, []).append(future)
+                    tier_objects_n[memory_mb] = tier_objects_n.get(memory_mb, 0) + len(cloud_objs) + 1
+                except Exception as ex:
+                    next_memory_mb = next((tier_mb for tier_mb in memory_tiers_mb if tier_mb > memory_mb), None)
+                    if not is_memory_error(ex) or next_memory_mb is None:
+                        raise
+                    logger.warning(f'Centroids segment {segm_i} ran out of memory with {memory_mb}MB, '
+                                   f'retrying with {next_memory_mb}MB')
+                    pending.setdefault(next_memory_mb, []).append(segm_i)
+
+            for memory_mb, futures in tier_futures.items():
+                append_pywren_stats(futures, memory=memory_mb, plus_objects=tier_objects_n[memory_mb])
+
+        self.msm_obj = msm_vector.save(self.ibm_cos, self.config["storage"]["output_bucket"],
+                                       f'{self.output["formula_images"]}/msm.msgpack')
+        logger.info(f'Metrics calculated: {msm_vector.scored_n}')
+        self.save_checkpoint('annotate', {
+            'formula_metrics': [[cloud_obj.bucket, cloud_obj.key] for cloud_obj in self.formula_metrics_objs],
+            'msm': [self.msm_obj.bucket, self.msm_obj.key],
+            'images': [[cloud_obj.bucket, cloud_obj.key] for cloud_obj in self.images_cloud_objs],
+        })
 
-        futures = self.pywren_executor.map(process_centr_segment, f'{self.config["storage"]["db_bucket"]}/{self.input_db["centroids_segments"]}/',
-                                           runtime_memory=memory_capacity_mb)
-        formula_metrics_list, images_cloud_objs = zip(*self.pywren_executor.get_result(futures))
-        self.formula_metrics_df = pd.concat(formula_metrics_list)
-        self.images_cloud_objs = list(chain(*images_cloud_objs))
-        append_pywren_stats(futures, memory=memory_capacity_mb, plus_objects=len(self.images_cloud_objs))
+    @property
+    def formula_metrics_df(self):
+        """ Metrics of all scored formulas, which are loaded from the objects stored by the annotation tasks """
+        if self._formula_metrics_df is None:
+            def read_metrics(cloud_obj):
+                return pickle.loads(read_object_with_retry(self.ibm_cos, cloud_obj.bucket, cloud_obj.key))
 
-        logger.info(f'Metrics calculated: {self.formula_metrics_df.shape[0]}')
+            with ThreadPoolExecutor(max_workers=128) as pool:
+                self._formula_metrics_df = pd.concat(list(pool.map(read_metrics, self.formula_metrics_objs)))
+        return self._formula_metrics_df
 
     def run_fdr(self):
-        self.rankings_df = build_fdr_rankings(self.pywren_executor, self.config["storage"]["db_bucket"],
-                                              self.input_data, self.input_db, self.formula_metrics_df)
-        self.fdrs = calculate_fdrs(self.pywren_executor, self.config['storage']['ds_bucket'], self.rankings_df)
+        self.fdrs = calculate_fdrs(self.pywren_executor, self.config["storage"]["db_bucket"],
+                                   self.input_data, self.input_db, self.msm_obj)
 
         logger.info(f'Number of annotations at with FDR less than:')
         for fdr_step in [0.05, 0.1, 0.2, 0.5]:
             logger.info(f'{fdr_step*100:2.0f}%: {(self.fdrs.fdr < fdr_step).sum()}')
+        self.save_checkpoint('run_fdr', {'fdrs': self.checkpoint.put_object('fdrs', self.fdrs)})
 
     def get_results(self):
         results_df = self.formula_metrics_df.merge(self.fdrs, left_index=True, right_index=True)
@@ -120,9 +351,9 @@ class Pipeline(object):
         # Only download interesting images, to prevent running out of memory
         targets = set(self.results_df.index[self.results_df.fdr <= 0.5])
 
-        def get_target_images(internal_storage, images_obj):
+        def get_target_images(ibm_cos, images_obj):
             images = {}
-            segm_images = pickle.loads(internal_storage.get_object(images_obj))
+            segm_images = pickle.loads(read_object_with_retry(ibm_cos, images_obj.bucket, images_obj.key))
             for k, v in segm_images.items():
                 if k in targets:
                     images[k] = v
@@ -0,0 +1,183 @@
+import pickle
+import time
+from collections import OrderedDict
+from copy import deepcopy
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from annotation_pipeline.molecular_db import build_database, calculate_centroids
+from annotation_pipeline.pipeline import Pipeline
+from annotation_pipeline.storage import LocalCOSClient
+from annotation_pipeline.synthetic import generate_mol_db, write_imzml
+from annotation_pipeline.utils import logger, get_ibm_cos_client, list_keys, read_object_with_retry, \
+    CF_PRICE_PER_GB_S, PYWREN_STATS
+
+STAGES = ['load_ds', 'split_ds', 'segment_ds', 'segment_centroids', 'annotate', 'run_fdr']
+MAP_TOTALS = ['actions', 'gb_seconds', 'plus_objects', 'minus_objects',
+              'cos_requests', 'cos_bytes_read', 'cos_bytes_written']
+
+
+def prepare_databases(config, input_config):
+    """ Builds the formulas and centroids of the input config's databases, if they aren't cached already """
+    input_db, input_data = input_config['molecular_db'], input_config['dataset']
+    build_database(config, input_db)
+    calculate_centroids(config, input_db, input_data['polarity'], input_data['isocalc_sigma'])
+
+
+def synthetic_input_config(config, work_dir, nrows, ncols, peaks_n, dbs_n, mols_n=5000, planted_formulas_n=500):
+    """ Creates a synthetic case: `dbs_n` random databases with their formulas and centroids, and a dataset with
+    the centroids of `planted_formulas_n` of their formulas, so that the pipeline finds real annotations.
+    Databases and datasets are reused by cases with the same parameters.
+
+    Returns
+    -----
+        dict: input config of the case
+    """
+    db_bucket = config['storage']['db_bucket']
+    db_prefix = f'scaling/dbs_{dbs_n}_mols_{mols_n}'
+    case = f'{nrows}x{ncols}x{peaks_n}_dbs_{dbs_n}'
+    input_config = {
+        'dataset': {'path': str(Path(work_dir) / 'datasets' / f'{nrows}x{ncols}x{peaks_n}_dbs_{dbs_n}'),
+                    'ds_segments': f'scaling/tmp/{case}/ds_segments',
+                    'num_decoys': 20,
+                    'polarity': '+',
+                    'isocalc_sigma': 0.001238},
+        'molecular_db': {'formulas_chunks': f'{db_prefix}/formulas_chunks',
+                         'centroids_chunks': f'{db_prefix}/centroids_chunks',
+                         'clipped_centroids_chunks': f'scaling/tmp/{case}/clipped_centroids_chunks',
+                         'centroids_segments': f'scaling/tmp/{case}/centroids_segments',
+                         'databases': [f'{db_prefix}/mol_db{db_i}.pickle' for db_i in range(dbs_n)],
+                         'adducts': ['+H', '+Na', '+K'],
+                         'modifiers': ['']},
+        'output': {'formula_images': f'scaling/tmp/{case}/formula_images'},
+    }
+
+    ibm_cos = get_ibm_cos_client(config)
+    for db_i, database in enumerate(input_config['molecular_db']['databases']):
+        ibm_cos.put_object(Bucket=db_bucket, Key=database, Body=pickle.dumps(generate_mol_db(mols_n, seed=db_i)))
+    prepare_databases(config, input_config)
+
+    imzml_path = Path(input_config['dataset']['path']) / 'ds.imzML'
+    if not imzml_path.exists():
+        centroids_key = list_keys(db_bucket, f'{input_config["molecular_db"]["centroids_chunks"]}/', ibm_cos)[0]
+        centr_df = read_object_with_retry(ibm_cos, db_bucket, centroids_key, pd.read_msgpack)
+        planted_formula_is = centr_df.index.unique()[:planted_formulas_n]
+        planted_mzs = centr_df.mz[centr_df.index.isin(planted_formula_is) & (centr_df.mz > 0)].values
+        imzml_path.parent.mkdir(parents=True, exist_ok=True)
+        write_imzml(imzml_path, nrows, ncols, peaks_n, mz_range=(100, 1000), planted_mzs=planted_mzs)
+
+    return input_config
+
+
+def run_case(config, input_config, workers=None):
+    """ Runs the whole pipeline and measures every stage
+
+    For each stage, `wall_s` is the time measured by the driver and `critical_path_s` is the sum of the longest call
+    of each of its maps, i.e. the time the stage would take with unlimited workers and no driver overhead.
+    Object storage requests and bytes are only available with `local_cos`.
+
+    Returns
+    -----
+        dict
+    """
+    config = deepcopy(config)
+    if workers:
+        config.setdefault('executor', {})['workers'] = workers
+
+    pipeline = Pipeline(config, input_config)
+    # Every run has to parse and segment the dataset, or later runs of the same case wouldn't measure it
+    pipeline.use_ds_segments_cache = False
+    stages = OrderedDict()
+    for stage in STAGES:
+        maps_start = len(PYWREN_STATS)
+        driver_cos_before = dict(LocalCOSClient.process_stats)
+        start = time.time()
+        getattr(pipeline, stage)()
+        wall_s = time.time() - start
+
+        maps = PYWREN_STATS[maps_start:]
+        stage_stats = OrderedDict([('wall_s', wall_s),
+                                   ('critical_path_s', sum(max(m['exec_times']) for m in maps)),
+                                   ('maps', len(maps))])
+        stage_stats.update((total, sum(m[total] for m in maps)) for total in MAP_TOTALS)
+        for stat, n in LocalCOSClient.process_stats.items():
+            stage_stats[f'cos_{stat}'] += n - driver_cos_before[stat]
+        stage_stats['cost_usd'] = stage_stats['gb_seconds'] * CF_PRICE_PER_GB_S
+        stages[stage] = stage_stats
+        logger.info(f'Stage {stage} took {wall_s:.2f}s')
+
+    return OrderedDict([('workers', workers),
+                        ('wall_s', sum(s['wall_s'] for s in stages.values())),
+                        ('gb_seconds', sum(s['gb_seconds'] for s in stages.values())),
+                        ('cost_usd', sum(s['cost_usd'] for s in stages.values())),
+                        ('annotations_fdr_10', int((pipeline.fdrs.fdr <= 0.1).sum())),
+                        ('stages', stages)])
+
+
+def run_grid(config, cases, workers_list):
+    """ Runs every case with every number of workers
+
+    Args
+    -----
+    config : dict
+    cases : list[tuple[str, dict, float]]
+        name, input config and work size (e.g. number of pixels times peaks per spectrum) of each case
+    workers_list : list[int]
+
+    Returns
+    -----
+        list[dict]: results of `run_case` with the case name, work size and number of databases
+    """
+    results = []
+    for name, input_config, work in cases:
+        for workers in workers_list:
+            logger.info(f'Running case {name} with {workers} workers')
+            result = run_case(config, input_config, workers)
+            result.update(case=name, work=work, dbs_n=len(input_config['molecular_db']['databases']))
+            results.append(result)
+    return results
+
+
+def results_to_df(results):
+    """ One row per case, number of workers and stage (plus a 'total' stage) """
+    rows = []
+    for result in results:
+        for stage, stats in result['stages'].items():
+            rows.append(OrderedDict([('case', result['case']), ('work', result['work']), ('dbs_n', result['dbs_n']),
+                                     ('workers', result['workers']), ('stage', stage), *stats.items()]))
+        rows.append(OrderedDict([('case', result['case']), ('work', result['work']), ('dbs_n', result['dbs_n']),
+                                 ('workers', result['workers']), ('stage', 'total'), ('wall_s', result['wall_s']),
+                                 ('gb_seconds', result['gb_seconds']), ('cost_usd', result['cost_usd'])]))
+    return pd.DataFrame(rows)
+
+
+def _efficiency_table(df, group_cols, baseline_workers_scale):
+    tables = []
+    for _, group in df.groupby(group_cols):
+        if group.workers.nunique() < 2:
+            continue
+        base = group[group.workers == group.workers.min()].set_index('stage').wall_s
+        group = group.assign(speedup=base.reindex(group.stage).values / group.wall_s.values)
+        group['efficiency'] = group.speedup / (group.workers / group.workers.min() if baseline_workers_scale else 1)
+        tables.append(group)
+    if not tables:
+        return pd.DataFrame()
+    table = pd.concat(tables).pivot_table(index=[*group_cols, 'workers'], columns='stage', values='efficiency')
+    table = table[[stage for stage in [*STAGES, 'total'] if stage in table.columns]]
+    table['first_to_stop_scaling'] = table[[stage for stage in STAGES if stage in table.columns]].idxmin(axis=1)
+    return table
+
+
+def strong_scaling_table(df):
+    """ Parallel efficiency of each stage when the same case is run with more workers """
+    return _efficiency_table(df, ['case', 'dbs_n'], baseline_workers_scale=True)
+
+
+def weak_scaling_table(df):
+    """ Efficiency of each stage when the work and the workers grow by the same factor, i.e. the ratio between
+    its wall time with the fewest workers and with more workers, among cases with the same work per worker
+    """
+    df = df.assign(work_per_worker=np.round(df.work / df.workers, 6))
+    return _efficiency_table(df, ['work_per_worker', 'dbs_n'], baseline_workers_scale=False)
@@ -1,18 +1,50 @@
 import numpy as np
 import pandas as pd
-import sys
+from collections import OrderedDict
+from annotation_pipeline.segment_format import dumps_segment, read_segment
+from annotation_pipeline.tracing import span, count_stream
 from annotation_pipeline.utils import logger, get_pixel_indices, get_ibm_cos_client, append_pywren_stats, list_keys,\
-    clean_from_cos, read_object_with_retry
+    clean_from_cos, read_object_with_retry, merge_sorted_runs
 from concurrent.futures import ThreadPoolExecutor
-import msgpack_numpy as msgpack
 
 ISOTOPIC_PEAK_N = 4
 MAX_MZ_VALUE = 10 ** 5
+# Relative costs of annotating a formula, in units of the cost of reading and merging one dataset peak (~0.15us),
+# fitted to the time taken by gen_iso_images and the batch metrics: a fixed cost per formula, the cost of every
+# isotope image that has any peaks (~75us) and the cost of adding each dataset peak within the ppm window of its peaks.
+# Images are sparse, so the number of pixels of the dataset doesn't matter.
+FORMULA_COST = 20
+IMAGE_COST = 500
+MATCHED_PEAK_COST = 3
 
 
-def chunk_spectra(config, input_data, imzml_parser, coordinates):
+def spectra_dtypes(mz_precision):
+    """ Column types of dataset chunks and segments. Pixel indices are stored as integers, so that they stay exact
+    for any image size, while intensities don't need more than single precision.
+    """
+    return OrderedDict([('sp_i', np.uint32), ('mz', np.dtype(mz_precision)), ('int', np.float32)])
+
+
+def spectra_peak_bytes(mz_precision):
+    return sum(np.dtype(dtype).itemsize for dtype in spectra_dtypes(mz_precision).values())
+
+
+def chunk_spectra(config, input_data, imzml_parser, coordinates, ds_segments_bounds):
+    """ Parses the dataset into chunks of spectra and uploads the part of every chunk that falls within each dataset
+    segment to `{ds_segments}/chunk/{segm_i}/{ch_i}.segm`, so that segments can be assembled in a single merge
+
+    Returns
+    -----
+        int: number of uploaded segment parts
+    """
     cos_client = get_ibm_cos_client(config)
     sp_id_to_idx = get_pixel_indices(coordinates)
+    dtypes = spectra_dtypes(imzml_parser.mzPrecision)
+    peak_bytes = spectra_peak_bytes(imzml_parser.mzPrecision)
+
+    # only inner bounds are used, so that the first and last segments
+    # include all mzs outside of the spectra sample mz range
+    segm_upper_bounds = ds_segments_bounds[:-1, 1]
 
     def chunk_size(coords, max_size=512 * 1024 ** 2):
         curr_sp_i = 0
@@ -23,10 +55,10 @@ def chunk_spectra(config, input_data, imzml_parser, coordinates):
             mzs_, ints_ = imzml_parser.getspectrum(curr_sp_i)
             mzs_, ints_ = map(np.array, [mzs_, ints_])
             sp_idx = sp_id_to_idx[curr_sp_i]
-            sp_inds_list.append(np.ones_like(mzs_) * sp_idx)
+            sp_inds_list.append(np.full(len(mzs_), sp_idx, dtype=dtypes['sp_i']))
             mzs_list.append(mzs_)
             ints_list.append(ints_)
-            estimated_size_mb += 2 * mzs_.nbytes + ints_.nbytes
+            estimated_size_mb += len(mzs_) * peak_bytes
             curr_sp_i += 1
             if estimated_size_mb > max_size:
                 yield sp_inds_list, mzs_list, ints_list
@@ -36,16 +68,22 @@ def chunk_spectra(config, input_data, imzml_parser, coordinates):
         if len(sp_inds_list) > 0:
             yield sp_inds_list, mzs_list, ints_list
 
-    def _upload_chunk(ch_i, sp_mz_int_buf):
-        chunk = msgpack.dumps(sp_mz_int_buf)
-        key = f'{input_data["ds_chunks"]}/{ch_i}.msgpack'
-        size = sys.getsizeof(chunk) * (1 / 1024 ** 2)
-        logger.info(f'Uploading spectra chunk {ch_i} - %.2f MB' % size)
-        cos_client.put_object(Bucket=config["storage"]["ds_bucket"],
-                              Key=key,
-                              Body=chunk)
-        logger.info(f'Spectra chunk {ch_i} finished')
-        return key
+    def _upload_chunk(ch_i, sp_columns):
+        # bounds are [l, r) intervals, so a peak equal to an upper bound belongs to the next segment
+        segm_ends = np.r_[np.searchsorted(sp_columns['mz'], segm_upper_bounds, side='left'), len(sp_columns['mz'])]
+        segm_starts = np.r_[0, segm_ends[:-1]]
+        parts_n, size = 0, 0
+        for segm_i, (segm_start, segm_end) in enumerate(zip(segm_starts, segm_ends)):
+            if segm_end == segm_start:
+                continue
+            part = dumps_segment(OrderedDict((name, arr[segm_start:segm_end]) for name, arr in sp_columns.items()))
+            cos_client.put_object(Bucket=config["storage"]["ds_bucket"],
+                                  Key=f'{input_data["ds_segments"]}/chunk/{segm_i}/{ch_i}.segm',
+                                  Body=part)
+            parts_n += 1
+            size += len(part)
+        logger.info(f'Spectra chunk {ch_i} finished - uploaded {parts_n} segment parts, %.2f MB' % (size / 1024 ** 2))
+        return parts_n
 
     max_size = 512 * 1024 ** 2  # 512MB
     chunk_it = chunk_size(coordinates, max_size)
@@ -54,21 +92,20 @@ def chunk_spectra(config, input_data, imzml_parser, coordinates):
     with ThreadPoolExecutor() as ex:
         for ch_i, chunk in enumerate(chunk_it):
             sp_inds_list, mzs_list, ints_list = chunk
-            dtype = imzml_parser.mzPrecision
             mzs = np.concatenate(mzs_list)
             by_mz = np.argsort(mzs)
-            sp_mz_int_buf = np.array([np.concatenate(sp_inds_list)[by_mz],
-                                      mzs[by_mz],
-                                      np.concatenate(ints_list)[by_mz]], dtype).T
+            sp_columns = OrderedDict([('sp_i', np.concatenate(sp_inds_list)[by_mz]),
+                                      ('mz', mzs[by_mz].astype(dtypes['mz'])),
+                                      ('int', np.concatenate(ints_list)[by_mz].astype(dtypes['int']))])
 
             logger.info(f'Parsed spectra chunk {ch_i}')
-            futures.append(ex.submit(_upload_chunk, ch_i, sp_mz_int_buf))
+            futures.append(ex.submit(_upload_chunk, ch_i, sp_columns))
 
         logger.info(f'Parsed dataset into {len(futures)} chunks')
 
-    logger.info(f'Uploaded {len(futures)} dataset chunks')
-    keys = [future.result() for future in futures]
-    return keys
+    parts_n = sum(future.result() for future in futures)
+    logger.info(f'Uploaded {parts_n} segment parts of {len(futures)} dataset chunks')
+    return parts_n
 
 
 def spectra_sample_gen(imzml_parser, sample_ratio=0.05):
@@ -87,9 +124,7 @@ def define_ds_segments(imzml_parser, ds_segm_size_mb=5, sample_ratio=0.05):
     spectra_mzs = np.array([mz for sp_id, mzs, ints in spectra_sample for mz in mzs])
     total_n_mz = spectra_mzs.shape[0] / sample_ratio
 
-    float_prec = 4 if imzml_parser.mzPrecision == 'f' else 8
-    segm_arr_columns = 3
-    segm_n = segm_arr_columns * (total_n_mz * float_prec) // (ds_segm_size_mb * 2 ** 20)
+    segm_n = (total_n_mz * spectra_peak_bytes(imzml_parser.mzPrecision)) // (ds_segm_size_mb * 2 ** 20)
     segm_n = max(1, int(segm_n))
 
     segm_bounds_q = [i * 1 / segm_n for i in range(0, segm_n + 1)]
@@ -100,43 +135,14 @@ def define_ds_segments(imzml_parser, ds_segm_size_mb=5, sample_ratio=0.05):
     return ds_segments
 
 
-def segment_spectra(pw, bucket, ds_chunks_prefix, ds_segments_prefix, ds_segments_bounds, ds_segm_size_mb, segm_dtype):
-    ds_segm_n = len(ds_segments_bounds)
+def segment_spectra(pw, bucket, ds_segments_prefix, ds_segm_n, ds_segm_size_mb, mz_precision, parts_n=0):
+    """ Merges the segment parts uploaded by `chunk_spectra` into the final `{ds_segments}/{segm_i}.segm` objects
 
-    # extend boundaries of the first and last segments
-    # to include all mzs outside of the spectra sample mz range
-    ds_segments_bounds = ds_segments_bounds.copy()
-    ds_segments_bounds[0, 0] = 0
-    ds_segments_bounds[-1, 1] = MAX_MZ_VALUE
-
-    # define first level segmentation and then segment each one into desired number
-    first_level_segm_size_mb = 512
-    first_level_segm_n = (len(ds_segments_bounds) * ds_segm_size_mb) // first_level_segm_size_mb
-    first_level_segm_n = max(first_level_segm_n, 1)
-    ds_segments_bounds = np.array_split(ds_segments_bounds, first_level_segm_n)
-
-    def segment_spectra_chunk(obj, id, ibm_cos):
-        print(f'Segmenting spectra chunk {obj.key}')
-        sp_mz_int_buf = msgpack.loads(obj.data_stream.read())
-
-        def _first_level_segment_upload(segm_i):
-            l = ds_segments_bounds[segm_i][0, 0]
-            r = ds_segments_bounds[segm_i][-1, 1]
-            segm_start, segm_end = np.searchsorted(sp_mz_int_buf[:, 1], (l, r))  # mz expected to be in column 1
-            segm = sp_mz_int_buf[segm_start:segm_end]
-            ibm_cos.put_object(Bucket=bucket,
-                               Key=f'{ds_segments_prefix}/chunk/{segm_i}/{id}.msgpack',
-                               Body=msgpack.dumps(segm))
-
-        with ThreadPoolExecutor(max_workers=128) as pool:
-            pool.map(_first_level_segment_upload, range(len(ds_segments_bounds)))
-
-    memory_safe_mb = 1024
-    memory_capacity_mb = first_level_segm_size_mb * 2 + memory_safe_mb
-    first_futures = pw.map(segment_spectra_chunk, f'{bucket}/{ds_chunks_prefix}/', runtime_memory=memory_capacity_mb)
-    pw.get_result(first_futures)
-    if not isinstance(first_futures, list): first_futures = [first_futures]
-    append_pywren_stats(first_futures, memory=memory_capacity_mb, plus_objects=len(first_futures) * len(ds_segments_bounds))
+    Returns
+    -----
+        tuple: number of segments and the number of peaks of each segment
+    """
+    dtypes = spectra_dtypes(mz_precision)
 
     def merge_spectra_chunk_segments(segm_i, ibm_cos):
         print(f'Merging segment {segm_i} spectra chunks')
@@ -144,40 +150,33 @@ def segment_spectra(pw, bucket, ds_chunks_prefix, ds_segments_prefix, ds_segment
         keys = list_keys(bucket, f'{ds_segments_prefix}/chunk/{segm_i}/', ibm_cos)
 
         def _merge(key):
-            segm_spectra_chunk = read_object_with_retry(ibm_cos, bucket, key, msgpack.load)
+            segm_spectra_chunk = read_segment(ibm_cos, bucket, key)
             return segm_spectra_chunk
 
-        with ThreadPoolExecutor(max_workers=128) as pool:
-            segm = list(pool.map(_merge, keys))
-
-        segm = np.concatenate(segm)
-
-        # Alternative in-place sorting (slower) :
-        # segm.view(f'{segm_dtype},{segm_dtype},{segm_dtype}').sort(order=['f1'], axis=0)
-        segm = segm[segm[:, 1].argsort()]
+        with span('download', objects=len(keys)), ThreadPoolExecutor(max_workers=128) as pool:
+            segm_chunks = list(pool.map(_merge, keys))
 
-        clean_from_cos(None, bucket, f'{ds_segments_prefix}/chunk/{segm_i}/', ibm_cos)
-        bounds_list = ds_segments_bounds[segm_i]
+        with span('compute'):
+            segm_n = sum(len(chunk['mz']) for chunk in segm_chunks)
+            segm = merge_sorted_runs(segm_chunks, out=OrderedDict((name, np.empty(segm_n, dtype=dtype))
+                                                                  for name, dtype in dtypes.items()))
+            del segm_chunks
 
-        segms_len = []
-        for segm_j in range(len(bounds_list)):
-            l, r = bounds_list[segm_j]
-            segm_start, segm_end = np.searchsorted(segm[:, 1], (l, r))  # mz expected to be in column 1
-            sub_segm = segm[segm_start:segm_end]
-            segms_len.append(len(sub_segm))
-            base_id = sum([len(bounds) for bounds in ds_segments_bounds[:segm_i]])
-            id = base_id + segm_j
-            print(f'Storing dataset segment {id}')
-            ibm_cos.put_object(Bucket=bucket,
-                               Key=f'{ds_segments_prefix}/{id}.msgpack',
-                               Body=msgpack.dumps(sub_segm))
+        print(f'Storing dataset segment {segm_i}')
+        with span('encode'):
+            body = dumps_segment(segm)
+        with span('upload'):
+            ibm_cos.put_object(Bucket=bucket, Key=f'{ds_segments_prefix}/{segm_i}.segm', Body=body)
+        with span('cleanup'):
+            clean_from_cos(None, bucket, f'{ds_segments_prefix}/chunk/{segm_i}/', ibm_cos)
 
-        return segms_len
+        return len(segm['mz'])
 
-    # same memory capacity
-    second_futures = pw.map(merge_spectra_chunk_segments, range(len(ds_segments_bounds)), runtime_memory=memory_capacity_mb)
-    ds_segms_len = list(np.concatenate(pw.get_result(second_futures)))
-    append_pywren_stats(second_futures, memory=memory_capacity_mb, plus_objects=ds_segm_n, minus_objects=len(first_futures) * len(ds_segments_bounds))
+    memory_safe_mb = 1024
+    memory_capacity_mb = ds_segm_size_mb * 2 + memory_safe_mb
+    futures = pw.map(merge_spectra_chunk_segments, range(ds_segm_n), runtime_memory=memory_capacity_mb)
+    ds_segms_len = pw.get_result(futures)
+    append_pywren_stats(futures, memory=memory_capacity_mb, plus_objects=ds_segm_n, minus_objects=parts_n)
 
     return ds_segm_n, ds_segms_len
 
@@ -185,15 +184,21 @@ def segment_spectra(pw, bucket, ds_chunks_prefix, ds_segments_prefix, ds_segment
 def clip_centr_df(pw, bucket, centr_chunks_prefix, clip_centr_chunk_prefix, mz_min, mz_max):
     def clip_centr_df_chunk(obj, id, ibm_cos):
         print(f'Clipping centroids dataframe chunk {obj.key}')
-        centroids_df_chunk = pd.read_msgpack(obj.data_stream._raw_stream).sort_values('mz')
-        centroids_df_chunk = centroids_df_chunk[centroids_df_chunk.mz > 0]
-
-        ds_mz_range_unique_formulas = centroids_df_chunk[(mz_min < centroids_df_chunk.mz) &
-                                                         (centroids_df_chunk.mz < mz_max)].index.unique()
-        centr_df_chunk = centroids_df_chunk[centroids_df_chunk.index.isin(ds_mz_range_unique_formulas)].reset_index()
-        ibm_cos.put_object(Bucket=bucket,
-                           Key=f'{clip_centr_chunk_prefix}/{id}.msgpack',
-                           Body=centr_df_chunk.to_msgpack())
+        with span('download', key=obj.key):
+            centroids_df_chunk = pd.read_msgpack(obj.data_stream._raw_stream)
+            count_stream(obj.data_stream)
+
+        with span('compute'):
+            centroids_df_chunk = centroids_df_chunk.sort_values('mz')
+            centroids_df_chunk = centroids_df_chunk[centroids_df_chunk.mz > 0]
+            ds_mz_range_unique_formulas = centroids_df_chunk[(mz_min < centroids_df_chunk.mz) &
+                                                             (centroids_df_chunk.mz < mz_max)].index.unique()
+            in_ds_mz_range = centroids_df_chunk.index.isin(ds_mz_range_unique_formulas)
+            centr_df_chunk = centroids_df_chunk[in_ds_mz_range].reset_index()
+        with span('encode'):
+            body = centr_df_chunk.to_msgpack()
+        with span('upload'):
+            ibm_cos.put_object(Bucket=bucket, Key=f'{clip_centr_chunk_prefix}/{id}.msgpack', Body=body)
 
         return centr_df_chunk.shape[0]
 
@@ -206,18 +211,88 @@ def clip_centr_df(pw, bucket, centr_chunks_prefix, clip_centr_chunk_prefix, mz_m
     return centr_n
 
 
-def define_centr_segments(pw, bucket, clip_centr_chunk_prefix, centr_n, ds_segm_n, ds_segm_size_mb):
+def ds_peaks_cdf(ds_segments_bounds, ds_segms_len):
+    """ Cumulative number of dataset peaks at every dataset segment bound, assuming that peaks are uniformly
+    distributed within each segment, so that `np.interp(mz, *ds_peaks_cdf(...))` estimates the peaks below `mz`
+
+    Returns
+    -----
+        tuple[ndarray, ndarray]: mz bounds and number of peaks below them
+    """
+    mz_bounds = np.r_[ds_segments_bounds[:, 0], ds_segments_bounds[-1, 1]]
+    return mz_bounds, np.r_[0, np.cumsum(ds_segms_len)]
+
+
+def estimate_formula_costs(centr_df, ds_segments_bounds, ds_segms_len, ppm):
+    """ Estimates the cost of generating the images and metrics of every formula in `centr_df`,
+    in units of the cost of reading one dataset peak.
+
+    The expected number of dataset peaks within the ppm window of every centroid comes from the peak density of
+    its dataset segment. Assuming they occur independently, the centroid has an image with probability
+    `1 - exp(-matched_peaks)`, so formulas in dense mz ranges cost more than those where most images are empty.
+
+    Returns
+    -----
+        pd.Series: cost of every formula_i
+    """
+    mz_bounds, peaks_cdf = ds_peaks_cdf(ds_segments_bounds, ds_segms_len)
+    segm_is = np.clip(np.searchsorted(mz_bounds, centr_df.mz.values, side='right') - 1, 0, len(ds_segms_len) - 1)
+    peaks_per_mz = np.diff(peaks_cdf) / np.maximum(np.diff(mz_bounds), 1e-9)
+    matched_peaks = peaks_per_mz[segm_is] * centr_df.mz.values * 2 * ppm * 1e-6
+    centr_costs = IMAGE_COST * -np.expm1(-matched_peaks) + MATCHED_PEAK_COST * matched_peaks
+    return FORMULA_COST + pd.Series(centr_costs).groupby(centr_df.formula_i.values).sum()
+
+
+def cost_balanced_bounds(first_peak_mzs, formula_costs, ds_segments_bounds, ds_segms_len, centr_segm_n):
+    """ Chooses centroids segments lower bounds so that every segment has the same estimated cost: the cost of
+    its formulas plus the cost of reading the dataset peaks in its mz range
+
+    Args
+    -----
+    first_peak_mzs : ndarray
+    formula_costs : ndarray
+        cost of the formula of each first peak, in units of the cost of reading one dataset peak
+    centr_segm_n : int
+
+    Returns
+    -----
+        ndarray: lower bounds of the first peak mzs of the segments
+    """
+    by_mz = np.argsort(first_peak_mzs)
+    first_peak_mzs = first_peak_mzs[by_mz]
+    cumulative_cost = np.cumsum(formula_costs[by_mz]) + np.interp(first_peak_mzs,
+                                                                  *ds_peaks_cdf(ds_segments_bounds, ds_segms_len))
+    target_costs = cumulative_cost[-1] * np.arange(1, centr_segm_n) / centr_segm_n
+    bound_is = np.searchsorted(cumulative_cost, target_costs, side='left').clip(max=len(first_peak_mzs) - 1)
+    # A formula that costs more than a segment, or many formulas with the same first peak mz,
+    # would otherwise result in repeated bounds and empty segments
+    return np.unique(np.r_[first_peak_mzs[0], first_peak_mzs[bound_is]])
+
+
+def define_centr_segments(pw, bucket, clip_centr_chunk_prefix, centr_n, ds_segm_n, ds_segm_size_mb,
+                          ds_segments_bounds=None, ds_segms_len=None, ppm=3.0):
+    """ Defines the lower bounds of the first peak mzs of centroids segments.
+    If the dataset segments are specified, bounds are chosen so that every segment takes about as long to annotate,
+    otherwise every segment gets the same number of formulas.
+    """
     logger.info('Defining centroids segments bounds')
+    cost_balanced = ds_segments_bounds is not None and ds_segms_len is not None
 
     def get_first_peak_mz(obj):
         print(f'Extracting first peak mz values from clipped centroids dataframe {obj.key}')
-        centr_df = pd.read_msgpack(obj.data_stream._raw_stream)
-        first_peak_df = centr_df[centr_df.peak_i == 0]
-        return first_peak_df.mz.values
+        with span('download', key=obj.key):
+            centr_df = pd.read_msgpack(obj.data_stream._raw_stream)
+            count_stream(obj.data_stream)
+        with span('compute'):
+            first_peak_df = centr_df[centr_df.peak_i == 0]
+            if not cost_balanced:
+                return first_peak_df.mz.values
+            formula_costs = estimate_formula_costs(centr_df, ds_segments_bounds, ds_segms_len, ppm)
+            return first_peak_df.mz.values, formula_costs.reindex(first_peak_df.formula_i.values).values
 
     memory_capacity_mb = 512
     futures = pw.map(get_first_peak_mz, f'{bucket}/{clip_centr_chunk_prefix}/', runtime_memory=memory_capacity_mb)
-    first_peak_df_mz = np.concatenate(pw.get_result(futures))
+    results = pw.get_result(futures)
     append_pywren_stats(futures, memory=memory_capacity_mb)
 
     ds_size_mb = ds_segm_n * ds_segm_size_mb
@@ -225,14 +300,27 @@ def define_centr_segments(pw, bucket, clip_centr_chunk_prefix, centr_n, ds_segm_
     peaks_per_centr_segm = 1e4
     centr_segm_n = int(max(ds_size_mb // data_per_centr_segm_mb, centr_n // peaks_per_centr_segm, 32))
 
-    segm_bounds_q = [i * 1 / centr_segm_n for i in range(0, centr_segm_n)]
-    centr_segm_lower_bounds = np.quantile(first_peak_df_mz, segm_bounds_q)
+    if cost_balanced:
+        first_peak_df_mz = np.concatenate([mzs for mzs, _ in results])
+        formula_costs = np.concatenate([costs for _, costs in results])
+        centr_segm_lower_bounds = cost_balanced_bounds(first_peak_df_mz, formula_costs, ds_segments_bounds,
+                                                       ds_segms_len, centr_segm_n)
+    else:
+        first_peak_df_mz = np.concatenate(results)
+        segm_bounds_q = [i * 1 / centr_segm_n for i in range(0, centr_segm_n)]
+        centr_segm_lower_bounds = np.quantile(first_peak_df_mz, segm_bounds_q)
 
     logger.info(f'Generated {len(centr_segm_lower_bounds)} centroids bounds: {centr_segm_lower_bounds[0]}...{centr_segm_lower_bounds[-1]}')
     return centr_segm_lower_bounds
 
 
 def segment_centroids(pw, bucket, clip_centr_chunk_prefix, centr_segm_prefix, centr_segm_lower_bounds):
+    """ Splits the clipped centroids into `{centr_segm_prefix}/{segm_i}.msgpack` segments by the mz of their first peak
+
+    Returns
+    -----
+        tuple: number of segments and the (min mz, max mz) of the peaks of every non-empty segment
+    """
     centr_segm_n = len(centr_segm_lower_bounds)
     centr_segm_lower_bounds = centr_segm_lower_bounds.copy()
 
@@ -242,25 +330,33 @@ def segment_centroids(pw, bucket, clip_centr_chunk_prefix, centr_segm_prefix, ce
     first_level_centr_segm_bounds = np.array([bounds[0] for bounds in centr_segm_lower_bounds])
 
     def segment_centr_df(centr_df, db_segm_lower_bounds):
-        first_peak_df = centr_df[centr_df.peak_i == 0].copy()
-        segment_mapping = np.searchsorted(db_segm_lower_bounds, first_peak_df.mz.values, side='right') - 1
-        first_peak_df['segm_i'] = segment_mapping
-        centr_segm_df = pd.merge(centr_df, first_peak_df[['formula_i', 'segm_i']], on='formula_i').sort_values('mz')
+        # formulas are assigned to segments by their first peak, keeping the mz order of centr_df
+        first_peak_df = centr_df[centr_df.peak_i == 0]
+        segment_mapping = pd.Series(np.searchsorted(db_segm_lower_bounds, first_peak_df.mz.values, side='right') - 1,
+                                    index=first_peak_df.formula_i.values)
+        segm_inds = segment_mapping.reindex(centr_df.formula_i.values).values
+        has_first_peak = ~np.isnan(segm_inds)
+        centr_segm_df = centr_df[has_first_peak].assign(segm_i=segm_inds[has_first_peak].astype(np.int64))
         return centr_segm_df
 
     def segment_centr_chunk(obj, id, ibm_cos):
         print(f'Segmenting clipped centroids dataframe chunk {obj.key}')
-        centr_df = pd.read_msgpack(obj.data_stream._raw_stream)
-        centr_segm_df = segment_centr_df(centr_df, first_level_centr_segm_bounds)
+        with span('download', key=obj.key):
+            centr_df = pd.read_msgpack(obj.data_stream._raw_stream)
+            count_stream(obj.data_stream)
+        with span('compute'):
+            centr_segm_df = segment_centr_df(centr_df, first_level_centr_segm_bounds)
+        with span('encode'):
+            bodies = [(segm_i, df.to_msgpack()) for segm_i, df in centr_segm_df.groupby('segm_i')]
 
         def _first_level_upload(args):
-            segm_i, df = args
+            segm_i, body = args
             ibm_cos.put_object(Bucket=bucket,
                                Key=f'{centr_segm_prefix}/chunk/{segm_i}/{id}.msgpack',
-                               Body=df.to_msgpack())
+                               Body=body)
 
-        with ThreadPoolExecutor(max_workers=128) as pool:
-            pool.map(_first_level_upload, [(segm_i, df) for segm_i, df in centr_segm_df.groupby('segm_i')])
+        with span('upload', objects=len(bodies)), ThreadPoolExecutor(max_workers=128) as pool:
+            pool.map(_first_level_upload, bodies)
 
     memory_capacity_mb = 512
     first_futures = pw.map(segment_centr_chunk, f'{bucket}/{clip_centr_chunk_prefix}/', runtime_memory=memory_capacity_mb)
@@ -277,29 +373,39 @@ def segment_centroids(pw, bucket, clip_centr_chunk_prefix, centr_segm_prefix, ce
             segm_centr_df_chunk = read_object_with_retry(ibm_cos, bucket, key, pd.read_msgpack)
             return segm_centr_df_chunk
 
-        with ThreadPoolExecutor(max_workers=128) as pool:
-            segm = pd.concat(list(pool.map(_merge, keys)))
-            del segm['segm_i']
-
-        clean_from_cos(None, bucket, f'{centr_segm_prefix}/chunk/{segm_i}/', ibm_cos)
-        centr_segm_df = segment_centr_df(segm, centr_segm_lower_bounds[segm_i])
+        with span('download', objects=len(keys)), ThreadPoolExecutor(max_workers=128) as pool:
+            segm_chunks = list(pool.map(_merge, keys))
+        with span('compute'):
+            segm = pd.DataFrame(merge_sorted_runs([OrderedDict((name, df[name].values) for name in df.columns
+                                                               if name != 'segm_i') for df in segm_chunks]))
+            del segm_chunks
+
+        with span('cleanup'):
+            clean_from_cos(None, bucket, f'{centr_segm_prefix}/chunk/{segm_i}/', ibm_cos)
+        with span('compute'):
+            centr_segm_df = segment_centr_df(segm, centr_segm_lower_bounds[segm_i])
+        base_id = sum([len(bounds) for bounds in centr_segm_lower_bounds[:segm_i]])
+        segm_dfs = [(base_id + segm_j, df) for segm_j, df in centr_segm_df.groupby('segm_i')]
+        with span('encode'):
+            bodies = [(id, df.to_msgpack()) for id, df in segm_dfs]
 
         def _second_level_upload(args):
-            segm_j, df = args
-            base_id = sum([len(bounds) for bounds in centr_segm_lower_bounds[:segm_i]])
-            id = base_id + segm_j
+            id, body = args
             print(f'Storing centroids segment {id}')
             ibm_cos.put_object(Bucket=bucket,
                                Key=f'{centr_segm_prefix}/{id}.msgpack',
-                               Body=df.to_msgpack())
+                               Body=body)
+
+        with span('upload', objects=len(bodies)), ThreadPoolExecutor(max_workers=128) as pool:
+            pool.map(_second_level_upload, bodies)
 
-        with ThreadPoolExecutor(max_workers=128) as pool:
-            pool.map(_second_level_upload, [(segm_i, df) for segm_i, df in centr_segm_df.groupby('segm_i')])
+        return [(id, df.mz.min(), df.mz.max()) for id, df in segm_dfs]
 
     memory_capacity_mb = 1024
     second_futures = pw.map(merge_centr_df_segments, range(len(centr_segm_lower_bounds)), runtime_memory=memory_capacity_mb)
-    pw.get_result(second_futures)
+    centr_segm_mz_ranges = {id: (min_mz, max_mz)
+                            for segm_ranges in pw.get_result(second_futures) for id, min_mz, max_mz in segm_ranges}
     append_pywren_stats(second_futures, memory=memory_capacity_mb,
                         plus_objects=centr_segm_n, minus_objects=len(first_futures) * len(centr_segm_lower_bounds))
 
-    return centr_segm_n
+    return centr_segm_n, centr_segm_mz_ranges
@@ -0,0 +1,143 @@
+import json
+import struct
+from collections import OrderedDict
+
+import numpy as np
+
+from annotation_pipeline.storage import read_buffer
+from annotation_pipeline.utils import read_object_with_retry
+
+# Binary layout of a segment object:
+#   MAGIC | header length (uint32) | JSON header | padding | mz index | column 0 | column 1 | ...
+# Every array is stored as a raw little-endian array starting at an 8-byte aligned offset, relative to the end of
+# the header. The mz index holds the value of the sort column at every `index_step` rows, which allows readers
+# to request only the byte ranges of the rows within an mz window.
+MAGIC = b'APSEGM01'
+PREFIX_STRUCT = struct.Struct('<8sI')
+HEADER_PREFETCH_BYTES = 64 * 1024
+INDEX_STEP = 4096
+ALIGNMENT = 8
+
+
+def _aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _le(dtype):
+    return np.dtype(dtype).newbyteorder('<')
+
+
+def dumps_segment(columns, sort_column='mz', index_step=INDEX_STEP):
+    """ Serializes equally long 1d arrays, which must be sorted by `sort_column`
+
+    Args
+    -----
+    columns : OrderedDict[str, ndarray]
+    sort_column : str
+    index_step : int
+        number of rows between consecutive mz index entries
+
+    Returns
+    -----
+        bytearray
+    """
+    rows_n = len(columns[sort_column])
+    index = np.ascontiguousarray(columns[sort_column][::index_step], dtype=_le('f8'))
+
+    arrays = [index]
+    header_columns = []
+    offset = _aligned(index.nbytes)
+    for name, arr in columns.items():
+        assert len(arr) == rows_n, f'Column {name} has {len(arr)} rows instead of {rows_n}'
+        arr = np.ascontiguousarray(arr, dtype=_le(arr.dtype))
+        header_columns.append({'name': name, 'dtype': arr.dtype.str, 'offset': offset})
+        arrays.append(arr)
+        offset = _aligned(offset + arr.nbytes)
+
+    header = json.dumps({'rows': rows_n,
+                         'sort_column': sort_column,
+                         'index': {'step': index_step, 'count': len(index), 'offset': 0},
+                         'columns': header_columns}).encode('utf-8')
+
+    data_start = _aligned(PREFIX_STRUCT.size + len(header))
+    buf = bytearray(data_start + offset)
+    PREFIX_STRUCT.pack_into(buf, 0, MAGIC, len(header))
+    buf[PREFIX_STRUCT.size:PREFIX_STRUCT.size + len(header)] = header
+    buf_bytes = np.frombuffer(buf, dtype=np.uint8)
+    array_offsets = [0] + [column['offset'] for column in header_columns]
+    for arr, array_offset in zip(arrays, array_offsets):
+        start = data_start + array_offset
+        buf_bytes[start:start + arr.nbytes] = arr.view(np.uint8)
+    return buf
+
+
+def _parse_header(buf):
+    magic, header_len = PREFIX_STRUCT.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise ValueError('Not a segment object')
+    data_start = _aligned(PREFIX_STRUCT.size + header_len)
+    if len(buf) < PREFIX_STRUCT.size + header_len:
+        return None, data_start
+    header = json.loads(bytes(buf[PREFIX_STRUCT.size:PREFIX_STRUCT.size + header_len]).decode('utf-8'))
+    return header, data_start
+
+
+def loads_segment(buf):
+    """ Deserializes a whole segment. Columns are read-only views of `buf`, so no data is copied.
+
+    Returns
+    -----
+        OrderedDict[str, ndarray]
+    """
+    header, data_start = _parse_header(buf)
+    return OrderedDict((column['name'], np.frombuffer(buf, dtype=column['dtype'], count=header['rows'],
+                                                      offset=data_start + column['offset']))
+                       for column in header['columns'])
+
+
+def read_segment(ibm_cos, bucket, key, mz_range=None):
+    """ Reads a segment object, optionally only the rows with `mz_range[0] <= mz <= mz_range[1]`.
+
+    When `mz_range` is specified, the header and mz index are read first and then each column is fetched with
+    an HTTP range request covering only the index blocks that overlap the window.
+
+    Returns
+    -----
+        OrderedDict[str, ndarray]
+    """
+    if mz_range is None:
+        return read_object_with_retry(ibm_cos, bucket, key, lambda stream: loads_segment(read_buffer(stream)))
+
+    buf = read_object_with_retry(ibm_cos, bucket, key, read_buffer, byte_range=(0, HEADER_PREFETCH_BYTES))
+    header, data_start = _parse_header(buf)
+    index_end = data_start + (header['index']['offset'] + header['index']['count'] * 8 if header else 0)
+    if header is None or len(buf) < index_end:
+        # Header or index is bigger than the prefetched bytes
+        buf = read_object_with_retry(ibm_cos, bucket, key, read_buffer, byte_range=(0, max(index_end, len(buf) * 4)))
+        header, data_start = _parse_header(buf)
+        if len(buf) < data_start + header['index']['offset'] + header['index']['count'] * 8:
+            buf = read_object_with_retry(ibm_cos, bucket, key, read_buffer)
+    index = header['index']
+
+    rows_n, step = header['rows'], index['step']
+    mz_index = np.frombuffer(buf, dtype='<f8', count=index['count'], offset=data_start + index['offset'])
+    lo, hi = mz_range
+    start_row = max(np.searchsorted(mz_index, lo, side='left') - 1, 0) * step
+    end_row = min(np.searchsorted(mz_index, hi, side='right') * step, rows_n)
+    end_row = max(start_row, end_row)
+
+    columns = OrderedDict()
+    for column in header['columns']:
+        dtype = np.dtype(column['dtype'])
+        if end_row == start_row:
+            columns[column['name']] = np.zeros(0, dtype=dtype)
+            continue
+        start = data_start + column['offset'] + start_row * dtype.itemsize
+        end = data_start + column['offset'] + end_row * dtype.itemsize
+        col_buf = read_object_with_retry(ibm_cos, bucket, key, read_buffer, byte_range=(start, end))
+        columns[column['name']] = np.frombuffer(col_buf, dtype=dtype, count=end_row - start_row)
+
+    sort_values = columns[header['sort_column']]
+    first = np.searchsorted(sort_values, lo, side='left')
+    last = np.searchsorted(sort_values, hi, side='right')
+    return OrderedDict((name, arr[first:last]) for name, arr in columns.items())
@@ -0,0 +1,221 @@
+import base64
+import io
+import json
+import threading
+import time
+from collections import OrderedDict
+from copy import deepcopy
+from functools import partial
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+from socketserver import ThreadingMixIn
+
+import numpy as np
+import pandas as pd
+
+from annotation_pipeline.formula_parser import safe_generate_ion_formula
+from annotation_pipeline.image import gen_iso_images, make_sample_area_mask, read_ds_segments
+from annotation_pipeline.isocalc_cache import IsotopePatternCache
+from annotation_pipeline.molecular_db import hash_formula_to_segment
+from annotation_pipeline.pipeline import Pipeline
+from annotation_pipeline.utils import ds_dims, logger
+from annotation_pipeline.validate import make_compute_image_metrics_batch, complete_image_list, METRICS
+
+
+def _png_base64(image):
+    import matplotlib.pyplot as plt  # Import lazily, as it's only needed for images
+
+    buf = io.BytesIO()
+    plt.imsave(buf, image.toarray(), format='png')
+    return base64.b64encode(buf.getvalue()).decode('ascii')
+
+
+class InteractiveAnnotator(object):
+    """ Keeps the peaks of a dataset in memory to annotate small lists of formulas without running any map
+
+    The dataset is only segmented if its segments aren't in the run checkpoint or the dataset segments cache already.
+    All segments are then read into a single array sorted by mz. Every query looks up the centroids of its ions in the
+    isotope pattern cache of the molecular databases, whose shards are kept in memory once a query needs them,
+    calculates the missing ones locally and keeps them in memory too, without storing them in the cache, and only
+    generates images from the peaks within `ppm` of them.
+
+    Args
+    -----
+    config : dict
+    input_config : dict
+    """
+
+    def __init__(self, config, input_config):
+        pipeline = Pipeline(config, input_config)
+        pipeline.load_ds()
+        resume_stage_i = pipeline.restore_checkpoint()
+        for stage in ['split_ds', 'segment_ds'][resume_stage_i:]:
+            getattr(pipeline, stage)()
+
+        # Unlike a worker, this process can use the concatenation that needs twice the memory of the dataset
+        ds_segms_mb = len(pipeline.ds_segms_len) * pipeline.ds_segm_size_mb
+        self.sp_inds, self.sp_mzs, self.sp_ints = read_ds_segments(pipeline.storage['ds_bucket'],
+                                                                   pipeline.ds_segments_prefix, 0,
+                                                                   len(pipeline.ds_segms_len) - 1,
+                                                                   pipeline.ds_segms_len, ds_segms_mb * 2 + 1024,
+                                                                   pipeline.ds_segm_size_mb,
+                                                                   pipeline.imzml_parser.mzPrecision, pipeline.ibm_cos)
+        logger.info(f'Loaded {len(self.sp_mzs)} peaks of {pipeline.sp_n} spectra')
+
+        self.nrows, self.ncols = ds_dims(pipeline.coordinates)
+        self.ppm = pipeline.image_gen_config['ppm']
+        self.adducts = pipeline.input_db['adducts']
+        self.compute_metrics = make_compute_image_metrics_batch(make_sample_area_mask(pipeline.coordinates),
+                                                                self.nrows, self.ncols, pipeline.image_gen_config)
+
+        from annotation_pipeline.isocalc_wrapper import IsocalcWrapper  # Import lazily, as in molecular_db
+        self.isocalc_wrapper = IsocalcWrapper({
+            'charge': {
+                'polarity': pipeline.input_data['polarity'],
+                'n_charges': 1,
+            },
+            'isocalc_sigma': pipeline.input_data['isocalc_sigma']
+        })
+        self.isocalc_cache_prefix = pipeline.input_db.get(
+            'isocalc_cache', str(Path(pipeline.input_db['formulas_chunks']).parent / 'isocalc_cache'))
+        self._isocalc_caches = {}
+        self._isocalc_caches_lock = threading.Lock()
+        self.pipeline = pipeline
+
+    def _centroids(self, ion_formulas):
+        shards = np.array([hash_formula_to_segment(ion_formula) for ion_formula in ion_formulas])
+        mzs = np.full((len(ion_formulas), self.isocalc_wrapper.n_peaks), np.nan)
+        ints = np.full((len(ion_formulas), self.isocalc_wrapper.n_peaks), np.nan)
+        for shard_i in np.unique(shards):
+            with self._isocalc_caches_lock:
+                if shard_i not in self._isocalc_caches:
+                    isocalc_cache = IsotopePatternCache(self.pipeline.ibm_cos, self.pipeline.storage['db_bucket'],
+                                                        self.isocalc_cache_prefix, self.isocalc_wrapper.charge,
+                                                        self.isocalc_wrapper.sigma, self.isocalc_wrapper.n_peaks)
+                    isocalc_cache.load_shards([shard_i])
+                    self._isocalc_caches[shard_i] = isocalc_cache
+            inds = np.flatnonzero(shards == shard_i)
+            mzs[inds], ints[inds] = self._isocalc_caches[shard_i].centroids(
+                [ion_formulas[i] for i in inds], partial(self.isocalc_wrapper.centroids_batch, processes=1))
+        return mzs, ints
+
+    def _peaks_near(self, mzs):
+        """ Returns the sp_i, mz and int of the peaks within `ppm` of any of `mzs`, sorted by mz """
+        starts = np.searchsorted(self.sp_mzs, mzs - mzs * self.ppm * 1e-6, 'left')
+        ends = np.searchsorted(self.sp_mzs, mzs + mzs * self.ppm * 1e-6, 'right')
+        inds = np.unique(np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)]
+                                        + [np.empty(0, dtype=np.int64)]))
+        return self.sp_inds[inds], self.sp_mzs[inds], self.sp_ints[inds]
+
+    def annotate(self, formulas, adducts=None, images=False):
+        """ Scores every combination of `formulas` and `adducts`
+
+        Args
+        -----
+        formulas : list[str]
+        adducts : list[str]
+            the adducts of the input config by default
+        images : bool
+            whether to include the isotope images of ions with an MSM above 0, as base64 encoded PNGs
+
+        Returns
+        -----
+            list[OrderedDict]: formula, adduct, ion formula, mz and metrics of every valid ion
+        """
+        adducts = self.adducts if adducts is None else adducts
+        ions = [(formula, adduct, safe_generate_ion_formula(formula, adduct))
+                for formula in formulas for adduct in adducts]
+        ions = [ion for ion in ions if ion[2] is not None]
+        if not ions:
+            return []
+
+        mzs, ints = self._centroids([ion_formula for _, _, ion_formula in ions])
+        valid = ~np.isnan(mzs[:, 0])
+        n_peaks = mzs.shape[1]
+        centr_df = pd.DataFrame({'formula_i': np.repeat(np.flatnonzero(valid), n_peaks),
+                                 'peak_i': np.tile(np.arange(n_peaks), valid.sum()),
+                                 'mz': mzs[valid].ravel(),
+                                 'int': ints[valid].ravel()},
+                                columns=['formula_i', 'peak_i', 'mz', 'int'])
+        centr_df = centr_df[centr_df.mz > 0].sort_values('mz')
+
+        sp_inds, sp_mzs, sp_ints = self._peaks_near(centr_df.mz.values)
+        formula_images = OrderedDict((f_i, (f_ints, f_images)) for f_i, f_ints, f_images
+                                     in gen_iso_images(sp_inds, sp_mzs, sp_ints, centr_df, self.nrows, self.ncols,
+                                                       self.ppm, min_px=1))
+        scored_is = [f_i for f_i, (_, f_images) in formula_images.items() if complete_image_list(f_images)]
+        formula_metrics = dict(zip(scored_is, self.compute_metrics([formula_images[f_i][0] for f_i in scored_is],
+                                                                   [formula_images[f_i][1] for f_i in scored_is])))
+
+        results = []
+        for f_i, (formula, adduct, ion_formula) in enumerate(ions):
+            if not valid[f_i]:
+                continue
+            result = OrderedDict([('formula', formula), ('adduct', adduct), ('ion_formula', ion_formula),
+                                  ('mz', float(mzs[f_i, 0]))])
+            result.update(formula_metrics.get(f_i, deepcopy(METRICS)))
+            if images:
+                # As in the pipeline, only annotated ions have images
+                f_images = formula_images[f_i][1] if result['msm'] > 0 else []
+                result['images'] = [_png_base64(image) if image is not None else None for image in f_images]
+            results.append(result)
+        return results
+
+
+class _AnnotationRequestHandler(BaseHTTPRequestHandler):
+    """ `GET /status` describes the loaded dataset and `POST /annotate` takes a JSON object with `formulas` and
+    optionally `adducts` and `images`, and returns the results of `InteractiveAnnotator.annotate`
+    """
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != '/status':
+            return self._send_json(404, {'error': f'Unknown path {self.path}'})
+        annotator = self.server.annotator
+        self._send_json(200, {'dataset': annotator.pipeline.input_data['path'],
+                              'spectra': annotator.pipeline.sp_n,
+                              'peaks': len(annotator.sp_mzs),
+                              'adducts': annotator.adducts,
+                              'ppm': annotator.ppm})
+
+    def do_POST(self):
+        if self.path != '/annotate':
+            return self._send_json(404, {'error': f'Unknown path {self.path}'})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+            formulas = request['formulas']
+        except (ValueError, KeyError, TypeError) as ex:
+            return self._send_json(400, {'error': f'Expected a JSON object with a list of formulas: {ex!r}'})
+
+        start = time.time()
+        try:
+            results = self.server.annotator.annotate(formulas, request.get('adducts'), request.get('images', False))
+        except Exception as ex:
+            logger.exception('Annotation request failed')
+            return self._send_json(500, {'error': repr(ex)})
+        self._send_json(200, {'results': results, 'took_s': time.time() - start})
+
+    def log_message(self, format, *args):
+        logger.info(f'{self.address_string()} - {format % args}')
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(config, input_config, host='127.0.0.1', port=8000):
+    """ Loads the dataset of `input_config` and answers annotation requests over HTTP until interrupted """
+    server = _ThreadingHTTPServer((host, port), _AnnotationRequestHandler)
+    server.annotator = InteractiveAnnotator(config, input_config)
+    logger.info(f'Serving annotations of {input_config["dataset"]["path"]} at http://{host}:{port}')
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
@@ -0,0 +1,278 @@
+import mmap
+import os
+import shutil
+import time
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+
+from ibm_botocore.exceptions import ClientError
+
+TMP_FILE_PREFIX = '.tmp-'
+
+
+def _no_such_key(bucket, key, operation):
+    return ClientError({'Error': {'Code': 'NoSuchKey', 'Message': f'{bucket}/{key} does not exist'}}, operation)
+
+
+def _parse_range(range_header, size):
+    """ Converts an HTTP `bytes=start-end` header (end inclusive) into a python [start, end) range """
+    start, end = range_header.split('=', 1)[1].split('-', 1)
+    if not start:
+        start, end = max(size - int(end), 0), size
+    else:
+        start = int(start)
+        end = min(int(end) + 1, size) if end else size
+    return min(start, size), end
+
+
+class MMapStreamingBody(object):
+    """ File-like object body that serves reads from a memory-mapped file.
+
+    `read()` returns `bytes` like botocore's `StreamingBody`, while `buffer` exposes the requested byte range
+    as a zero-copy `memoryview` that can be passed directly to `np.frombuffer`, `pickle.loads`, etc.
+    """
+
+    def __init__(self, path, start=0, end=None):
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        self._start = start
+        self._end = size if end is None else end
+        self._pos = start
+        self._amount_read = 0
+
+    @property
+    def _raw_stream(self):
+        return self
+
+    @property
+    def buffer(self):
+        if self._mmap is None:
+            return memoryview(b'')
+        return memoryview(self._mmap)[self._start:self._end]
+
+    def __len__(self):
+        return self._end - self._start
+
+    def read(self, amt=None):
+        if self._mmap is None:
+            return b''
+        end = self._end if amt is None or amt < 0 else min(self._pos + amt, self._end)
+        data = self._mmap[self._pos:end]
+        self._amount_read += len(data)
+        self._pos = end
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        # The mmap is closed when the last buffer exported from it is garbage collected
+        self._mmap = None
+
+
+class _ListObjectsPaginator(object):
+    def __init__(self, client):
+        self._client = client
+
+    def paginate(self, Bucket, Prefix='', Delimiter=None, PaginationConfig=None):
+        page_size = (PaginationConfig or {}).get('PageSize', 1000)
+        token = None
+        while True:
+            page = self._client.list_objects_v2(Bucket=Bucket, Prefix=Prefix, Delimiter=Delimiter, MaxKeys=page_size,
+                                                ContinuationToken=token)
+            yield page
+            if not page['IsTruncated']:
+                break
+            token = page['NextContinuationToken']
+
+
+class LocalCOSClient(object):
+    """ Stand-in for the `ibm_boto3` S3 client that stores every bucket as a directory under `path`.
+
+    Only the subset of the S3 API used by the pipeline is implemented. Reads are served from `mmap`,
+    writes go to a temporary file that is atomically renamed into place, and listings only walk
+    the directories that can contain keys with the requested prefix.
+    `latency_ms` and `bandwidth_mbps` can be used to emulate the network characteristics of a real object storage.
+    Requests and bytes are counted per client in `stats` and for all clients of the process in `process_stats`.
+    """
+
+    process_stats = {'requests': 0, 'bytes_read': 0, 'bytes_written': 0}
+
+    def __init__(self, path, latency_ms=0, bandwidth_mbps=None):
+        self.root = Path(path)
+        self.latency = latency_ms / 1000
+        self.bandwidth = bandwidth_mbps * 1024 ** 2 / 8 if bandwidth_mbps else None
+        self.stats = {'requests': 0, 'bytes_read': 0, 'bytes_written': 0}
+
+    def _count(self, stat, n):
+        self.stats[stat] += n
+        LocalCOSClient.process_stats[stat] += n
+
+    def _throttle(self, nbytes=0):
+        self._count('requests', 1)
+        delay = self.latency
+        if self.bandwidth:
+            delay += nbytes / self.bandwidth
+        if delay > 0:
+            time.sleep(delay)
+
+    def _path(self, bucket, key):
+        if not key or key.endswith('/') or '..' in key.split('/'):
+            raise ValueError(f'Invalid key: {key}')
+        return self.root / bucket / key
+
+    def _iter_keys(self, bucket, prefix, recursive=True):
+        """ Yields (key, path) for every object in `bucket` starting with `prefix`, in lexicographical order.
+        If not `recursive`, directories directly under `prefix` are yielded as (common prefix, None) instead.
+        """
+        bucket_path = self.root / bucket
+        dir_prefix, _, name_prefix = prefix.rpartition('/')
+        start_dir = bucket_path / dir_prefix if dir_prefix else bucket_path
+        if not start_dir.is_dir():
+            return
+
+        def walk(dir_path, key_prefix, name_filter):
+            entries = []
+            with os.scandir(dir_path) as it:
+                for entry in it:
+                    if entry.name.startswith(TMP_FILE_PREFIX) or not entry.name.startswith(name_filter):
+                        continue
+                    entries.append(entry)
+            # Sort so that keys are listed in the same order as S3, where 'a/b' sorts after 'a.b'
+            entries.sort(key=lambda e: e.name + '/' if e.is_dir() else e.name)
+            for entry in entries:
+                if entry.is_dir() and not recursive:
+                    yield f'{key_prefix}{entry.name}/', None
+                elif entry.is_dir():
+                    yield from walk(entry.path, f'{key_prefix}{entry.name}/', '')
+                else:
+                    yield f'{key_prefix}{entry.name}', entry.path
+
+        yield from walk(start_dir, f'{dir_prefix}/' if dir_prefix else '', name_prefix)
+
+    def get_object(self, Bucket, Key, Range=None):
+        path = self._path(Bucket, Key)
+        if not path.is_file():
+            raise _no_such_key(Bucket, Key, 'GetObject')
+        size = path.stat().st_size
+        start, end = _parse_range(Range, size) if Range else (0, size)
+        self._throttle(end - start)
+        self._count('bytes_read', end - start)
+        return {'Body': MMapStreamingBody(path, start, end), 'ContentLength': end - start}
+
+    def head_object(self, Bucket, Key):
+        path = self._path(Bucket, Key)
+        if not path.is_file():
+            raise _no_such_key(Bucket, Key, 'HeadObject')
+        self._throttle()
+        stat = path.stat()
+        return {'ContentLength': stat.st_size,
+                'LastModified': datetime.fromtimestamp(stat.st_mtime, timezone.utc)}
+
+    def put_object(self, Bucket, Key, Body=b''):
+        path = self._path(Bucket, Key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.parent / f'{TMP_FILE_PREFIX}{uuid.uuid4().hex}'
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        try:
+            with open(tmp_path, 'wb') as f:
+                if hasattr(Body, 'read'):
+                    shutil.copyfileobj(Body, f)
+                else:
+                    f.write(Body)
+                nbytes = f.tell()
+            os.replace(tmp_path, path)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+        self._throttle(nbytes)
+        self._count('bytes_written', nbytes)
+        return {}
+
+    def upload_file(self, Filename, Bucket, Key):
+        with open(Filename, 'rb') as f:
+            self.put_object(Bucket=Bucket, Key=Key, Body=f)
+
+    def download_file(self, Bucket, Key, Filename):
+        body = self.get_object(Bucket=Bucket, Key=Key)['Body']
+        with open(Filename, 'wb') as f:
+            f.write(body.buffer)
+
+    def list_objects_v2(self, Bucket, Prefix='', Delimiter=None, MaxKeys=1000, ContinuationToken=None,
+                        StartAfter=None):
+        # Only the '/' delimiter is supported, as keys are stored as paths
+        assert Delimiter in (None, '', '/'), f'Unsupported delimiter: {Delimiter}'
+        self._throttle()
+        start_after = ContinuationToken or StartAfter
+        contents, common_prefixes = [], []
+        last_key = None
+        is_truncated = False
+        for key, path in self._iter_keys(Bucket, Prefix, recursive=not Delimiter):
+            if start_after and key <= start_after:
+                continue
+            if len(contents) + len(common_prefixes) == MaxKeys:
+                is_truncated = True
+                break
+            if path is None:
+                common_prefixes.append({'Prefix': key})
+            else:
+                stat = os.stat(path)
+                contents.append({'Key': key, 'Size': stat.st_size,
+                                 'LastModified': datetime.fromtimestamp(stat.st_mtime, timezone.utc)})
+            last_key = key
+
+        page = {'KeyCount': len(contents) + len(common_prefixes), 'IsTruncated': is_truncated, 'Prefix': Prefix}
+        if contents:
+            page['Contents'] = contents
+        if common_prefixes:
+            page['CommonPrefixes'] = common_prefixes
+        if Delimiter:
+            page['Delimiter'] = Delimiter
+        if is_truncated:
+            page['NextContinuationToken'] = last_key
+        return page
+
+    def get_paginator(self, operation_name):
+        assert operation_name == 'list_objects_v2', f'Unsupported paginator: {operation_name}'
+        return _ListObjectsPaginator(self)
+
+    def delete_object(self, Bucket, Key):
+        self._throttle()
+        path = self._path(Bucket, Key)
+        if path.is_file():
+            path.unlink()
+            self._remove_empty_dirs(Bucket, path.parent)
+        return {}
+
+    def delete_objects(self, Bucket, Delete):
+        self._throttle()
+        deleted = []
+        for obj in Delete['Objects']:
+            path = self._path(Bucket, obj['Key'])
+            if path.is_file():
+                path.unlink()
+                self._remove_empty_dirs(Bucket, path.parent)
+            deleted.append({'Key': obj['Key']})
+        return {'Deleted': deleted}
+
+    def _remove_empty_dirs(self, bucket, dir_path):
+        bucket_path = self.root / bucket
+        while dir_path != bucket_path and bucket_path in dir_path.parents:
+            try:
+                dir_path.rmdir()
+            except OSError:
+                break
+            dir_path = dir_path.parent
+
+
+def read_buffer(data_stream):
+    """ Returns the whole body of a `get_object` response, without copying it if the storage supports it """
+    buffer = getattr(data_stream, 'buffer', None)
+    if buffer is not None:
+        return buffer
+    return data_stream.read()
@@ -0,0 +1,90 @@
+import numpy as np
+
+# Element count ranges of generated molecules, in Hill order
+MOL_ELEMENT_RANGES = [('C', 1, 60), ('H', 0, 120), ('N', 0, 6), ('O', 0, 16), ('P', 0, 2), ('S', 0, 2)]
+
+
+def generate_mol_db(mols_n, seed=0):
+    """ Generates random, unique CHNOPS molecule formulas in the same format as the uploaded molecular databases
+
+    Args
+    -----
+    mols_n : int
+    seed : int
+
+    Returns
+    -----
+        list[str]: sorted formulas
+    """
+    rng = np.random.RandomState(seed)
+    mols = set()
+    while len(mols) < mols_n:
+        counts = np.stack([rng.randint(low, high + 1, size=mols_n) for _, low, high in MOL_ELEMENT_RANGES], axis=1)
+        for row in counts:
+            mols.add(''.join(elem + (str(n) if n > 1 else '')
+                             for (elem, _, _), n in zip(MOL_ELEMENT_RANGES, row) if n > 0))
+            if len(mols) == mols_n:
+                break
+    return sorted(mols)
+
+
+def generate_spectra(nrows, ncols, peaks_n, mz_range=(100, 1000), continuous=False, planted_mzs=(), seed=0):
+    """ Yields the (x, y) coordinates, mzs and intensities of the spectra of a synthetic dataset
+
+    Every spectrum consists of `peaks_n` random noise peaks. `planted_mzs` are added to the spectra of a disc in
+    the middle of the image, with intensities that fall off towards its edge, so that they produce real annotations.
+    Continuous datasets share the same mz axis in all spectra, with zero intensities where a pixel has no signal.
+    """
+    rng = np.random.RandomState(seed)
+    planted_mzs = np.sort(np.asarray(planted_mzs, dtype=np.float64))
+    shared_mzs = np.sort(rng.uniform(*mz_range, size=peaks_n))
+    if continuous:
+        shared_mzs = np.unique(np.concatenate([shared_mzs, planted_mzs]))
+    planted_cols = np.searchsorted(shared_mzs, planted_mzs)
+
+    radius = min(nrows, ncols) / 3
+    for y in range(nrows):
+        for x in range(ncols):
+            signal = max(0., 1 - np.hypot(y - nrows / 2, x - ncols / 2) / radius)
+            if continuous:
+                mzs = shared_mzs
+                ints = rng.exponential(100, size=len(mzs)).astype(np.float32)
+                ints[planted_cols] = 1000 * signal
+            else:
+                mzs = np.sort(rng.uniform(*mz_range, size=peaks_n))
+                ints = rng.exponential(100, size=peaks_n).astype(np.float32)
+                if signal > 0 and len(planted_mzs):
+                    mzs = np.concatenate([mzs, planted_mzs])
+                    ints = np.concatenate([ints, np.full(len(planted_mzs), 1000 * signal, dtype=np.float32)])
+                    by_mz = np.argsort(mzs)
+                    mzs, ints = mzs[by_mz], ints[by_mz]
+            yield (x + 1, y + 1), mzs, ints
+
+
+def write_imzml(path, nrows=50, ncols=50, peaks_n=1000, mz_range=(100, 1000), mz_precision='f', continuous=False,
+                planted_mzs=(), seed=0):
+    """ Writes a synthetic dataset to `path` (an .imzML file, the .ibd file is written next to it)
+
+    Args
+    -----
+    path : str
+    nrows : int
+    ncols : int
+    peaks_n : int
+        number of peaks per spectrum
+    mz_range : tuple[float, float]
+    mz_precision : str
+        numpy dtype of the stored mzs, 'f' or 'd'
+    continuous : bool
+        whether to write a continuous instead of a processed imzML
+    planted_mzs : list[float]
+        mzs to add to the spectra in the middle of the image
+    seed : int
+    """
+    from pyimzml.ImzMLWriter import ImzMLWriter  # Import lazily, like everywhere else pyimzml is used
+
+    with ImzMLWriter(str(path), mz_dtype=np.dtype(mz_precision).type, intensity_dtype=np.float32,
+                     mode='continuous' if continuous else 'processed') as writer:
+        for coords, mzs, ints in generate_spectra(nrows, ncols, peaks_n, mz_range, continuous, planted_mzs, seed):
+            writer.addSpectrum(mzs.astype(mz_precision), ints, coords)
+    return path
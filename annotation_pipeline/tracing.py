@@ -0,0 +1,280 @@
+import functools
+import json
+import logging
+import os
+import resource
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+# Not imported from utils, which depends on this module
+logger = logging.getLogger('annotation-pipeline')
+
+COUNTERS = ('objects_read', 'bytes_read', 'objects_written', 'bytes_written', 'retries')
+
+# Tracer of the call that is running in this process, if it is traced
+_tracer = None
+
+
+def _peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class _NoSpan(object):
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class Tracer(object):
+    """ Records the spans of a single call of a mapped function.
+
+    I/O counters are added to every span that is open when they are counted, including spans opened by other threads,
+    so that reads done by a thread pool are attributed to the span that started it.
+    """
+
+    def __init__(self):
+        self.spans = []
+        self._open_spans = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, **args):
+        span_args = OrderedDict(args)
+        span_args.update((counter, 0) for counter in COUNTERS)
+        span = OrderedDict([('name', name), ('start', time.time()), ('end', None), ('args', span_args)])
+        with self._lock:
+            self._open_spans.append(span)
+        try:
+            yield span_args
+        except Exception as ex:
+            span_args['error'] = repr(ex)
+            raise
+        finally:
+            span['end'] = time.time()
+            span_args['peak_rss_mb'] = _peak_rss_mb()
+            with self._lock:
+                self._open_spans.remove(span)
+                self.spans.append(span)
+
+    def count(self, **counters):
+        with self._lock:
+            for span in self._open_spans:
+                for counter, n in counters.items():
+                    span['args'][counter] += n
+
+
+def span(name, **args):
+    """ Context manager that records a span of the current call with the I/O counted while it's open.
+    Does nothing if the call isn't traced.
+
+    Args
+    -----
+    name : str
+        e.g. 'download', 'decode', 'compute', 'encode' or 'upload'
+    args : dict
+        extra information to show with the span
+
+    Returns
+    -----
+        the span's args dict, which can be updated inside the `with` block
+    """
+    if _tracer is None:
+        return _NoSpan()
+    return _tracer.span(name, **args)
+
+
+def count(**counters):
+    """ Adds to the I/O counters of the open spans of the current call, if it is traced """
+    if _tracer is not None:
+        _tracer.count(**counters)
+
+
+def count_stream(stream):
+    """ Counts an object read through a stream that wasn't requested with a counted client, e.g. PyWren's `obj` """
+    count(objects_read=1, bytes_read=getattr(stream, '_amount_read', 0))
+
+
+def _body_len(body):
+    if isinstance(body, str):
+        return len(body.encode('utf-8'))
+    try:
+        return len(body)
+    except TypeError:
+        return 0
+
+
+class CountingCOSClient(object):
+    """ Wraps a COS client to count the objects and bytes transferred by the traced call """
+
+    def __init__(self, ibm_cos):
+        self._ibm_cos = ibm_cos
+
+    def __getattr__(self, name):
+        return getattr(self._ibm_cos, name)
+
+    def get_object(self, **kwargs):
+        response = self._ibm_cos.get_object(**kwargs)
+        count(objects_read=1, bytes_read=response.get('ContentLength', 0))
+        return response
+
+    def put_object(self, **kwargs):
+        response = self._ibm_cos.put_object(**kwargs)
+        count(objects_written=1, bytes_written=_body_len(kwargs.get('Body', b'')))
+        return response
+
+
+class CountingInternalStorage(object):
+    """ Wraps PyWren's `internal_storage` to count the objects and bytes transferred by the traced call """
+
+    def __init__(self, internal_storage):
+        self._internal_storage = internal_storage
+
+    def __getattr__(self, name):
+        return getattr(self._internal_storage, name)
+
+    def put_object(self, body, *args, **kwargs):
+        cloud_obj = self._internal_storage.put_object(body, *args, **kwargs)
+        count(objects_written=1, bytes_written=_body_len(body))
+        return cloud_obj
+
+    def get_object(self, *args, **kwargs):
+        body = self._internal_storage.get_object(*args, **kwargs)
+        count(objects_read=1, bytes_read=_body_len(body))
+        return body
+
+
+def traced(map_function):
+    """ Wraps a function mapped with `pw.map` so that it returns a `(result, trace)` tuple.
+    The wrapper has the signature of `map_function`, so PyWren injects the same arguments into it.
+    """
+
+    @functools.wraps(map_function)
+    def traced_function(**kwargs):
+        global _tracer
+        if 'ibm_cos' in kwargs:
+            kwargs['ibm_cos'] = CountingCOSClient(kwargs['ibm_cos'])
+        if 'internal_storage' in kwargs:
+            kwargs['internal_storage'] = CountingInternalStorage(kwargs['internal_storage'])
+
+        _tracer = tracer = Tracer()
+        try:
+            with tracer.span('call'):
+                result = map_function(**kwargs)
+        finally:
+            _tracer = None
+        return result, {'pid': os.getpid(), 'spans': tracer.spans}
+
+    return traced_function
+
+
+class TracingExecutor(object):
+    """ Wraps an executor so that every call of every map is traced, while `get_result` returns the same results.
+
+    Every time results are collected, the trace of the executor so far is written to `{trace_dir}/{timestamp}_{id}.json`
+    in the Chrome trace format, which can be opened in Perfetto or chrome://tracing.
+    Each map is shown as a process with one track per call, where the time between the map being submitted and
+    the call starting is shown as a 'queued' span. Worker timestamps come from the workers' clocks,
+    so they are only as accurate as the clock synchronization between the driver and the workers.
+    """
+
+    def __init__(self, executor, trace_dir):
+        self._executor = executor
+        self.start = time.time()
+        trace_name = f'{datetime.now().strftime("%Y-%m-%d_%H:%M:%S")}_{uuid.uuid4().hex[:8]}'
+        self.trace_path = Path(trace_dir) / f'{trace_name}.json'
+        self.maps = []
+        self._future_calls = {}
+        self._read = set()
+
+    def __getattr__(self, name):
+        return getattr(self._executor, name)
+
+    def map(self, map_function, map_iterdata, **kwargs):
+        submitted = time.time()
+        futures = self._executor.map(traced(map_function), map_iterdata, **kwargs)
+        map_i = len(self.maps)
+        self.maps.append({'function': map_function.__name__, 'runtime_memory': kwargs.get('runtime_memory'),
+                          'submitted': submitted, 'collected': None, 'futures': futures,
+                          'traces': [None] * len(futures)})
+        for call_i, future in enumerate(futures):
+            self._future_calls[id(future)] = (map_i, call_i)
+        return futures
+
+    def get_result(self, futures=None, throw_except=True):
+        """ Returns results in the same shape as PyWren after a map: in a list, even for a single future, and without
+        `futures`, the results of all calls whose results haven't been returned that way yet
+        """
+        if futures is None:
+            futures = [future for map_ in self.maps for future in map_['futures'] if id(future) not in self._read]
+            self._read.update(id(future) for future in futures)
+        elif isinstance(futures, (list, tuple)):
+            futures = list(futures)
+        else:
+            futures = [futures]
+        # PyWren would return the results of all its calls for an empty list
+        traced_results = self._executor.get_result(futures, throw_except=throw_except) if futures else []
+
+        results = []
+        for future, traced_result in zip(futures, traced_results):
+            map_i, call_i = self._future_calls[id(future)]
+            if traced_result is None:
+                results.append(None)
+                continue
+            result, self.maps[map_i]['traces'][call_i] = traced_result
+            self.maps[map_i]['collected'] = time.time()
+            results.append(result)
+
+        self.save_chrome_trace()
+        return results
+
+    def chrome_trace(self):
+        """ Returns the trace of all maps so far as a Chrome trace dict """
+
+        def _us(timestamp):
+            return round((timestamp - self.start) * 1e6)
+
+        def _complete_event(name, start, end, pid, tid, args=None):
+            return {'name': name, 'ph': 'X', 'ts': _us(start), 'dur': _us(end) - _us(start),
+                    'pid': pid, 'tid': tid, 'args': args or {}}
+
+        def _metadata_event(name, pid, tid, value):
+            return {'name': name, 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': value}}
+
+        events = [_metadata_event('process_name', 0, 0, 'driver'), _metadata_event('thread_name', 0, 0, 'maps')]
+        for map_i, map_ in enumerate(self.maps):
+            pid = map_i + 1
+            events.append(_metadata_event('process_name', pid, 0, f'map {map_i}: {map_["function"]}'))
+            events.append({'name': 'process_sort_index', 'ph': 'M', 'pid': pid, 'args': {'sort_index': pid}})
+            if map_['collected']:
+                events.append(_complete_event(map_['function'], map_['submitted'], map_['collected'], 0, 0,
+                                              {'calls': len(map_['futures']),
+                                               'runtime_memory_mb': map_['runtime_memory']}))
+
+            for call_i, trace in enumerate(map_['traces']):
+                if trace is None:
+                    continue
+                events.append(_metadata_event('thread_name', pid, call_i, f'call {call_i}'))
+                call_span = next(span for span in trace['spans'] if span['name'] == 'call')
+                events.append(_complete_event('queued', map_['submitted'], call_span['start'], pid, call_i))
+                for span in trace['spans']:
+                    args = dict(span['args'], worker_pid=trace['pid'])
+                    if span is call_span:
+                        args['runtime_memory_mb'] = map_['runtime_memory']
+                    events.append(_complete_event(span['name'], span['start'], span['end'], pid, call_i, args))
+
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save_chrome_trace(self, path=None):
+        path = Path(path or self.trace_path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+        logger.info(f'Saved trace of {len(self.maps)} maps to {path}')
+        return path
@@ -6,6 +6,11 @@ import ibm_boto3
 import ibm_botocore
 import pandas as pd
 import csv
+import hashlib
+import json
+from collections import OrderedDict
+
+from annotation_pipeline.tracing import count
 
 logging.getLogger('ibm_boto3').setLevel(logging.CRITICAL)
 logging.getLogger('ibm_botocore').setLevel(logging.CRITICAL)
@@ -20,9 +25,19 @@ logger = logging.getLogger('annotation-pipeline')
 # logger.setLevel(logging.INFO)
 
 STATUS_PATH = datetime.now().strftime("logs/%Y-%m-%d_%H:%M:%S.csv")
+CF_PRICE_PER_GB_S = 0.000017  # IBM Cloud Functions price in dollars
+# Statistics of every map call of this process, in addition to the summary appended to the STATUS_PATH csv
+PYWREN_STATS = []
 
 
 def get_ibm_cos_client(config):
+    if 'local_cos' in config:
+        from annotation_pipeline.storage import LocalCOSClient
+        local_cos = config['local_cos']
+        return LocalCOSClient(local_cos['path'],
+                              latency_ms=local_cos.get('latency_ms', 0),
+                              bandwidth_mbps=local_cos.get('bandwidth_mbps'))
+
     client_config = ibm_botocore.client.Config(connect_timeout=1,
                                                read_timeout=3,
                                                retries={'max_attempts': 5})
@@ -55,6 +70,18 @@ def list_keys(bucket, prefix, cos_client):
     return key_list
 
 
+def list_prefixes(bucket, prefix, cos_client):
+    """ Lists the "directories" directly under `prefix`, without listing the objects in them """
+    paginator = cos_client.get_paginator('list_objects_v2')
+    page_iterator = paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/')
+
+    prefix_list = []
+    for page in page_iterator:
+        for item in page.get('CommonPrefixes', []):
+            prefix_list.append(item['Prefix'])
+    return prefix_list
+
+
 def clean_from_cos(config, bucket, prefix, cos_client=None):
     if not cos_client:
         cos_client = get_ibm_cos_client(config)
@@ -94,13 +121,87 @@ def get_pixel_indices(coordinates):
     return pixel_indices
 
 
+def merge_sorted_runs(runs, key='mz', out=None, block_rows=4096):
+    """ Merges runs of equally long columns, each sorted by `key`, into a single sorted set of columns.
+
+    Runs are consumed in blocks: every step takes the rows of all runs up to the smallest last key of their next
+    `block_rows` rows, so only a small, cache-friendly batch is sorted at a time and each row is copied once
+    into the output.
+    Runs that don't overlap, e.g. consecutive dataset segments, are copied one after another without sorting.
+
+    Args
+    -----
+    runs : list[OrderedDict[str, ndarray]]
+    key : str
+    out : OrderedDict[str, ndarray]
+        optional preallocated output columns, at least as long as all runs together
+    block_rows : int
+
+    Returns
+    -----
+        OrderedDict[str, ndarray]
+    """
+    runs = [run for run in runs if len(run[key]) > 0]
+    total_n = sum(len(run[key]) for run in runs)
+    if out is None:
+        if not runs:
+            return OrderedDict()
+        out = OrderedDict((name, np.empty(total_n, dtype=np.result_type(*[run[name] for run in runs])))
+                          for name in runs[0])
+    out = OrderedDict((name, arr[:total_n]) for name, arr in out.items())
+
+    def _copy(row_i, run_i, start, end):
+        for name, arr in out.items():
+            arr[row_i:row_i + end - start] = runs[run_i][name][start:end]
+        return row_i + end - start
+
+    row_i = 0
+    if all(prev_run[key][-1] <= run[key][0] for prev_run, run in zip(runs, runs[1:])):
+        for run_i, run in enumerate(runs):
+            row_i = _copy(row_i, run_i, 0, len(run[key]))
+        return out
+
+    positions = [0] * len(runs)
+    active = list(range(len(runs)))
+    while active:
+        cut = min(runs[run_i][key][min(positions[run_i] + block_rows, len(runs[run_i][key])) - 1]
+                  for run_i in active)
+        slices = []
+        for run_i in active:
+            start = positions[run_i]
+            end = start + np.searchsorted(runs[run_i][key][start:], cut, side='right')
+            if end > start:
+                slices.append((run_i, start, end))
+                positions[run_i] = end
+
+        if len(slices) == 1:
+            row_i = _copy(row_i, *slices[0])
+        else:
+            by_key = np.concatenate([runs[run_i][key][start:end] for run_i, start, end in slices]).argsort()
+            batch_n = len(by_key)
+            for name, arr in out.items():
+                batch = np.concatenate([runs[run_i][name][start:end] for run_i, start, end in slices])
+                arr[row_i:row_i + batch_n] = batch[by_key]
+            row_i += batch_n
+        active = [run_i for run_i in active if positions[run_i] < len(runs[run_i][key])]
+
+    return out
+
+
 def append_pywren_stats(futures, memory, plus_objects=0, minus_objects=0):
     if type(futures) != list:
         futures = [futures]
 
     actions_num = len(futures)
     func_name = futures[0].function_name
-    average_runtime = np.average([future._call_status['exec_time'] for future in futures])
+    exec_times = [future._call_status['exec_time'] for future in futures]
+    average_runtime = np.average(exec_times)
+    cos_stats = [future._call_status.get('cos_stats') or {} for future in futures]
+    PYWREN_STATS.append({'function': func_name, 'actions': actions_num, 'memory': memory, 'exec_times': exec_times,
+                         'gb_seconds': sum(exec_times) * memory / 1024,
+                         'plus_objects': plus_objects, 'minus_objects': minus_objects,
+                         **{f'cos_{stat}': sum(stats.get(stat, 0) for stats in cos_stats)
+                            for stat in ('requests', 'bytes_read', 'bytes_written')}})
     headers = ['Function', 'Actions', 'Memory', 'Runtime', '+Objects', '-Objects']
     content = [func_name, actions_num, memory, average_runtime, plus_objects, minus_objects]
 
@@ -117,18 +218,19 @@ def append_pywren_stats(futures, memory, plus_objects=0, minus_objects=0):
 
 def get_pywren_stats(log_path=STATUS_PATH):
     stats = pd.read_csv(log_path)
-    unit_price_in_dollars = 0.000017
-    calc_func = lambda row: row[1] * (row[2] / 1024) * row[3] * unit_price_in_dollars
+    calc_func = lambda row: row[1] * (row[2] / 1024) * row[3] * CF_PRICE_PER_GB_S
     print('Total PyWren cost:', np.sum(np.apply_along_axis(calc_func, 1, stats)), '$')
     return stats
 
 
-def read_object_with_retry(ibm_cos, bucket, key, stream_reader=None):
+def read_object_with_retry(ibm_cos, bucket, key, stream_reader=None, byte_range=None):
+    """ Reads an object, or only the bytes in the [start, end) `byte_range` if specified """
     last_exception = None
+    range_kwargs = {'Range': f'bytes={byte_range[0]}-{byte_range[1] - 1}'} if byte_range else {}
     for attempt in range(1, 4):
         try:
             print(f'Reading {key} (attempt {attempt})')
-            data_stream = ibm_cos.get_object(Bucket=bucket, Key=key)['Body']
+            data_stream = ibm_cos.get_object(Bucket=bucket, Key=key, **range_kwargs)['Body']
             if stream_reader:
                 data = stream_reader(data_stream)
             else:
@@ -139,4 +241,25 @@ def read_object_with_retry(ibm_cos, bucket, key, stream_reader=None):
         except Exception as ex:
             print(f'Exception reading {key} (attempt {attempt}): ', ex)
             last_exception = ex
+            if attempt < 3:
+                count(retries=1)
     raise last_exception
+
+
+def content_hash(*parts):
+    """ MD5 hex digest of `parts`, which can be bytes or anything that can be serialized to JSON """
+    m = hashlib.md5()
+    for part in parts:
+        m.update(part if isinstance(part, bytes) else json.dumps(part, sort_keys=True).encode('utf-8'))
+    return m.hexdigest()
+
+
+def read_manifest(ibm_cos, bucket, key):
+    try:
+        return json.loads(ibm_cos.get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8'))
+    except ibm_botocore.client.ClientError:
+        return None
+
+
+def write_manifest(ibm_cos, bucket, key, manifest):
+    ibm_cos.put_object(Bucket=bucket, Key=key, Body=json.dumps(manifest, indent=2).encode('utf-8'))
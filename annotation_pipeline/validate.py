@@ -1,5 +1,6 @@
 import numpy as np
 from collections import OrderedDict
+from scipy.sparse import coo_matrix
 
 from pyImagingMSpec.image_measures import isotope_image_correlation, isotope_pattern_match
 from cpyImagingMSpec import measure_of_chaos
@@ -10,6 +11,9 @@ METRICS = OrderedDict([('chaos', 0), ('spatial', 0), ('spectral', 0), ('msm', 0)
                        ('min_iso_ints', [0, 0, 0, 0]),
                        ('max_iso_ints', [0, 0, 0, 0])])
 
+# pixels of the dense sample area images correlated at once by the batch metrics, 32MB of float64
+SPATIAL_CHUNK_PX = 4 * 1024 ** 2
+
 
 def replace_nan(v, default=0):
     def replace(x):
@@ -76,6 +80,116 @@ def make_compute_image_metrics(sample_area_mask, nrows, ncols, img_gen_config):
     return compute
 
 
+def make_compute_image_metrics_batch(sample_area_mask, nrows, ncols, img_gen_config):
+    """ Returns a function for computing image metrics of many formulas at once
+
+    Spectral scores are calculated with sparse matrix products over the sample area pixels instead of densifying
+    each isotope image. Spatial scores are only calculated for formulas that pass the spectral check, densifying
+    their images a chunk of formulas at a time and centering them before the correlation, as np.corrcoef does.
+    Only images of formulas that pass both checks are converted to dense arrays for measure_of_chaos.
+    Scores match those of `make_compute_image_metrics` up to floating point rounding.
+
+    Args
+    -----
+    sample_area_mask: ndarray[bool]
+        mask for separating sampled pixels (True) from non-sampled (False)
+
+    img_gen_config : dict
+        isotope_generation section of the dataset config
+    Returns
+    -----
+        function
+    """
+    compute = make_compute_image_metrics(sample_area_mask, nrows, ncols, img_gen_config)
+    sample_area_px = np.flatnonzero(sample_area_mask.flatten())
+    sample_px_n = len(sample_area_px)
+    nlevels = img_gen_config.get('nlevels', 30)
+
+    def stack_images(formulas_images, iso_n):
+        rows, cols, data = [], [], []
+        for f_pos, f_images in enumerate(formulas_images):
+            for peak_pos, img in enumerate(f_images[:iso_n]):
+                if img is not None:
+                    rows.append(np.full(img.nnz, f_pos * iso_n + peak_pos))
+                    cols.append(img.row.astype(np.int64) * ncols + img.col)
+                    data.append(img.data)
+        shape = (len(formulas_images) * iso_n, nrows * ncols)
+        if not data:
+            return coo_matrix(shape).tocsr()
+        images = coo_matrix((np.concatenate(data).astype(np.float64),
+                             (np.concatenate(rows), np.concatenate(cols))), shape=shape)
+        return images.tocsr()  # duplicated pixels are summed, as in toarray()
+
+    def row_sums(m):
+        return np.asarray(m.sum(axis=1)).ravel()
+
+    def compute_batch(formulas_ints, formulas_images):
+        """ Returns a list with the metrics of each formula, in the same order as the arguments """
+        if img_gen_config.get('do_preprocessing', False):
+            # Hot spot removal is applied to dense images
+            return [compute(f_images, f_ints) for f_ints, f_images in zip(formulas_ints, formulas_images)]
+
+        if len(formulas_images) == 0:
+            return []
+        formulas_ints = np.asarray(formulas_ints, dtype=np.float64)
+        formulas_n, iso_n = formulas_ints.shape
+
+        images = stack_images(formulas_images, iso_n)
+        sample_images = images[:, sample_area_px]
+        iso_images = [sample_images[peak_pos::iso_n] for peak_pos in range(iso_n)]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # Spectral: isotope intensities summed over the pixels where the principal peak is present
+            not_null = (iso_images[0] > 0).astype(np.float64)
+            image_ints = np.stack([row_sums(img.multiply(not_null)) for img in iso_images], axis=1)
+            theor_norm = formulas_ints / np.linalg.norm(formulas_ints, axis=1, keepdims=True)
+            image_norm = image_ints / np.linalg.norm(image_ints, axis=1, keepdims=True)
+            spectral = 1 - np.mean(np.abs(theor_norm - image_norm), axis=1)
+            spectral[spectral == 1.] = 0
+
+            # Spatial: weighted pearson correlation of each isotope image with the principal one
+            spatial = np.zeros(formulas_n)
+            spatial_f_pos = np.flatnonzero((spectral > 0) & (row_sums(not_null) >= 2))
+            chunk_n = max(1, SPATIAL_CHUNK_PX // (iso_n * max(sample_px_n, 1)))
+            for chunk_start in range(0, len(spatial_f_pos), chunk_n):
+                chunk_f_pos = spatial_f_pos[chunk_start:chunk_start + chunk_n]
+                rows = (chunk_f_pos[:, None] * iso_n + np.arange(iso_n)).ravel()
+                chunk = sample_images[rows].toarray().reshape(len(chunk_f_pos), iso_n, sample_px_n)
+                chunk -= chunk.mean(axis=2, keepdims=True)
+                std = np.sqrt(np.einsum('fip,fip->fi', chunk, chunk))
+                cov = np.einsum('fp,fip->fi', chunk[:, 0], chunk[:, 1:])
+                corr = np.clip(cov / std[:, :1] / std[:, 1:], -1, 1)
+                corr[np.isinf(corr) | np.isnan(corr)] = 0
+                weights = formulas_ints[chunk_f_pos, 1:]
+                spatial[chunk_f_pos] = np.clip(np.sum(corr * weights, axis=1) / np.sum(weights, axis=1), 0, 1)
+
+        total_ints = row_sums(images).reshape(formulas_n, iso_n)
+        min_ints = images.min(axis=1).toarray().reshape(formulas_n, iso_n)
+        max_ints = images.max(axis=1).toarray().reshape(formulas_n, iso_n)
+
+        metrics_list = []
+        for f_pos, f_images in enumerate(formulas_images):
+            m = METRICS.copy()
+            m['spectral'] = spectral[f_pos]
+            if m['spectral'] > 0:
+
+                m['spatial'] = spatial[f_pos]
+                if m['spatial'] > 0:
+
+                    moc = measure_of_chaos(f_images[0].toarray(), nlevels)
+                    m['chaos'] = 0 if np.isclose(moc, 1.0) else moc
+                    if m['chaos'] > 0:
+
+                        m['msm'] = m['chaos'] * m['spatial'] * m['spectral']
+                        m['total_iso_ints'] = list(total_ints[f_pos])
+                        m['min_iso_ints'] = list(min_ints[f_pos])
+                        m['max_iso_ints'] = list(max_ints[f_pos])
+            metrics_list.append(OrderedDict((k, replace_nan(v)) for k, v in m.items()))
+        return metrics_list
+
+    return compute_batch
+
+
 def complete_image_list(images):
     non_empty_image_n = sum(1 for img in images if img is not None)
     return non_empty_image_n > 1 and images[0] is not None
@@ -100,3 +214,32 @@ def formula_image_metrics(formula_images_it, compute_metrics, images_manager):
             f_metrics = compute_metrics(f_images, f_ints)
             if f_metrics['msm'] > 0:
                 images_manager(f_i, f_metrics, f_images)
+
+
+def formula_image_metrics_batch(formula_images_it, compute_metrics_batch, images_manager, batch_size=1000):
+    """ Compute isotope image metrics for batches of formulas
+
+    Args
+    ---
+    formula_images_it: Iterator
+    compute_metrics_batch: function
+    images_manager: ImagesManager
+    batch_size: int
+        number of formulas scored together
+    """
+
+    def score(batch):
+        f_is, f_ints, f_images = zip(*batch)
+        for f_i, f_metrics, images in zip(f_is, compute_metrics_batch(f_ints, f_images), f_images):
+            if f_metrics['msm'] > 0:
+                images_manager(f_i, f_metrics, images)
+
+    batch = []
+    for f_i, f_ints, f_images in formula_images_it:
+        if complete_image_list(f_images):
+            batch.append((f_i, f_ints, f_images))
+            if len(batch) == batch_size:
+                score(batch)
+                batch = []
+    if batch:
+        score(batch)
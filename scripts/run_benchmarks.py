@@ -0,0 +1,45 @@
+import argparse
+import json
+import sys
+from tempfile import TemporaryDirectory
+
+from annotation_pipeline.benchmark import BENCHMARKS, BenchmarkContext, run_benchmarks, compare_results, load_results
+
+import logging
+logging.basicConfig(level=logging.INFO)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run stage benchmarks over a synthetic dataset and database')
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help='benchmarks to run (default: all)')
+    parser.add_argument('--output', default='benchmarks.json', help='path of the JSON results')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare with')
+    parser.add_argument('--max-slowdown', type=float, default=1.2,
+                        help='exit with an error if a benchmark is slower than the compared one by this factor')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--work-dir', help='directory for the synthetic inputs (default: a temporary directory)')
+    parser.add_argument('--rows', type=int, default=50)
+    parser.add_argument('--cols', type=int, default=50)
+    parser.add_argument('--peaks', type=int, default=1000, help='peaks per spectrum')
+    parser.add_argument('--mz-precision', choices=['f', 'd'], default='f')
+    parser.add_argument('--continuous', action='store_true', help='generate a continuous instead of processed imzML')
+    parser.add_argument('--formulas', type=int, default=5000, help='number of centroids formulas')
+    parser.add_argument('--mols', type=int, default=5000, help='number of molecules in the database')
+    parser.add_argument('--workers', type=int, help='local executor workers')
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as temp_dir:
+        ctx = BenchmarkContext(args.work_dir or temp_dir, nrows=args.rows, ncols=args.cols, peaks_n=args.peaks,
+                               mz_precision=args.mz_precision, continuous=args.continuous,
+                               formulas_n=args.formulas, mols_n=args.mols, workers=args.workers)
+        results = run_benchmarks(ctx, args.only, args.repeats)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {args.output}')
+
+    if args.compare:
+        ratios = compare_results(load_results(args.compare), results)
+        for name, ratio in ratios.items():
+            print(f'{name:30} {ratio:6.2f}x {"SLOWER" if ratio > args.max_slowdown else ""}')
+        if any(ratio > args.max_slowdown for ratio in ratios.values()):
+            sys.exit(1)
@@ -12,15 +12,20 @@ if __name__ == '__main__':
     parser.add_argument('--config', type=argparse.FileType('r'), default='config.json', help='config.json path')
     parser.add_argument('--input', type=argparse.FileType('r'), default='input_config.json',
                         help='input_config.json path')
+    parser.add_argument('--trace-dir', help='directory to save a Chrome trace of every call to, e.g. logs/traces')
+    parser.add_argument('--no-resume', action='store_true',
+                        help="run every stage, even if a previous run's checkpoint is still valid")
     args = parser.parse_args()
 
     start = time.time()
 
     config = json.load(args.config)
     input_config = json.load(args.input)
+    if args.trace_dir:
+        config.setdefault('executor', {})['trace_dir'] = args.trace_dir
 
     pipeline = Pipeline(config, input_config)
-    pipeline()
+    pipeline(resume=not args.no_resume)
     results_df = pipeline.get_results()
 
     print(f'--- {time.time() - start:.2f} seconds ---')
@@ -0,0 +1,59 @@
+import argparse
+import json
+from pathlib import Path
+
+import pandas as pd
+
+from annotation_pipeline.scaling import synthetic_input_config, prepare_databases, run_grid, results_to_df, \
+    strong_scaling_table, weak_scaling_table
+
+import logging
+logging.basicConfig(level=logging.INFO)
+
+
+def parse_size(size):
+    nrows, ncols = map(int, size.split('x'))
+    return nrows, ncols
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the whole pipeline over a grid of dataset sizes, '
+                                                 'database counts and worker counts')
+    parser.add_argument('--config', type=argparse.FileType('r'), default='config.json', help='config.json path')
+    parser.add_argument('--input', nargs='+', default=[],
+                        help='input_config.json paths of real datasets to include, e.g. input_config_small to '
+                             'input_config_huge4. Their relative work size for weak scaling is read from an optional '
+                             '"work" field of the dataset section')
+    parser.add_argument('--sizes', nargs='+', type=parse_size, default=[],
+                        help='synthetic dataset sizes as ROWSxCOLS, e.g. 50x50 100x100')
+    parser.add_argument('--peaks', type=int, default=1000, help='peaks per spectrum of synthetic datasets')
+    parser.add_argument('--dbs', nargs='+', type=int, default=[1], help='numbers of synthetic databases')
+    parser.add_argument('--mols', type=int, default=5000, help='molecules per synthetic database')
+    parser.add_argument('--workers', nargs='+', type=int, default=[1, 2, 4], help='numbers of local executor workers')
+    parser.add_argument('--work-dir', default='scaling', help='directory for synthetic datasets')
+    parser.add_argument('--output', default='scaling', help='prefix of the JSON results and CSV tables')
+    args = parser.parse_args()
+
+    config = json.load(args.config)
+    cases = []
+    for input_path in args.input:
+        with open(input_path) as f:
+            input_config = json.load(f)
+        prepare_databases(config, input_config)
+        cases.append((Path(input_path).stem, input_config, input_config['dataset'].get('work', 1)))
+    for nrows, ncols in args.sizes:
+        for dbs_n in args.dbs:
+            input_config = synthetic_input_config(config, args.work_dir, nrows, ncols, args.peaks, dbs_n, args.mols)
+            cases.append((f'{nrows}x{ncols}_dbs_{dbs_n}', input_config, nrows * ncols * args.peaks))
+
+    results = run_grid(config, cases, args.workers)
+    with open(f'{args.output}.json', 'w') as f:
+        json.dump(results, f, indent=2)
+
+    df = results_to_df(results)
+    df.to_csv(f'{args.output}_stages.csv', index=False)
+    with pd.option_context('display.width', 200, 'display.max_columns', 20, 'display.precision', 2):
+        for name, table in [('strong', strong_scaling_table(df)), ('weak', weak_scaling_table(df))]:
+            table.to_csv(f'{args.output}_{name}_scaling.csv')
+            print(f'\n{name.capitalize()} scaling efficiency per stage:\n{table}')
+        print(f'\nTotals:\n{df[df.stage == "total"][["case", "workers", "wall_s", "gb_seconds", "cost_usd"]]}')
@@ -0,0 +1,25 @@
+import os
+
+import pytest
+
+from annotation_pipeline.scaling import synthetic_input_config
+
+
+@pytest.fixture(scope='session', autouse=True)
+def work_dir(tmp_path_factory):
+    """ Runs the tests in a temporary directory, as the statistics of every map are written to `logs/` """
+    cwd = os.getcwd()
+    work_dir = tmp_path_factory.mktemp('work')
+    os.chdir(str(work_dir))
+    yield work_dir
+    os.chdir(cwd)
+
+
+@pytest.fixture(scope='session')
+def synthetic_case(work_dir):
+    """ Config and input config of a tiny synthetic dataset and database in a local COS, shared by all tests """
+    config = {'local_cos': {'path': str(work_dir / 'cos')},
+              'executor': {'type': 'local', 'workers': 4},
+              'storage': {'ds_bucket': 'ds', 'db_bucket': 'db', 'output_bucket': 'out'}}
+    input_config = synthetic_input_config(config, str(work_dir), 10, 10, 200, 1, mols_n=100, planted_formulas_n=50)
+    return config, input_config
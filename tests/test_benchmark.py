@@ -0,0 +1,15 @@
+import json
+
+from annotation_pipeline.benchmark import BENCHMARKS, BenchmarkContext, compare_results, run_benchmarks
+
+
+def test_run_benchmarks(tmp_path):
+    ctx = BenchmarkContext(str(tmp_path), nrows=5, ncols=5, peaks_n=100, formulas_n=200, mols_n=50, workers=4)
+    results = run_benchmarks(ctx, repeats=2)
+
+    assert list(results['benchmarks']) == list(BENCHMARKS)
+    for result in results['benchmarks'].values():
+        assert len(result['runs_s']) == 2 and result['min_s'] <= result['median_s']
+        assert result['items'] > 0
+    assert json.loads(json.dumps(results))['params'] == ctx.params
+    assert compare_results(results, results) == {name: 1 for name in BENCHMARKS}
@@ -0,0 +1,92 @@
+import time
+
+import numpy as np
+import pytest
+
+from annotation_pipeline.ds_cache import DatasetSegmentsCache
+from annotation_pipeline.storage import LocalCOSClient
+from annotation_pipeline.utils import list_keys, read_manifest, write_manifest
+
+DAY = 24 * 3600
+# 1MB per segment with the peak size of mz_precision 'f'
+SEGMS_LEN = [1024 ** 2 // 12] * 4
+
+
+@pytest.fixture
+def cos(tmp_path):
+    return LocalCOSClient(str(tmp_path))
+
+
+@pytest.fixture
+def cache(cos):
+    return DatasetSegmentsCache(cos, 'ds', 'cache', max_age_days=30, max_size_gb=10 / 1024)
+
+
+def _store(cos, cache, key, segms_len=SEGMS_LEN, complete=True):
+    cache.start(key)
+    for segm_i in range(len(segms_len)):
+        cos.put_object(Bucket='ds', Key=f'{cache.segments_prefix(key)}/{segm_i}.segm', Body=b'segm')
+    if complete:
+        cache.put(key, np.zeros((len(segms_len), 2)), segms_len, 'f')
+
+
+def _age(cos, cache, key, days):
+    manifest_key = f'{cache.segments_prefix(key)}/manifest.json'
+    manifest = read_manifest(cos, 'ds', manifest_key)
+    manifest['last_used'] -= days * DAY
+    write_manifest(cos, 'ds', manifest_key, manifest)
+
+
+def _cached_keys(cos):
+    return sorted({key.split('/')[1] for key in list_keys('ds', 'cache/', cos)})
+
+
+def test_get_complete_datasets(cos, cache):
+    _store(cos, cache, 'a')
+    _store(cos, cache, 'b', complete=False)
+
+    manifest = cache.get('a')
+    assert manifest['ds_segm_n'] == 4 and manifest['ds_segms_len'] == SEGMS_LEN
+    assert manifest['size_mb'] == pytest.approx(4, rel=1e-3)
+    assert cache.get('b') is None and cache.get('c') is None
+
+
+def test_get_marks_datasets_as_used(cos, cache):
+    _store(cos, cache, 'a')
+    _age(cos, cache, 'a', 10)
+
+    cache.get('a')
+    assert time.time() - read_manifest(cos, 'ds', 'cache/a/manifest.json')['last_used'] < DAY
+
+
+def test_evict_old_and_least_recently_used(cos, cache):
+    _store(cos, cache, 'a')
+    _store(cos, cache, 'b')
+    _age(cos, cache, 'a', 40)
+    _age(cos, cache, 'b', 1)
+
+    # 'a' is too old
+    _store(cos, cache, 'c')
+    assert _cached_keys(cos) == ['b', 'c']
+    # 'b' is the least recently used and 'd' doesn't fit in 10MB with it
+    _store(cos, cache, 'd')
+    assert _cached_keys(cos) == ['c', 'd']
+
+
+def test_evict_incomplete_datasets(cos, cache):
+    _store(cos, cache, 'a', complete=False)
+    _store(cos, cache, 'b', complete=False)
+    _age(cos, cache, 'a', 2)
+    # Segments of an interrupted eviction, without a manifest
+    cos.put_object(Bucket='ds', Key='cache/c/0.segm', Body=b'segm')
+
+    cache.evict()
+    assert _cached_keys(cos) == ['b']
+
+
+def test_evict_keeps_dataset_in_use(cos, cache):
+    _store(cos, cache, 'a', segms_len=SEGMS_LEN * 4)
+    _age(cos, cache, 'a', 40)
+
+    assert cache.get('a') is not None
+    assert _cached_keys(cos) == ['a']
@@ -0,0 +1,208 @@
+import os
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from annotation_pipeline.executor import LocalExecutor, MemoryLimitExceeded, is_memory_error, iter_completed, \
+    ALL_COMPLETED, ANY_COMPLETED
+from annotation_pipeline.utils import logger
+
+
+@pytest.fixture
+def pw(tmp_path):
+    return LocalExecutor({'local_cos': {'path': str(tmp_path)}, 'storage': {'output_bucket': 'out'}}, workers=2)
+
+
+@pytest.mark.parametrize('ex, expected', [
+    (MemoryError(), True),
+    (MemoryLimitExceeded('Call 0 of f exceeded its memory limit of 256MB'), True),
+    (MemoryError('Function exceeded maximum memory and was killed'), True),
+    (ValueError('ndarray is not C-contiguous, check its memory layout'), False),
+    (OSError('[Errno 12] Cannot allocate shared memory'), False),
+    (Exception('Out of memory'), False),
+    (TimeoutError('Function exceeded maximum time of 600 seconds and was killed'), False),
+])
+def test_is_memory_error(ex, expected):
+    assert is_memory_error(ex) == expected
+
+
+def test_iterdata_is_mapped_to_arguments(pw):
+    def add(x, y=0, id=None):
+        return id, x + y
+
+    futures = pw.map(add, [1, (2, 3), {'x': 4, 'y': 5}])
+    assert pw.get_result(futures) == [(0, 1), (1, 5), (2, 9)]
+
+
+def test_objects_are_mapped_by_prefix(pw):
+    for key in ['a/0', 'a/1', 'b/0']:
+        pw.ibm_cos.put_object(Bucket='in', Key=key, Body=key.encode())
+
+    def read(obj, ibm_cos, internal_storage):
+        stored = internal_storage.put_object(obj.data_stream.read())
+        return obj.key, internal_storage.get_object(stored), ibm_cos.get_object(Bucket='in', Key=obj.key)['Body'].read()
+
+    assert sorted(pw.get_result(pw.map(read, 'in/a/'))) == [('a/0', b'a/0', b'a/0'), ('a/1', b'a/1', b'a/1')]
+    assert pw.get_result(pw.map(read, ['in/b/0'])) == [('b/0', b'b/0', b'b/0')]
+
+
+def test_get_result_returns_lists(pw):
+    futures = pw.map(lambda x: x, [0, 1, 2])
+    assert pw.get_result(futures) == [0, 1, 2]
+    # As with PyWren after a map, even the result of a single future is returned in a list
+    assert pw.get_result(futures[1]) == [1]
+    assert pw.get_result([futures[1]]) == [1]
+
+
+def test_get_result_of_unread_calls(pw):
+    futures = pw.map(lambda x: x, [0, 1])
+    pw.get_result(futures[0])
+    pw.map(lambda x: x * 10, [1, 2])
+    # Without futures, the results of all calls that no previous call without futures returned are returned
+    assert pw.get_result() == [0, 1, 10, 20]
+    assert pw.get_result() == []
+    pw.map(lambda x: x, [3])
+    assert pw.get_result() == [3]
+
+
+def test_calls_are_forked_without_threads(pw):
+    threads_n = threading.active_count()
+
+    def log(x):
+        # Forking while another thread held the logging lock would deadlock here
+        logger.info(f'Call {x}')
+        return os.getppid()
+
+    futures = pw.map(log, range(4))
+    assert threading.active_count() == threads_n
+    assert pw.get_result(futures) == [os.getpid()] * 4
+    assert threading.active_count() == threads_n
+
+
+def test_call_exceeding_memory_limit(pw):
+    def allocate(mb):
+        data = np.ones(mb * 1024 ** 2, dtype=np.uint8)
+        return int(data.sum())
+
+    futures = pw.map(allocate, [16, 512], runtime_memory=256)
+    assert pw.get_result(futures[0]) == [16 * 1024 ** 2]
+    with pytest.raises(MemoryLimitExceeded):
+        pw.get_result(futures[1])
+
+
+def test_call_errors_are_raised(pw):
+    def fail(x):
+        raise ValueError(f'bad memory layout {x}')
+
+    futures = pw.map(fail, [1])
+    with pytest.raises(ValueError) as exc_info:
+        pw.get_result(futures)
+    assert not is_memory_error(exc_info.value)
+
+
+def _max_concurrent(intervals):
+    events = sorted([(start, 1) for start, _ in intervals] + [(end, -1) for _, end in intervals])
+    return max(np.cumsum([delta for _, delta in events]))
+
+
+def test_maps_share_workers_and_memory(tmp_path):
+    pw = LocalExecutor({'local_cos': {'path': str(tmp_path)}, 'storage': {'output_bucket': 'out'}},
+                       workers=3, total_memory_mb=1000)
+
+    def run(x):
+        start = time.time()
+        time.sleep(0.2)
+        return start, time.time()
+
+    futures = pw.map(run, range(4), runtime_memory=100) + pw.map(run, range(4), runtime_memory=100)
+    assert _max_concurrent(pw.get_result(futures)) <= 3
+
+    futures = pw.map(run, range(3), runtime_memory=400) + pw.map(run, range(3), runtime_memory=400)
+    assert _max_concurrent(pw.get_result(futures)) <= 2
+
+
+def test_wait(pw):
+    def sleep(seconds):
+        time.sleep(seconds)
+        return seconds
+
+    futures = pw.map(sleep, [0, 5])
+    done, not_done = pw.wait(futures, return_when=ANY_COMPLETED)
+    assert done == [futures[0]] and not_done == [futures[1]]
+    assert futures[0]._call_status['exec_time'] >= 0
+    futures[1].cancel()
+    done, not_done = pw.wait(futures, throw_except=False, return_when=ALL_COMPLETED)
+    assert len(done) == 2 and pw.get_result(futures[1], throw_except=False) == [None]
+
+
+def test_iter_completed_resubmits_stragglers(pw, tmp_path):
+    def run(i, marker_dir=str(tmp_path)):
+        # Only the first attempt of the last call is slow
+        marker = Path(marker_dir) / str(i)
+        if i == 3 and not marker.exists():
+            marker.touch()
+            time.sleep(60)
+        # Long enough for the median duration to not depend on how long processes take to start
+        time.sleep(0.5)
+        return i
+
+    futures = pw.map(run, range(4))
+    resubmitted = []
+
+    def resubmit(i):
+        resubmitted.append(i)
+        return pw.map(run, [i])[0]
+
+    start = time.time()
+    results = {i: pw.get_result([future])[0] for i, future in iter_completed(pw, futures, resubmit, slowdown=2,
+                                                                      poll_interval=0.1)}
+    assert results == {0: 0, 1: 1, 2: 2, 3: 3}
+    assert resubmitted == [3] and time.time() - start < 30
+    # The straggler was cancelled, which frees its worker
+    pw.wait(futures, throw_except=False)
+    assert futures[3].cancelled and pw.get_result(futures[3], throw_except=False) == [None]
+
+
+class StoppingInvokerExecutor(LocalExecutor):
+    """ Drops the calls that haven't started whenever results are collected, as PyWren's invoker does when
+    `get_result` stops it, except that they fail instead of never finishing
+    """
+
+    def get_result(self, futures=None, throw_except=True):
+        results = super().get_result(futures, throw_except=throw_except)
+        for future, *_ in self._queue:
+            future._set_exception(RuntimeError(f'Call {future.call_id} was dropped'))
+        self._queue.clear()
+        return results
+
+
+def test_iter_completed_yields_once_all_calls_started(tmp_path):
+    pw = StoppingInvokerExecutor({'local_cos': {'path': str(tmp_path)}, 'storage': {'output_bucket': 'out'}},
+                                 workers=2)
+
+    def run(i):
+        time.sleep(0.1 if i < 2 else 0.5)
+        return i
+
+    futures = pw.map(run, range(6))
+    started = []
+    for i, future in iter_completed(pw, futures, poll_interval=0.05):
+        started.append(sum(call_future._call_status.get('start_time') is not None for call_future in futures))
+        assert pw.get_result([future]) == [i]
+    assert started == [6] * 6
+
+
+def test_iter_completed_yields_failures(pw):
+    def run(i):
+        if i == 1:
+            raise ValueError(i)
+        return i
+
+    futures = pw.map(run, range(3))
+    completed = dict(iter_completed(pw, futures))
+    assert sorted(completed) == [0, 1, 2]
+    with pytest.raises(ValueError):
+        pw.get_result(completed[1])
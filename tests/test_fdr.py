@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from annotation_pipeline.fdr import MsmVector, lookup_msm, run_fdr_ranking
+
+
+def _pandas_fdr_ranking(target_msm, decoy_msms):
+    """ FDR ranking of the original implementation, with one ranking per target and decoy adduct pair """
+    target = pd.DataFrame({'msm': target_msm})
+    rankings = []
+    for decoy_msm in decoy_msms:
+        decoy = pd.DataFrame({'msm': decoy_msm})
+        merged = pd.concat([target.assign(is_target=1), decoy.assign(is_target=0)], sort=False)
+        merged = merged.sort_values('msm', ascending=False)
+        decoy_cumsum = (merged.is_target == False).cumsum()
+        target_cumsum = merged.is_target.cumsum()
+        base_fdr = np.clip(decoy_cumsum / target_cumsum, 0, 1)
+        base_fdr[np.isnan(base_fdr)] = 1
+        target_fdrs = merged.assign(fdr=base_fdr)[lambda df: df.is_target == 1]
+        target_fdrs = target_fdrs.drop('is_target', axis=1)
+        target_fdrs = target_fdrs.sort_values('msm')
+        target_fdrs = target_fdrs.assign(fdr=np.minimum.accumulate(target_fdrs.fdr))
+        rankings.append(target_fdrs.sort_index())
+    return pd.concat(rankings).groupby(level=0).fdr.agg(np.nanmedian).sort_index().values
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('target_n, decoy_n, decoys_n', [(1, 1, 1), (100, 100, 1), (500, 300, 20), (50, 2000, 5)])
+def test_run_fdr_ranking(seed, target_n, decoy_n, decoys_n):
+    rs = np.random.RandomState(seed)
+    # Decoys score lower on average, as they do in real datasets
+    target_msm = rs.uniform(0, 1, target_n)
+    decoy_msms = [rs.uniform(0, 1, rs.randint(decoy_n // 2, decoy_n + 1)) ** 2 for _ in range(decoys_n)]
+
+    np.testing.assert_allclose(run_fdr_ranking(target_msm, decoy_msms),
+                               _pandas_fdr_ranking(target_msm, decoy_msms))
+
+
+def test_run_fdr_ranking_is_monotonic():
+    target_msm = np.array([0.9, 0.5, 0.1])
+    # The second decoy ranking has a FDR of 2 / 2 at 0.5, which is lowered to the 2 / 3 at 0.1
+    fdrs = run_fdr_ranking(target_msm, [np.array([0.05]), np.array([0.6, 0.7])])
+    np.testing.assert_allclose(fdrs, [0, 1 / 3, 1 / 3])
+
+
+def test_run_fdr_ranking_counts_tied_scores_as_hits():
+    # Two molecules share the formula scoring 0.5. At 0.5, there are 3 targets and 2 decoys, including both
+    # molecules and the decoy with the same score, whereas the original implementation's FDRs of the tied targets
+    # depended on their order in its sort. The 0.9 target can't have a higher FDR than lower scores.
+    fdrs = run_fdr_ranking(np.array([0.5, 0.9, 0.5]), [np.array([0.95, 0.5])])
+    np.testing.assert_allclose(fdrs, [2 / 3, 2 / 3, 2 / 3])
+    fdrs = run_fdr_ranking(np.array([0.5, 0.9, 0.5]), [np.array([0.95, 0.5]), np.array([0.95, 0.4])])
+    np.testing.assert_allclose(fdrs, [(2 / 3 + 1 / 3) / 2] * 3)
+
+
+def test_msm_vector():
+    msm_vector = MsmVector()
+    msm_vector.add([3, 1], [0.3, 0.1])
+    msm_vector.add(np.array([10]), [0.5])
+    msm_vector.add([], [])
+
+    assert msm_vector.scored_n == 3
+    np.testing.assert_array_equal(lookup_msm(msm_vector.msm, np.array([1, 3, 10, 0, -1, 1000])),
+                                  [0.1, 0.3, 0.5, np.nan, np.nan, np.nan])
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from annotation_pipeline.formula_parser import generate_ion_formula, safe_generate_ion_formula, parse_formulas, \
+    safe_generate_ion_formulas, is_valid_formula, ParseFormulaError
+
+ELEMENTS = ['C', 'H', 'N', 'O', 'P', 'S', 'Cl', 'Na', 'K', 'Fe']
+
+
+def _random_formulas(n, seed=0):
+    rs = np.random.RandomState(seed)
+    formulas = []
+    for _ in range(n):
+        elements = rs.choice(ELEMENTS, rs.randint(1, 5), replace=False)
+        formulas.append(''.join(f'{elem}{rs.choice(["", "1", "2", str(rs.randint(3, 60))])}' for elem in elements))
+    return formulas + ['H', 'H2O', 'Na', 'CH4', 'C6H12O6.H2O', 'O=C=O', 'HCl']
+
+
+def test_generate_ion_formula():
+    assert generate_ion_formula('C6H12O6', '+H') == 'C6H13O6'
+    assert generate_ion_formula('C6H12O6', '-H2O', '+Na') == 'C6H10NaO5'
+    assert generate_ion_formula('NaCl', '+K') == 'ClKNa'
+    assert generate_ion_formula('H2O', '-H') == 'HO'
+    with pytest.raises(ParseFormulaError):
+        generate_ion_formula('H2O', '-Na')
+    with pytest.raises(ParseFormulaError):
+        generate_ion_formula('H', '-H')
+    assert safe_generate_ion_formula('H', '', '-H') is None
+
+
+@pytest.mark.parametrize('modifier', ['', '-H2O', '+CO2', '-CH4'])
+@pytest.mark.parametrize('adduct', ['+H', '-H', '+Na', '+K', '+He', '+Fe', '-Cl'])
+def test_safe_generate_ion_formulas(modifier, adduct):
+    formulas = _random_formulas(500)
+    elements, counts = parse_formulas(formulas)
+
+    expected = [safe_generate_ion_formula(formula, modifier, adduct) for formula in formulas]
+    assert safe_generate_ion_formulas(elements, counts, modifier, adduct) == expected
+
+
+def test_is_valid_formula():
+    assert is_valid_formula('C6H12O6', ELEMENTS)
+    assert not is_valid_formula('C6H12O6X', ELEMENTS)
+    assert not is_valid_formula('C6H12O6.H2O', ELEMENTS)
+    assert not is_valid_formula('', ELEMENTS)
@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+
+from annotation_pipeline.image import gen_iso_images
+from annotation_pipeline.segment import ISOTOPIC_PEAK_N
+
+NROWS, NCOLS = 5, 7
+
+
+def _original_gen_iso_images(sp_inds, sp_mzs, sp_ints, centr_df, nrows, ncols, ppm=3, min_px=1):
+    # The implementation that gen_iso_images replaced, kept as a reference for its output
+    centr_f_inds = centr_df.formula_i.values
+    centr_p_inds = centr_df.peak_i.values
+    centr_mzs = centr_df.mz.values
+    centr_ints = centr_df.int.values
+
+    def yield_buffer(buffer):
+        while len(buffer) < ISOTOPIC_PEAK_N:
+            buffer.append((buffer[0][0], len(buffer) - 1, 0, None))
+        buffer = np.array(buffer, dtype=object)
+        buffer = buffer[buffer[:, 1].argsort(kind='stable')]
+        buffer = pd.DataFrame(buffer, columns=['formula_i', 'peak_i', 'centr_ints', 'image'])
+        return buffer.formula_i[0], buffer.centr_ints, buffer.image
+
+    lower = centr_mzs - centr_mzs * ppm * 1e-6
+    upper = centr_mzs + centr_mzs * ppm * 1e-6
+    lower_idx = np.searchsorted(sp_mzs, lower, 'left')
+    upper_idx = np.searchsorted(sp_mzs, upper, 'right')
+    ranges_df = pd.DataFrame({'formula_i': centr_f_inds, 'lower_idx': lower_idx, 'upper_idx': upper_idx})
+    ranges_df = ranges_df.sort_values('formula_i')
+
+    buffer = []
+    for df_index, df_row in ranges_df.iterrows():
+        if len(buffer) != 0 and buffer[0][0] != centr_f_inds[df_index]:
+            yield yield_buffer(buffer)
+            buffer = []
+
+        l, u = df_row['lower_idx'], df_row['upper_idx']
+        m = None
+        if u - l >= min_px:
+            inds = sp_inds[l:u]
+            m = coo_matrix((sp_ints[l:u], (inds // ncols, inds % ncols)), shape=(nrows, ncols), copy=True)
+        buffer.append((centr_f_inds[df_index], centr_p_inds[df_index], centr_ints[df_index], m))
+
+    if len(buffer) != 0:
+        yield yield_buffer(buffer)
+
+
+def _synthetic_case():
+    rng = np.random.RandomState(42)
+    formulas_n = 30
+    centr_df = pd.DataFrame({
+        'formula_i': np.repeat(np.arange(formulas_n), ISOTOPIC_PEAK_N),
+        'peak_i': np.tile(np.arange(ISOTOPIC_PEAK_N), formulas_n),
+        'mz': 100 + np.arange(formulas_n * ISOTOPIC_PEAK_N) * 0.5,
+        'int': np.tile([100, 50, 20, 5], formulas_n).astype(float),
+    })
+    # Clip leading, middle and trailing peaks, as the centroids of a segment lose peaks outside its mz range
+    clipped = [(1, 0), (2, 1), (2, 2), (3, 3), (4, 0), (4, 1), (4, 2), (5, 1), (5, 2), (5, 3), (6, 0), (6, 3)]
+    clipped += [(formula_i, peak_i) for formula_i in range(10, formulas_n) if rng.rand() < 0.5
+                for peak_i in range(ISOTOPIC_PEAK_N) if rng.rand() < 0.5]
+    keep = ~centr_df.set_index(['formula_i', 'peak_i']).index.isin(clipped)
+    centr_df = centr_df[keep].sort_values('mz')
+
+    # Spectra hit most centroids, so some peaks have no image
+    hit_mzs = rng.choice(centr_df.mz.values, size=len(centr_df) * 2)
+    sp_mzs = np.sort(np.r_[hit_mzs + rng.uniform(-1e-4, 1e-4, len(hit_mzs)), rng.uniform(99, 200, 100)])
+    sp_inds = rng.randint(0, NROWS * NCOLS, len(sp_mzs))
+    sp_ints = rng.uniform(1, 1000, len(sp_mzs)).astype(np.float32)
+    return sp_inds, sp_mzs, sp_ints, centr_df
+
+
+def test_gen_iso_images_matches_original_with_clipped_peaks():
+    sp_inds, sp_mzs, sp_ints, centr_df = _synthetic_case()
+
+    expected = list(_original_gen_iso_images(sp_inds, sp_mzs, sp_ints, centr_df, NROWS, NCOLS, min_px=2))
+    actual = list(gen_iso_images(sp_inds, sp_mzs, sp_ints, centr_df, NROWS, NCOLS, min_px=2))
+
+    assert [f_i for f_i, _, _ in actual] == [f_i for f_i, _, _ in expected]
+    for (_, ints, images), (_, exp_ints, exp_images) in zip(actual, expected):
+        np.testing.assert_array_equal(ints, exp_ints.astype(float))
+        assert [img is None for img in images] == [img is None for img in exp_images]
+        for img, exp_img in zip(images, exp_images):
+            if img is not None:
+                np.testing.assert_array_equal(img.toarray(), exp_img.toarray())
+
+
+def test_gen_iso_images_pads_before_later_peaks():
+    sp_inds, sp_mzs, sp_ints, centr_df = _synthetic_case()
+
+    images_by_formula = {f_i: (ints, images) for f_i, ints, images
+                         in gen_iso_images(sp_inds, sp_mzs, sp_ints, centr_df, NROWS, NCOLS)}
+    # Peaks 1, 2 and 3 survive, and the padding goes between peaks 2 and 3
+    np.testing.assert_array_equal(images_by_formula[1][0], [50, 20, 0, 5])
+    assert images_by_formula[1][1][2] is None
+    # Peaks 0 and 3, and then 1 and 2 survive
+    np.testing.assert_array_equal(images_by_formula[2][0], [100, 0, 0, 5])
+    np.testing.assert_array_equal(images_by_formula[6][0], [50, 0, 20, 0])
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from annotation_pipeline.isocalc_cache import IsotopePatternCache
+from annotation_pipeline.storage import LocalCOSClient
+
+N_PEAKS = 4
+
+
+def _calculate_centroids_batch(formulas, calculated):
+    calculated.extend(formulas)
+    mzs = np.array([[len(formula) + peak_i for peak_i in range(N_PEAKS)] for formula in formulas], dtype=float)
+    return mzs, mzs / 10
+
+
+@pytest.fixture
+def cos(tmp_path):
+    return LocalCOSClient(str(tmp_path))
+
+
+def _cache(cos):
+    return IsotopePatternCache(cos, 'db', 'isocalc_cache', 1, 0.001238, N_PEAKS)
+
+
+def test_centroids_are_calculated_once(cos):
+    isocalc_cache = _cache(cos)
+    calculated = []
+
+    def calculate_centroids_batch(formulas):
+        return _calculate_centroids_batch(formulas, calculated)
+
+    mzs, ints = isocalc_cache.centroids(['C6H12O6', 'H2O'], calculate_centroids_batch)
+    np.testing.assert_array_equal(mzs[1], [3, 4, 5, 6])
+    np.testing.assert_array_equal(ints, mzs / 10)
+    # Centroids calculated by a previous call are reused even before they are stored
+    mzs2, ints2 = isocalc_cache.centroids(['H2O', 'CO2', 'C6H12O6'], calculate_centroids_batch)
+    np.testing.assert_array_equal(mzs2[[2, 0]], mzs)
+    assert calculated == ['C6H12O6', 'H2O', 'CO2']
+    assert (isocalc_cache.hits, isocalc_cache.misses) == (2, 3)
+
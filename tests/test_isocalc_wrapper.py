@@ -0,0 +1,38 @@
+import numpy as np
+
+from annotation_pipeline.executor import LocalExecutor
+from annotation_pipeline.isocalc_wrapper import IsocalcWrapper, BATCH_CHUNK_SIZE
+
+ISOCALC_CONFIG = {'charge': {'polarity': '+', 'n_charges': 1}, 'isocalc_sigma': 0.001238}
+
+
+def _formulas(n):
+    return [f'C{c}H{h}O{o}' for c, h, o in zip(np.arange(n) % 40 + 1, np.arange(n) % 70 + 1, np.arange(n) % 9 + 1)]
+
+
+def test_centroids_batch_matches_centroids():
+    isocalc_wrapper = IsocalcWrapper(ISOCALC_CONFIG)
+    formulas = _formulas(20) + ['C6H12O6X', 'not a formula']
+    mzs, ints = isocalc_wrapper.centroids_batch(formulas, processes=1)
+
+    for i, formula in enumerate(formulas[:20]):
+        formula_mzs, formula_ints = isocalc_wrapper.centroids(formula)
+        np.testing.assert_array_equal(mzs[i], formula_mzs)
+        np.testing.assert_array_equal(ints[i], formula_ints)
+    assert np.isnan(mzs[20:]).all() and np.isnan(ints[20:]).all()
+
+
+def test_centroids_batch_in_local_executor_call(tmp_path):
+    isocalc_wrapper = IsocalcWrapper(ISOCALC_CONFIG)
+    formulas = _formulas(BATCH_CHUNK_SIZE * 2 + 1)
+
+    def calculate_centroids(formulas):
+        # Calls of the local executor run in daemonic processes, which can't start a pool
+        return isocalc_wrapper.centroids_batch(formulas, processes=2)
+
+    pw = LocalExecutor({'local_cos': {'path': str(tmp_path)}, 'storage': {'output_bucket': 'out'}}, workers=1)
+    mzs, ints = pw.get_result(pw.map(calculate_centroids, [[formulas]]))[0]
+
+    expected_mzs, expected_ints = isocalc_wrapper.centroids_batch(formulas, processes=1)
+    np.testing.assert_array_equal(mzs, expected_mzs)
+    np.testing.assert_array_equal(ints, expected_ints)
@@ -0,0 +1,137 @@
+import pickle
+
+import pandas as pd
+import pytest
+
+from annotation_pipeline.fdr import msgpack_load_text
+from annotation_pipeline.formula_parser import safe_generate_ion_formula
+from annotation_pipeline import molecular_db
+from annotation_pipeline.molecular_db import DECOY_ADDUCTS, build_database, get_formula_index_key
+from annotation_pipeline.utils import get_ibm_cos_client, list_keys, read_manifest, read_object_with_retry
+
+DATABASES = {'db/mol_db1.pickle': ['C2H6O', 'C6H12O6', 'CO2', 'H2O'],
+             'db/mol_db2.pickle': ['C5H5N5', 'C6H12O6', 'NH3']}
+
+
+def _config(cos_path):
+    config = {'local_cos': {'path': cos_path},
+              'executor': {'type': 'local', 'workers': 4},
+              'storage': {'db_bucket': 'db', 'output_bucket': 'out'}}
+    ibm_cos = get_ibm_cos_client(config)
+    for database, mols in DATABASES.items():
+        ibm_cos.put_object(Bucket='db', Key=database, Body=pickle.dumps(mols))
+    return config
+
+
+@pytest.fixture
+def config(tmp_path):
+    return _config(str(tmp_path / 'cos'))
+
+
+def _input_db(databases, adducts=('+H', '+Na')):
+    return {'formulas_chunks': 'db/formulas_chunks',
+            'databases': list(databases),
+            'adducts': list(adducts),
+            'modifiers': ['', '-H2O']}
+
+
+def _formulas(config, input_db):
+    """ Formula of every formula_i in the formulas chunks of the build """
+    ibm_cos = get_ibm_cos_client(config)
+    manifest = read_manifest(ibm_cos, 'db', f'{input_db["formulas_chunks"]}_manifest.json')
+    chunks = [read_object_with_retry(ibm_cos, 'db', key, pd.read_msgpack) for key in manifest['formula_chunks']]
+    return pd.concat(chunks).formula
+
+
+def _check_formula_indices(config, input_db):
+    ibm_cos = get_ibm_cos_client(config)
+    formulas = _formulas(config, input_db)
+    adducts = [*input_db['adducts'], *DECOY_ADDUCTS]
+    for database in input_db['databases']:
+        mols = DATABASES[database]
+        for modifier in input_db['modifiers']:
+            formula_index_key = get_formula_index_key(input_db['formulas_chunks'], database, modifier)
+            formula_index = read_object_with_retry(ibm_cos, 'db', formula_index_key, msgpack_load_text)
+            assert formula_index['adducts'] == adducts
+            assert formula_index['formula_is'].shape == (len(adducts), len(mols))
+            for adduct_i, adduct in enumerate(adducts):
+                for mol_i, mol in enumerate(mols):
+                    formula_i = formula_index['formula_is'][adduct_i, mol_i]
+                    expected_formula = safe_generate_ion_formula(mol, modifier, adduct)
+                    if expected_formula is None:
+                        assert formula_i == -1
+                    else:
+                        assert formulas[formula_i] == expected_formula
+
+
+def test_build_database_formula_indices(config):
+    input_db = _input_db(DATABASES)
+    build_database(config, input_db)
+
+    _check_formula_indices(config, input_db)
+
+
+def test_build_database_formula_i(config, tmp_path):
+    input_db = _input_db(DATABASES)
+    formulas_n, _ = build_database(config, input_db)
+
+    formulas = _formulas(config, input_db)
+    expected_formulas = {safe_generate_ion_formula(mol, modifier, adduct)
+                         for mols in DATABASES.values() for mol in mols
+                         for modifier in input_db['modifiers']
+                         for adduct in [*input_db['adducts'], *DECOY_ADDUCTS]} - {None}
+    # Every ion formula gets exactly one formula_i, numbered from 0
+    assert sorted(formulas.index) == list(range(formulas_n))
+    assert formulas.is_unique
+    assert set(formulas) == expected_formulas
+
+    # The same input always gets the same formula_i
+    other_config = _config(str(tmp_path / 'other_cos'))
+    build_database(other_config, input_db)
+    pd.testing.assert_series_equal(_formulas(other_config, input_db).sort_index(), formulas.sort_index())
+
+
+def _manifest(config, input_db):
+    return read_manifest(get_ibm_cos_client(config), 'db', f'{input_db["formulas_chunks"]}_manifest.json')
+
+
+def test_build_database_rerun_does_nothing(config, monkeypatch):
+    input_db = _input_db(DATABASES)
+    build_result = build_database(config, input_db)
+    manifest = _manifest(config, input_db)
+    keys = list_keys('db', '', get_ibm_cos_client(config))
+
+    def get_executor(config):
+        raise AssertionError('An up to date build should not run anything')
+
+    monkeypatch.setattr(molecular_db, 'get_executor', get_executor)
+    assert build_database(config, input_db) == build_result
+    assert _manifest(config, input_db) == manifest
+    assert list_keys('db', '', get_ibm_cos_client(config)) == keys
+
+
+def test_build_database_adds_database(config):
+    db1, db2 = DATABASES
+    input_db = _input_db([db1])
+    formulas_n_before, _ = build_database(config, input_db)
+    formulas_before = _formulas(config, input_db)
+    manifest_before = _manifest(config, input_db)
+
+    input_db = _input_db([db1, db2])
+    formulas_n, _ = build_database(config, input_db)
+    formulas = _formulas(config, input_db)
+    manifest = _manifest(config, input_db)
+
+    # Formulas of the first database keep their formula_i, and new formulas are appended
+    pd.testing.assert_series_equal(formulas[formulas.index < formulas_n_before].sort_index(),
+                                   formulas_before.sort_index())
+    assert sorted(formulas.index) == list(range(formulas_n))
+    assert formulas.is_unique and formulas_n > formulas_n_before
+    assert manifest['build_id'] == manifest_before['build_id']
+    assert manifest['generation'] == manifest_before['generation'] + 1
+    assert manifest['formula_chunks'][:len(manifest_before['formula_chunks'])] == manifest_before['formula_chunks']
+    _check_formula_indices(config, input_db)
+
+    # Changing the adducts renumbers the formulas with a new build_id
+    build_database(config, _input_db([db1, db2], adducts=['+K']))
+    assert _manifest(config, input_db)['build_id'] != manifest['build_id']
@@ -0,0 +1,44 @@
+import json
+from copy import deepcopy
+
+from annotation_pipeline.pipeline import Pipeline
+from annotation_pipeline.utils import read_manifest, write_manifest
+
+
+def test_pipeline(synthetic_case, tmp_path):
+    config, input_config = synthetic_case
+    config = deepcopy(config)
+    config['executor']['trace_dir'] = str(tmp_path)
+    # The local executor returns results in lists even for single futures, as PyWren does
+    pipeline = Pipeline(config, input_config)
+    pipeline(resume=False)
+
+    metrics_df = pipeline.formula_metrics_df
+    assert len(metrics_df) > 0
+    assert set(pipeline.fdrs.index) <= set(metrics_df.index)
+    with open(pipeline.pywren_executor.trace_path) as f:
+        events = json.load(f)['traceEvents']
+    # Every map is shown as a process, with a track per call
+    annotate_pids = {event['pid'] for event in events
+                     if event['name'] == 'process_name' and event['args']['name'].endswith('process_centr_segment')}
+    annotate_calls = [event for event in events if event['name'] == 'call' and event['pid'] in annotate_pids]
+    assert len(annotate_calls) == pipeline.centr_segm_n
+
+
+def test_run_fdr_fingerprint_depends_on_formulas_build(synthetic_case):
+    config, input_config = synthetic_case
+    pipeline = Pipeline(config, input_config)
+    pipeline.load_ds()
+    manifest_key = f'{input_config["molecular_db"]["formulas_chunks"]}_manifest.json'
+    manifest = read_manifest(pipeline.ibm_cos, config['storage']['db_bucket'], manifest_key)
+    fingerprints = {stage: pipeline.stage_fingerprint(stage) for stage in ['annotate', 'run_fdr']}
+
+    for changed_manifest in [dict(manifest, generation=manifest['generation'] + 1),
+                             dict(manifest, databases={database: 'changed' for database in manifest['databases']})]:
+        write_manifest(pipeline.ibm_cos, config['storage']['db_bucket'], manifest_key, changed_manifest)
+        try:
+            assert pipeline.stage_fingerprint('annotate') == fingerprints['annotate']
+            assert pipeline.stage_fingerprint('run_fdr') != fingerprints['run_fdr']
+        finally:
+            write_manifest(pipeline.ibm_cos, config['storage']['db_bucket'], manifest_key, manifest)
+    assert pipeline.stage_fingerprint('run_fdr') == fingerprints['run_fdr']
@@ -0,0 +1,36 @@
+from collections import OrderedDict
+
+import pytest
+
+from annotation_pipeline.scaling import STAGES, run_case, results_to_df, strong_scaling_table, weak_scaling_table
+
+
+def test_run_case(synthetic_case):
+    result = run_case(*synthetic_case, workers=2)
+
+    assert result['workers'] == 2 and list(result['stages']) == STAGES
+    assert result['wall_s'] == pytest.approx(sum(stats['wall_s'] for stats in result['stages'].values()))
+    annotate = result['stages']['annotate']
+    assert annotate['maps'] >= 1 and annotate['actions'] > 0 and annotate['cos_bytes_read'] > 0
+    assert 0 < annotate['critical_path_s'] and result['gb_seconds'] > 0
+
+
+def _result(case, work, workers, annotate_wall_s):
+    stages = OrderedDict((stage, OrderedDict([('wall_s', work / 10 / workers)])) for stage in STAGES)
+    stages['annotate']['wall_s'] = annotate_wall_s
+    return {'case': case, 'work': work, 'dbs_n': 1, 'workers': workers,
+            'wall_s': sum(stats['wall_s'] for stats in stages.values()), 'gb_seconds': 0, 'cost_usd': 0,
+            'stages': stages}
+
+
+def test_scaling_tables():
+    # Every stage scales perfectly except annotate, which takes as long with any number of workers
+    df = results_to_df([_result('small', 100, 1, 10), _result('small', 100, 2, 10), _result('large', 200, 2, 20)])
+    assert len(df) == 3 * (len(STAGES) + 1)
+
+    strong = strong_scaling_table(df).loc[('small', 1, 2)]
+    assert strong['segment_ds'] == pytest.approx(1) and strong['annotate'] == pytest.approx(0.5)
+    assert strong['first_to_stop_scaling'] == 'annotate'
+
+    weak = weak_scaling_table(df).loc[(100, 1, 2)]
+    assert weak['segment_ds'] == pytest.approx(1) and weak['annotate'] == pytest.approx(0.5)
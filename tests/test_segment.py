@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+
+from annotation_pipeline.segment import estimate_formula_costs, cost_balanced_bounds, FORMULA_COST
+
+# 10 dataset segments of 100 mz each, with 90% of the peaks between 700 and 900
+DS_SEGMENTS_BOUNDS = np.array([[100 + i * 100, 200 + i * 100] for i in range(10)], dtype=float)
+DS_SEGMS_LEN = np.array([1000] * 6 + [450000] * 2 + [1000] * 2)
+
+
+def _centr_df(first_peak_mzs):
+    formulas_n = len(first_peak_mzs)
+    return pd.DataFrame({'formula_i': np.repeat(np.arange(formulas_n), 4),
+                         'peak_i': np.tile(np.arange(4), formulas_n),
+                         'mz': (np.asarray(first_peak_mzs)[:, None] + np.arange(4)).ravel()})
+
+
+def test_formula_costs_depend_on_peak_density():
+    costs = estimate_formula_costs(_centr_df([150, 750, 850, 950]), DS_SEGMENTS_BOUNDS, DS_SEGMS_LEN, ppm=3)
+
+    assert list(costs.index) == [0, 1, 2, 3]
+    assert FORMULA_COST < costs[0] < costs[3]
+    # Formulas in the dense mz range have images for most of their peaks
+    assert costs[1] > 5 * costs[0] and costs[2] > 5 * costs[3]
+
+
+def test_cost_balanced_bounds():
+    rs = np.random.RandomState(0)
+    first_peak_mzs = rs.uniform(100, 1096, 10000)
+    formula_costs = estimate_formula_costs(_centr_df(first_peak_mzs), DS_SEGMENTS_BOUNDS, DS_SEGMS_LEN, ppm=3).values
+
+    bounds = cost_balanced_bounds(first_peak_mzs, formula_costs, DS_SEGMENTS_BOUNDS, DS_SEGMS_LEN, 32)
+    assert len(bounds) == 32 and np.all(np.diff(bounds) > 0) and bounds[0] == first_peak_mzs.min()
+    # Segments are narrower where formulas are more expensive
+    widths = np.diff(bounds)
+    assert np.median(widths[(bounds[:-1] > 700) & (bounds[1:] < 900)]) < np.median(widths[bounds[1:] < 700]) / 5
+
+
+def test_cost_balanced_bounds_are_unique():
+    first_peak_mzs = np.array([100., 200., 300., 300., 300., 400.])
+    # The first formula costs more than several segments
+    formula_costs = np.array([1e6, 1, 1, 1, 1, 1])
+
+    bounds = cost_balanced_bounds(first_peak_mzs, formula_costs, DS_SEGMENTS_BOUNDS, DS_SEGMS_LEN, 8)
+    np.testing.assert_array_equal(bounds, np.unique(bounds))
+    assert bounds[0] == 100
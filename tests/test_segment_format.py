@@ -0,0 +1,55 @@
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+
+from annotation_pipeline.segment_format import dumps_segment, loads_segment, read_segment
+from annotation_pipeline.storage import LocalCOSClient
+
+
+def _random_columns(rows_n, seed=0):
+    rs = np.random.RandomState(seed)
+    return OrderedDict([('sp_i', rs.randint(0, 1000, rows_n).astype(np.uint32)),
+                        ('mz', np.sort(rs.uniform(100, 1000, rows_n))),
+                        ('int', rs.uniform(0, 1e5, rows_n).astype(np.float32))])
+
+
+def _assert_columns_equal(actual, expected):
+    assert list(actual) == list(expected)
+    for name in expected:
+        assert actual[name].dtype == expected[name].dtype
+        np.testing.assert_array_equal(actual[name], expected[name])
+
+
+@pytest.mark.parametrize('rows_n', [0, 1, 100, 10000])
+def test_round_trip(rows_n):
+    columns = _random_columns(rows_n)
+    _assert_columns_equal(loads_segment(dumps_segment(columns, index_step=64)), columns)
+
+
+def test_ranged_reads(tmp_path):
+    cos = LocalCOSClient(str(tmp_path))
+    columns = _random_columns(10000)
+    # Repeated mzs at block boundaries
+    columns['mz'][4000:4200] = columns['mz'][4000]
+    cos.put_object(Bucket='b', Key='segm', Body=dumps_segment(columns, index_step=64))
+
+    _assert_columns_equal(read_segment(cos, 'b', 'segm'), columns)
+    mz = columns['mz']
+    for lo, hi in [(0, 50), (2000, 3000), (100, 1000), (mz[0], mz[0]), (mz[-1], mz[-1]),
+                   (mz[4000], mz[4000]), (mz[123], mz[4567]), (500, 400)]:
+        rows = (mz >= lo) & (mz <= hi)
+        expected = OrderedDict((name, arr[rows]) for name, arr in columns.items())
+        _assert_columns_equal(read_segment(cos, 'b', 'segm', mz_range=(lo, hi)), expected)
+
+
+def test_ranged_reads_with_big_header(tmp_path):
+    cos = LocalCOSClient(str(tmp_path))
+    columns = _random_columns(100000)
+    # The mz index doesn't fit in the prefetched header bytes
+    cos.put_object(Bucket='b', Key='segm', Body=dumps_segment(columns, index_step=4))
+
+    mz = columns['mz']
+    rows = (mz >= 300) & (mz <= 301)
+    expected = OrderedDict((name, arr[rows]) for name, arr in columns.items())
+    _assert_columns_equal(read_segment(cos, 'b', 'segm', mz_range=(300, 301)), expected)
@@ -0,0 +1,66 @@
+import json
+import pickle
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from annotation_pipeline.molecular_db import DECOY_ADDUCTS
+from annotation_pipeline.server import InteractiveAnnotator, _AnnotationRequestHandler, _ThreadingHTTPServer
+from annotation_pipeline.utils import get_ibm_cos_client, read_object_with_retry
+
+
+@pytest.fixture(scope='module')
+def annotator(synthetic_case):
+    return InteractiveAnnotator(*synthetic_case)
+
+
+@pytest.fixture(scope='module')
+def hit(synthetic_case, annotator):
+    """ An ion of a database molecule that is in the dataset. Most planted formulas have decoy adducts. """
+    config, input_config = synthetic_case
+    database = input_config['molecular_db']['databases'][0]
+    mols = pickle.loads(read_object_with_retry(get_ibm_cos_client(config), config['storage']['db_bucket'], database))
+    results = annotator.annotate(mols, adducts=DECOY_ADDUCTS)
+    return max(results, key=lambda result: result['msm'])
+
+
+@pytest.fixture
+def server_url(annotator):
+    server = _ThreadingHTTPServer(('127.0.0.1', 0), _AnnotationRequestHandler)
+    server.annotator = annotator
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+def test_annotate(annotator, hit):
+    assert hit['msm'] > 0 and hit['mz'] > 0
+    result, = annotator.annotate([hit['formula']], [hit['adduct']], images=True)
+    assert result['ion_formula'] == hit['ion_formula'] and result['msm'] == hit['msm']
+    assert any(isinstance(image, str) for image in result['images'])
+    assert annotator.annotate(['C6H12O6'], ['-C7']) == []
+
+
+def _request(url, body=None):
+    data = None if body is None else (body if isinstance(body, bytes) else json.dumps(body).encode('utf-8'))
+    try:
+        with urllib.request.urlopen(url, data) as response:
+            return response.status, json.loads(response.read().decode('utf-8'))
+    except urllib.error.HTTPError as ex:
+        return ex.code, json.loads(ex.read().decode('utf-8'))
+
+
+def test_http_handler(annotator, hit, server_url):
+    status, body = _request(f'{server_url}/status')
+    assert status == 200 and body['spectra'] == annotator.pipeline.sp_n and body['peaks'] == len(annotator.sp_mzs)
+
+    status, body = _request(f'{server_url}/annotate', {'formulas': [hit['formula']], 'adducts': [hit['adduct']]})
+    assert status == 200 and [result['msm'] for result in body['results']] == [hit['msm']]
+
+    assert _request(f'{server_url}/annotate', b'{"adducts": ["+H"]}')[0] == 400
+    assert _request(f'{server_url}/annotate', b'not json')[0] == 400
+    assert _request(f'{server_url}/unknown')[0] == 404
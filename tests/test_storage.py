@@ -0,0 +1,73 @@
+import pytest
+
+from annotation_pipeline.storage import LocalCOSClient, _parse_range
+from annotation_pipeline.utils import list_keys, list_prefixes, read_object_with_retry
+
+
+@pytest.mark.parametrize('range_header, size, expected', [
+    ('bytes=0-9', 100, (0, 10)),
+    ('bytes=10-19', 100, (10, 20)),
+    ('bytes=0-0', 100, (0, 1)),
+    ('bytes=90-', 100, (90, 100)),
+    ('bytes=-10', 100, (90, 100)),
+    ('bytes=-200', 100, (0, 100)),
+    ('bytes=90-199', 100, (90, 100)),
+    ('bytes=150-199', 100, (100, 100)),
+    ('bytes=5-4', 100, (5, 5)),
+    ('bytes=0-9', 0, (0, 0)),
+])
+def test_parse_range(range_header, size, expected):
+    assert _parse_range(range_header, size) == expected
+
+
+@pytest.fixture
+def cos(tmp_path):
+    return LocalCOSClient(str(tmp_path))
+
+
+def test_ranged_get_object(cos):
+    body = bytes(range(256))
+    cos.put_object(Bucket='b', Key='dir/obj', Body=body)
+
+    assert cos.get_object(Bucket='b', Key='dir/obj')['Body'].read() == body
+    assert cos.get_object(Bucket='b', Key='dir/obj', Range='bytes=10-19')['Body'].read() == body[10:20]
+    assert cos.get_object(Bucket='b', Key='dir/obj', Range='bytes=-16')['Body'].read() == body[-16:]
+    assert bytes(cos.get_object(Bucket='b', Key='dir/obj', Range='bytes=250-')['Body'].buffer) == body[250:]
+    assert read_object_with_retry(cos, 'b', 'dir/obj', byte_range=(100, 110)) == body[100:110]
+    assert read_object_with_retry(cos, 'b', 'dir/obj', byte_range=(100, 100)) == b''
+
+
+def test_get_missing_object(cos):
+    from ibm_botocore.exceptions import ClientError
+
+    with pytest.raises(ClientError):
+        cos.get_object(Bucket='b', Key='missing')
+    with pytest.raises(ClientError):
+        cos.head_object(Bucket='b', Key='missing')
+
+
+def test_list_and_delete(cos):
+    keys = ['a.b', 'a/b', 'a/c/d', 'ab', 'b']
+    for key in keys:
+        cos.put_object(Bucket='b', Key=key, Body=key)
+
+    assert list_keys('b', '', cos) == sorted(keys)
+    assert list_keys('b', 'a', cos) == ['a.b', 'a/b', 'a/c/d', 'ab']
+    assert list_keys('b', 'a/', cos) == ['a/b', 'a/c/d']
+    page = cos.list_objects_v2(Bucket='b', MaxKeys=2)
+    assert [obj['Key'] for obj in page['Contents']] == ['a.b', 'a/b'] and page['IsTruncated']
+
+    cos.delete_objects(Bucket='b', Delete={'Objects': [{'Key': 'a/b'}, {'Key': 'a/c/d'}]})
+    assert list_keys('b', '', cos) == ['a.b', 'ab', 'b']
+
+
+def test_list_prefixes(cos):
+    for key in ['a.b', 'a/b', 'a/c/d', 'a/e/f', 'ab', 'b']:
+        cos.put_object(Bucket='b', Key=key, Body=key)
+
+    assert list_prefixes('b', '', cos) == ['a/']
+    assert list_prefixes('b', 'a/', cos) == ['a/c/', 'a/e/']
+    page = cos.list_objects_v2(Bucket='b', Prefix='a', Delimiter='/', MaxKeys=2)
+    assert [obj['Key'] for obj in page['Contents']] == ['a.b'] and page['CommonPrefixes'] == [{'Prefix': 'a/'}]
+    page = cos.list_objects_v2(Bucket='b', Prefix='a', Delimiter='/', ContinuationToken=page['NextContinuationToken'])
+    assert [obj['Key'] for obj in page['Contents']] == ['ab'] and 'CommonPrefixes' not in page
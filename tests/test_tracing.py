@@ -0,0 +1,41 @@
+import json
+
+import pytest
+
+from annotation_pipeline.executor import LocalExecutor
+from annotation_pipeline.tracing import TracingExecutor, span
+
+
+@pytest.fixture
+def pw(tmp_path):
+    executor = LocalExecutor({'local_cos': {'path': str(tmp_path / 'cos')}, 'storage': {'output_bucket': 'out'}},
+                             workers=2)
+    return TracingExecutor(executor, str(tmp_path / 'traces'))
+
+
+def store(x, ibm_cos):
+    with span('upload', x=x):
+        ibm_cos.put_object(Bucket='out', Key=f'{x}.txt', Body=b'a' * x)
+    return x
+
+
+def test_results_have_the_shape_of_the_wrapped_executor(pw):
+    futures = pw.map(store, [1, 2, 3])
+    assert pw.get_result(futures) == [1, 2, 3]
+    assert pw.get_result(futures[1]) == [2]
+    futures = pw.map(store, [4])
+    assert pw.get_result() == [1, 2, 3, 4]
+    assert pw.get_result() == []
+
+
+def test_calls_are_traced(pw):
+    pw.get_result(pw.map(store, [10, 20], runtime_memory=512))
+
+    with open(pw.trace_path) as f:
+        events = json.load(f)['traceEvents']
+    uploads = sorted([event for event in events if event['name'] == 'upload'], key=lambda event: event['args']['x'])
+    written = [(event['args']['objects_written'], event['args']['bytes_written']) for event in uploads]
+    assert written == [(1, 10), (1, 20)]
+    calls = [event for event in events if event['name'] == 'call']
+    assert [event['args']['runtime_memory_mb'] for event in calls] == [512, 512]
+    assert len([event for event in events if event['name'] == 'queued']) == 2
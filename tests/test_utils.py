@@ -0,0 +1,77 @@
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from annotation_pipeline.utils import merge_sorted_runs
+
+
+def _random_runs(rs, runs_n, max_rows, mz_ranges):
+    runs = []
+    for run_i in range(runs_n):
+        rows_n = rs.randint(0, max_rows)
+        lo, hi = mz_ranges[run_i]
+        runs.append(OrderedDict([('mz', np.sort(rs.uniform(lo, hi, rows_n))),
+                                 ('sp_i', rs.randint(0, 1000, rows_n).astype(np.uint32)),
+                                 ('int', rs.uniform(0, 1, rows_n).astype(np.float32))]))
+    return runs
+
+
+def _sort_values_baseline(runs):
+    df = pd.concat([pd.DataFrame(run) for run in runs], ignore_index=True).sort_values('mz', kind='mergesort')
+    return OrderedDict((name, df[name].values) for name in df.columns)
+
+
+def _assert_columns_equal(actual, expected):
+    assert list(actual) == list(expected)
+    for name in expected:
+        assert actual[name].dtype == expected[name].dtype
+        np.testing.assert_array_equal(actual[name], expected[name])
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('block_rows', [1, 7, 4096])
+def test_merge_overlapping_runs(seed, block_rows):
+    rs = np.random.RandomState(seed)
+    runs = _random_runs(rs, 8, 2000, [(100, 1000)] * 4 + [(400, 600)] * 2 + [(900, 1200)] * 2)
+    _assert_columns_equal(merge_sorted_runs(runs, block_rows=block_rows), _sort_values_baseline(runs))
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_merge_disjoint_runs(seed):
+    rs = np.random.RandomState(seed)
+    runs = _random_runs(rs, 6, 1000, [(i * 100, (i + 1) * 100) for i in range(6)])
+    _assert_columns_equal(merge_sorted_runs(runs), _sort_values_baseline(runs))
+
+
+def test_merge_into_preallocated_out():
+    rs = np.random.RandomState(0)
+    runs = _random_runs(rs, 4, 1000, [(0, 10)] * 4)
+    total_n = sum(len(run['mz']) for run in runs)
+    out = OrderedDict((name, np.empty(total_n + 10, dtype=arr.dtype)) for name, arr in runs[0].items())
+
+    merged = merge_sorted_runs(runs, out=out, block_rows=16)
+    _assert_columns_equal(merged, _sort_values_baseline(runs))
+    assert all(np.shares_memory(merged[name], out[name]) for name in out)
+
+
+def test_merge_runs_with_ties():
+    runs = [OrderedDict([('mz', np.repeat(np.arange(5.), 10)), ('sp_i', np.arange(50) + run_i * 50)])
+            for run_i in range(3)]
+    merged = merge_sorted_runs(runs, block_rows=3)
+    expected = _sort_values_baseline(runs)
+
+    np.testing.assert_array_equal(merged['mz'], expected['mz'])
+    # The order of rows with equal keys isn't specified
+    merged_rows = sorted(zip(merged['mz'], merged['sp_i']))
+    assert merged_rows == sorted(zip(expected['mz'], expected['sp_i']))
+
+
+def test_merge_empty_runs():
+    empty = OrderedDict([('mz', np.zeros(0)), ('sp_i', np.zeros(0, dtype=np.uint32))])
+    assert merge_sorted_runs([]) == OrderedDict()
+    assert merge_sorted_runs([empty, empty]) == OrderedDict()
+
+    run = OrderedDict([('mz', np.array([1., 2.])), ('sp_i', np.array([3, 4], dtype=np.uint32))])
+    _assert_columns_equal(merge_sorted_runs([empty, run, empty]), run)
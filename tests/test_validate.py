@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+from scipy.sparse import coo_matrix
+
+from annotation_pipeline import validate
+from annotation_pipeline.validate import make_compute_image_metrics, make_compute_image_metrics_batch
+
+NROWS, NCOLS = 6, 8
+FORMULA_INTS = [100., 50., 20., 5.]
+
+
+def _sparse(img):
+    return coo_matrix(img)
+
+
+def _synthetic_batch():
+    rng = np.random.RandomState(42)
+    sample_area_mask = np.ones((NROWS, NCOLS), dtype=bool)
+    sample_area_mask[0, :3] = False
+
+    formulas_ints, formulas_images = [], []
+    for _ in range(40):
+        base = rng.uniform(0, 1000, (NROWS, NCOLS)) * (rng.rand(NROWS, NCOLS) < 0.6)
+        images = [_sparse(base * ratio + rng.uniform(0, 50, (NROWS, NCOLS)) * (base > 0))
+                  for ratio in [1, 0.5, 0.2, 0.05]]
+        images[rng.randint(1, 4)] = None
+        formulas_ints.append(FORMULA_INTS)
+        formulas_images.append(images)
+
+    single_px = np.zeros((NROWS, NCOLS))
+    single_px[3, 4] = 500
+    constant = np.full((NROWS, NCOLS), 3.)
+    zero = np.zeros((NROWS, NCOLS))
+    base = formulas_images[0][0].toarray()
+    # Edge cases: zero, single-pixel and constant images, including pixels outside of the sample area
+    for images in [[_sparse(single_px), _sparse(single_px * 0.5), None, None],
+                   [_sparse(constant), _sparse(constant * 0.5), _sparse(constant * 0.2), None],
+                   [_sparse(base), _sparse(constant), _sparse(zero), _sparse(base * 0.05)],
+                   [_sparse(base), _sparse(zero), _sparse(zero), _sparse(zero)],
+                   [_sparse(zero), _sparse(base), None, None],
+                   [_sparse(base), _sparse(base * 0.5), _sparse(base * 0.2), _sparse(base * 0.05)]]:
+        formulas_ints.append(FORMULA_INTS)
+        formulas_images.append(images)
+    return sample_area_mask, formulas_ints, formulas_images
+
+
+@pytest.mark.parametrize('spatial_chunk_px', [validate.SPATIAL_CHUNK_PX, NROWS * NCOLS * 4 * 3])
+def test_batch_metrics_equal_formula_metrics(monkeypatch, spatial_chunk_px):
+    monkeypatch.setattr(validate, 'SPATIAL_CHUNK_PX', spatial_chunk_px)
+    sample_area_mask, formulas_ints, formulas_images = _synthetic_batch()
+    img_gen_config = {'nlevels': 30}
+
+    compute = make_compute_image_metrics(sample_area_mask, NROWS, NCOLS, img_gen_config)
+    compute_batch = make_compute_image_metrics_batch(sample_area_mask, NROWS, NCOLS, img_gen_config)
+
+    expected = [compute(f_images, f_ints) for f_ints, f_images in zip(formulas_ints, formulas_images)]
+    actual = compute_batch(formulas_ints, formulas_images)
+
+    assert sum(m['msm'] > 0 for m in expected) > 20
+    assert len(actual) == len(expected)
+    for metrics, exp_metrics in zip(actual, expected):
+        assert list(metrics) == list(exp_metrics)
+        for name, value in exp_metrics.items():
+            assert metrics[name] == pytest.approx(value, rel=1e-9, abs=1e-12), name
+
+
+def test_batch_metrics_of_empty_batch():
+    compute_batch = make_compute_image_metrics_batch(np.ones((NROWS, NCOLS), dtype=bool), NROWS, NCOLS, {})
+    assert compute_batch([], []) == []